@@ -0,0 +1,255 @@
+"""Latency and scaling benchmark of the CLI commands.
+
+    python benchmark.py [--markets 10,50,200] [--borrowers 1000,50000] [--repeat 5]
+                        [--latency 0.002] [--output benchmark.json] [--rpc URL]
+    python benchmark.py --codec 20000
+
+Every command runs end-to-end in a new `morpho-cli.py` process against a node
+answering JSON-RPC over HTTP on localhost. By default the node is a synthetic Morpho
+Blue deployment (utils.synthetic_chain) with a MetaMorpho vault of the requested
+number of markets and borrowers (spread over the markets), with `latency` seconds
+per request, so the benchmark works fully offline. With --rpc the commands run
+against another node (e.g. an anvil fork) configured by the .env file.
+
+Results (p50/p95 wall time, JSON-RPC requests and peak RSS of each command by vault
+size) are written to a JSON file with the commit, to be compared across commits.
+
+--codec measures the client side cost of the hot reader calls instead: calls per
+second of getPosition and getMarketData through web3 contracts and through
+morpho.codec, against a provider answering instantly with a canned result.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from eth_abi import encode
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+from morpho import codec
+from utils.middleware import chain_id_middleware
+from utils.synthetic_chain import SyntheticChain, serve
+
+# Commands benchmarked: name -> (cli arguments, cold caches)
+COMMANDS = {
+    "open (cold)": ("stats", True),
+    "open": ("stats", False),
+    "summary": ("summary", False),
+    "borrowers": ("borrowers", False),
+    "reallocation planning": ("simulate", False),
+}
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def planning(chain):
+    """simulate arguments moving 10% of the vault supply of every market to idle"""
+    ids = chain.marketIds()
+    args = []
+    for id in ids[1:]:
+        supply = chain._supplyAssets(bytes.fromhex(id[2:]), chain.vault.lower())
+        args += [id, f"{supply * 0.9 / pow(10, 6):.0f}"]
+    return " ".join(args + [ids[0], "max"])
+
+
+def run_command(args, env):
+    """(seconds, peak RSS in MB) of one CLI process"""
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "morpho-cli.py"] + args.split(),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        # wait4 gives the resource usage of this process only
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise Exception(
+                f"morpho-cli.py {args[:40]} failed: {stderr.read().decode()[-2000:]}"
+            )
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return elapsed, usage.ru_maxrss * scale / pow(10, 6)
+
+
+def benchmark(markets, borrowers, repeat, latency, rpc=None):
+    """Results of every command for one vault size"""
+    env = dict(os.environ, LOG_FILE="", MORPHO_BLUE_MARKETS="")
+    chain = None
+    if rpc is None:
+        chain = SyntheticChain(
+            markets=markets,
+            borrowers=max(1, borrowers // max(markets, 1)),
+            latency=latency,
+        )
+        server, url = serve(chain)
+        env.update(
+            WEB3_HTTP_PROVIDER=url,
+            META_MORPHO=chain.vault,
+            MORPHO_BLUE=chain.blue,
+            MORPHO_READER=chain.reader,
+        )
+    else:
+        env["WEB3_HTTP_PROVIDER"] = rpc
+
+    # One unmeasured run fills the cache of the warm commands
+    warmCache = tempfile.mkdtemp(prefix="morpho-bench-")
+    run_command("stats", dict(env, MORPHO_CACHE_DIR=warmCache))
+    results = []
+    for name, (args, cold) in COMMANDS.items():
+        if args == "simulate":
+            if chain is None:
+                continue
+            args = "simulate " + planning(chain)
+        runs = []
+        for _ in range(repeat):
+            env["MORPHO_CACHE_DIR"] = (
+                tempfile.mkdtemp(prefix="morpho-bench-") if cold else warmCache
+            )
+            requests = chain.requests if chain else 0
+            elapsed, rss = run_command(args, env)
+            runs.append((elapsed, rss, chain.requests - requests if chain else None))
+        seconds = [r[0] for r in runs]
+        result = {
+            "command": name,
+            "markets": markets,
+            "borrowers": borrowers,
+            "p50": percentile(seconds, 0.5),
+            "p95": percentile(seconds, 0.95),
+            "mean": statistics.mean(seconds),
+            "rpc": runs[-1][2],
+            "peakRssMb": max(r[1] for r in runs),
+            "runs": seconds,
+        }
+        print(
+            f"{name:<22} markets {markets:<4} borrowers {borrowers:<6} "
+            f"p50 {result['p50']:.2f}s p95 {result['p95']:.2f}s "
+            f"rpc {result['rpc']} rss {result['peakRssMb']:.0f}MB"
+        )
+        results.append(result)
+    if chain is not None:
+        server.shutdown()
+    return results
+
+
+class CannedProvider(BaseProvider):
+    """Answers every eth_call with the same 8 words, no I/O"""
+
+    result = "0x" + encode(["uint256"] * 8, [pow(10, 18) + i for i in range(8)]).hex()
+
+    def make_request(self, method, params):
+        if method == "eth_chainId":
+            return {"jsonrpc": "2.0", "id": 0, "result": "0x1"}
+        return {"jsonrpc": "2.0", "id": 0, "result": self.result}
+
+
+def codec_benchmark(calls):
+    """Calls per second of the reader calls through web3 and through the codec"""
+    web3 = Web3(CannedProvider())
+    web3.middleware_onion.add(chain_id_middleware, name="chain_id")
+    reader = Web3.to_checksum_address("0x" + "11" * 20)
+    contract = web3.eth.contract(
+        address=reader, abi=json.load(open("abis/MorphoReader.json"))
+    )
+    id = "0x" + "22" * 32
+    # Addresses as they come from logs, lower case, a few of them repeated
+    addresses = ["0x" + f"{i % 1000:040x}" for i in range(calls)]
+    paths = {
+        "getPosition (web3)": lambda a: contract.functions.getPosition(
+            id, Web3.to_checksum_address(a)
+        ).call(),
+        "getPosition (codec)": lambda a: codec.get_position(
+            web3, reader, id, codec.checksum(a)
+        ),
+        "getMarketData (web3)": lambda a: contract.functions.getMarketData(id).call(),
+        "getMarketData (codec)": lambda a: codec.get_market_data(web3, reader, id),
+    }
+    results = []
+    for name, call in paths.items():
+        start = time.perf_counter()
+        for address in addresses:
+            call(address)
+        elapsed = time.perf_counter() - start
+        results.append(
+            {"command": name, "calls": calls, "callsPerSecond": calls / elapsed}
+        )
+        print(f"{name:<22} {calls / elapsed:>10,.0f} calls/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--markets", default="10,50,200")
+    parser.add_argument("--borrowers", default="1000,10000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--rpc", default=None)
+    parser.add_argument("--codec", type=int, default=0)
+    options = parser.parse_args()
+
+    results = []
+    if options.codec:
+        results = codec_benchmark(options.codec)
+    sizes = [
+        (int(m), int(b))
+        for m in options.markets.split(",")
+        for b in options.borrowers.split(",")
+    ]
+    if options.rpc:
+        # The vault of the .env file, its size isn't ours to choose
+        sizes = [(0, 0)]
+    if options.codec:
+        sizes = []
+    for markets, borrowers in sizes:
+        results += benchmark(
+            markets, borrowers, options.repeat, options.latency, options.rpc
+        )
+
+    with open(options.output, "w") as file:
+        json.dump(
+            {
+                "commit": commit(),
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "node": options.rpc or "synthetic",
+                "latency": options.latency,
+                "repeat": options.repeat,
+                "maxWorkers": int(os.environ.get("MAX_WORKERS", 10)),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
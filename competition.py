@@ -1,88 +1,59 @@
 import os
-import json
+
+from morpho.codec import encode_address, get_logs
+from morpho.log_decoder import log_decoder
+
+
+def reserveDataUpdated(web3, pool, token, fromBlock):
+    """Decoded ReserveDataUpdated logs of the reserve token of an Aave v3 pool"""
+    decoder = log_decoder()
+    logs = get_logs(
+        web3,
+        {
+            "address": pool,
+            "fromBlock": fromBlock,
+            "toBlock": "latest",
+            "topics": [
+                decoder.topic("ReserveDataUpdated"),
+                "0x" + encode_address(token).hex(),
+            ],
+        },
+    )
+    return decoder.decode(logs).get("ReserveDataUpdated") or []
 
 
 def aaveV3Rates(web3, token, nbBlocks=50):
     address = os.environ.get("AAVE_V3_POOL")
-    contract = web3.eth.contract(
-        address=web3.to_checksum_address(address),
-        abi=json.load(open("abis/aave_v3_pool.json")),
-    )
     currentBlock = web3.eth.get_block_number()
-    logs = (
-        contract.events.ReserveDataUpdated()
-        .create_filter(
-            fromBlock=currentBlock - nbBlocks, argument_filters={"reserve": token}
-        )
-        .get_all_entries()
-    )
+    logs = reserveDataUpdated(web3, address, token, currentBlock - nbBlocks)
     cnt = len(logs)
 
     if cnt == 0:
-        logs = (
-            contract.events.ReserveDataUpdated()
-            .create_filter(
-                fromBlock=currentBlock - nbBlocks * 10,
-                argument_filters={"reserve": token},
-            )
-            .get_all_entries()
-        )
+        logs = reserveDataUpdated(web3, address, token, currentBlock - nbBlocks * 10)
         cnt = len(logs)
         if cnt == 0:
             print(f"Error: No logs found for {token}")
             return (0, 0, 0)
 
-    borrowRate = 0
-    supplyRate = 0
-
-    for log in logs:
-        borrowRate += log.args.variableBorrowRate / pow(10, 27)
-        supplyRate += log.args.liquidityRate / pow(10, 27)
-
-    borrowRate = borrowRate / cnt
-    supplyRate = supplyRate / cnt
+    borrowRate = logs.floats("variableBorrowRate").mean() / pow(10, 27)
+    supplyRate = logs.floats("liquidityRate").mean() / pow(10, 27)
     return (supplyRate, borrowRate, cnt)
 
 
 def sparkRates(web3, token="0x6b175474e89094c44da98b954eedeac495271d0f", nbBlocks=1000):
     address = os.environ.get("SPARK_POOL")
-    contract = web3.eth.contract(
-        address=web3.to_checksum_address(address),
-        abi=json.load(open("abis/aave_v3_pool.json")),
-    )
     currentBlock = web3.eth.get_block_number()
-    logs = (
-        contract.events.ReserveDataUpdated()
-        .create_filter(
-            fromBlock=currentBlock - nbBlocks, argument_filters={"reserve": token}
-        )
-        .get_all_entries()
-    )
+    logs = reserveDataUpdated(web3, address, token, currentBlock - nbBlocks)
     cnt = len(logs)
 
     if cnt == 0:
-        logs = (
-            contract.events.ReserveDataUpdated()
-            .create_filter(
-                fromBlock=currentBlock - nbBlocks * 10,
-                argument_filters={"reserve": token},
-            )
-            .get_all_entries()
-        )
+        logs = reserveDataUpdated(web3, address, token, currentBlock - nbBlocks * 10)
         cnt = len(logs)
 
     if cnt == 0:
         print(f"Error: No logs found for {token}")
         return (0, 0, 0)
 
-    borrowRate = 0
-    supplyRate = 0
-
-    for log in logs:
-        # print(log)
-        borrowRate += log.args.variableBorrowRate / pow(10, 27)
-        supplyRate += log.args.liquidityRate / pow(10, 27)
-
-    borrowRate = borrowRate / cnt
-    supplyRate = supplyRate / cnt
+    borrowRate = logs.floats("variableBorrowRate").mean() / pow(10, 27)
+    supplyRate = logs.floats("liquidityRate").mean() / pow(10, 27)
     return (supplyRate, borrowRate, cnt)
@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+# Default schedule of the daemon, the commands of do_full
+DEFAULT_SCHEDULE = "summary@5;competition@50;reallocation execute@10;borrowers@25"
+
+
+@dataclass
+class Workflow:
+    line: str
+    every: int
+    nextBlock: int = 0
+    running: bool = False
+    runs: int = 0
+    skipped: int = 0
+
+    @property
+    def name(self) -> str:
+        return self.line.split()[0]
+
+
+def parse_schedule(spec: str) -> list[Workflow]:
+    """Workflows of a "<command line>@<blocks>;..." schedule (DAEMON_SCHEDULE)"""
+    workflows = []
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        line, _, every = entry.rpartition("@")
+        if not line.strip() or not every.strip().isdigit() or int(every) < 1:
+            raise Exception(f"Invalid schedule entry '{entry}', use <command>@<blocks>")
+        workflows.append(Workflow(line.strip(), int(every)))
+    return workflows
+
+
+class BlockScheduler:
+    """Run CLI workflows from one warm process, each one every N blocks.
+
+    New heads come from the block head notifier. A workflow due at a block is
+    skipped if its previous run hasn't finished, the next run is planned N blocks
+    later plus a random jitter (DAEMON_JITTER blocks) so workflows sharing a period
+    don't always start on the same block. Workflows run one at a time, `run(line)`
+    returns a dict of results (e.g. output, RPC calls) and each run is appended as a
+    JSON line to the results file (DAEMON_RESULTS).
+    """
+
+    def __init__(self, head, workflows, run, jitter=None, results=None, log=print):
+        self.head = head
+        self.workflows = workflows
+        self.run = run
+        self.jitter = int(
+            jitter if jitter is not None else os.environ.get("DAEMON_JITTER", 2)
+        )
+        self.results = results or os.environ.get("DAEMON_RESULTS") or "daemon.jsonl"
+        self.log = log
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._stop = threading.Event()
+
+    def onNewHead(self, number):
+        with self._lock:
+            for w in self.workflows:
+                if number < w.nextBlock:
+                    continue
+                w.nextBlock = number + w.every + random.randint(0, self.jitter)
+                if w.running:
+                    w.skipped += 1
+                    self.log(f"{w.line} skipped at block {number}, still running")
+                    continue
+                w.running = True
+                self._executor.submit(self._execute, w, number)
+
+    def _execute(self, workflow, block):
+        started = datetime.datetime.now()
+        start = time.perf_counter()
+        details, error = {}, None
+        try:
+            details = self.run(workflow.line)
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+            self.log(f"{workflow.line} failed at block {block}: {error}")
+        finally:
+            with self._lock:
+                workflow.running = False
+                workflow.runs += 1
+        self._write(
+            {
+                "workflow": workflow.line,
+                "block": block,
+                "started": started.isoformat(timespec="seconds"),
+                "seconds": round(time.perf_counter() - start, 3),
+                "ok": error is None,
+                "error": error,
+                **details,
+            }
+        )
+
+    def _write(self, result):
+        with open(self.results, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+    def start(self):
+        self.head.subscribe(self.onNewHead)
+        self.head.start()
+        self.onNewHead(self.head.number())
+
+    def stop(self):
+        self._stop.set()
+        self.head.stop()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def wait(self):
+        """Block until stop() or Ctrl-C"""
+        try:
+            while not self._stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.log("Daemon stopping")
+        self.stop()
@@ -0,0 +1,211 @@
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+import json
+import os
+
+from web3 import Account, Web3
+from web3.exceptions import ContractLogicError
+
+from morpho import MorphoMarket, Position
+from morpho.liquidation_ranking import LiquidationRanking, RankedLiquidation
+from utils.output import ContextThreadPoolExecutor
+
+WETH = "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2"
+
+
+@dataclass(frozen=True)
+class PreparedLiquidation:
+    market: MorphoMarket
+    position: Position
+    fnct: object
+    seizedAssets: int
+    repaidAssets: int
+    ranking: RankedLiquidation | None = None
+
+    @property
+    def seizedValue(self) -> float:
+        return (
+            self.seizedAssets
+            / self.market.collateralTokenFactor
+            * self.position.collateralPrice
+        )
+
+    @property
+    def expectedProfit(self) -> float:
+        """Profit from the ranking engine, otherwise value of the seized collateral
+        minus the repaid debt, in loan token
+        """
+        if self.ranking is not None:
+            return self.ranking.profit
+        return self.seizedValue - self.repaidAssets / self.market.loanTokenFactor
+
+    @property
+    def label(self) -> str:
+        return f"liquidation {self.market.name()} {self.position.address}"
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.market.name()} {self.position.address} health {self.position.healthRatio*100:.1f}% "
+            f"repay {self.repaidAssets / self.market.loanTokenFactor:,.2f} "
+            f"seize {self.seizedAssets / self.market.collateralTokenFactor:,.4f} "
+            f"profit {self.expectedProfit:,.2f}"
+        )
+
+
+class LiquidationBatchRunner:
+    """Prepare the liquidations of a set of markets concurrently: find unhealthy
+    borrowers, simulate each liquidation with eth_call on the pending block, drop
+    the ones that revert and submit the others, most profitable first.
+    pipeline is a function returning the TransactionPipeline, only called when
+    executing so that dry runs need neither PRIVATE_KEY nor MAX_GWEI.
+    """
+
+    def __init__(self, web3, liquidatorAddress, pipeline, log=print, quotes=None):
+        self.web3 = web3
+        self._pipelineFactory = pipeline
+        self._pipeline = None
+        self.quotes = quotes
+        self.log = log
+        self.liquidator = web3.eth.contract(
+            address=Web3.to_checksum_address(liquidatorAddress),
+            abi=json.load(open("abis/MorphoLiquidator.json")),
+        )
+
+    @property
+    def pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self._pipelineFactory()
+        return self._pipeline
+
+    @property
+    def sender(self) -> str | None:
+        """Account the liquidations are simulated from"""
+        if self._pipeline is not None:
+            return self._pipeline.address
+        if os.environ.get("PRIVATE_KEY"):
+            return Account.from_key(os.environ.get("PRIVATE_KEY")).address
+        return None
+
+    def gasPrice(self) -> int:
+        if self._pipeline is not None:
+            return self._pipeline.fees().effectiveGasPrice
+        return self.web3.eth.gas_price
+
+    def candidates(self, markets, maxHealthRatio=0.99):
+        """Unhealthy (market, position) of all the markets"""
+
+        def fetch(market):
+            return [(market, p) for p in market.borrowers().unhealthy(maxHealthRatio)]
+
+        candidates = []
+        with ContextThreadPoolExecutor(
+            max_workers=os.environ.get("MAX_WORKERS", 10)
+        ) as executor:
+            for future in as_completed([executor.submit(fetch, m) for m in markets]):
+                candidates += future.result()
+        return candidates
+
+    def swapRates(self, candidates):
+        """1inch rates to sell the collateral of each candidate and to buy the loan
+        tokens with ETH, fetched concurrently within the quote time budget. With
+        LIQUIDATOR_1INCH set the collateral sales are fetched as swaps so their
+        calldata is cached for the liquidation.
+        Returns (swapRates, nativePrices) for LiquidationRanking.
+        """
+        if self.quotes is None or not self.quotes.enabled:
+            return {}, {}
+        # Positions of the same market can sell the same amount
+        sells = {}
+        for m, p in candidates:
+            if p.collateral > 0:
+                quote = (
+                    m.collateralToken,
+                    m.loanToken,
+                    int(p.collateral * m.collateralTokenFactor),
+                )
+                sells.setdefault(quote, []).append((m, p))
+        natives = {(WETH, m.loanToken, pow(10, 18)): m for m, _ in candidates}
+        swapper = os.environ.get("LIQUIDATOR_1INCH")
+        if swapper:
+            rates = self.quotes.prefetch(
+                list(natives), swaps=[(*q, swapper) for q in sells]
+            )
+        else:
+            rates = self.quotes.prefetch(list(sells) + list(natives))
+
+        swapRates = {}
+        nativePrices = {}
+        for quote, rate in rates.items():
+            for m, p in sells.get(quote, []):
+                swapRates[(m.collateralToken, m.loanToken, p.address)] = (
+                    rate * m.collateralTokenFactor / m.loanTokenFactor
+                )
+            if quote in natives:
+                m = natives[quote]
+                nativePrices[m.loanToken] = rate * pow(10, 18) / m.loanTokenFactor
+        return swapRates, nativePrices
+
+    def rank(self, candidates) -> list[RankedLiquidation]:
+        """Candidates sorted by expected profit with the current gas price"""
+        swapRates, nativePrices = self.swapRates(candidates)
+        ranking = LiquidationRanking(self.gasPrice(), nativePrices=nativePrices)
+        return ranking.rank(candidates, swapRates)
+
+    def prepare(self, market, position, ranking=None) -> PreparedLiquidation | None:
+        """Simulate the liquidation, returns None if it would revert"""
+        fnct = self.liquidator.functions.liquidate(
+            market.params.toTuple(),
+            Web3.to_checksum_address(position.address),
+            0,
+            False,
+        )
+        try:
+            seizedAssets, repaidAssets = fnct.call(
+                {"from": self.sender} if self.sender else {},
+                block_identifier="pending",
+            )
+        except (ContractLogicError, ValueError) as exc:
+            self.log(f"{market.name()} {position.address} dropped, reverts: {exc}")
+            return None
+        return PreparedLiquidation(
+            market, position, fnct, seizedAssets, repaidAssets, ranking
+        )
+
+    def prepareAll(self, ranked) -> list[PreparedLiquidation]:
+        """Simulate all the ranked candidates concurrently, most profitable first"""
+        prepared = []
+        with ContextThreadPoolExecutor(
+            max_workers=os.environ.get("MAX_WORKERS", 10)
+        ) as executor:
+            futures = {
+                executor.submit(self.prepare, r.market, r.position, r): r
+                for r in ranked
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    r = futures[future]
+                    self.log(
+                        f"{r.market.name()} {r.position.address} skipped, "
+                        f"simulation failed: {exc}"
+                    )
+                    continue
+                if result is not None:
+                    prepared.append(result)
+        return sorted(prepared, key=lambda p: p.expectedProfit, reverse=True)
+
+    def run(self, markets, maxHealthRatio=0.99, execute=True):
+        if execute:
+            # Rank with the fees the transactions will be sent with
+            self.pipeline.fees()
+        prepared = self.prepareAll(self.rank(self.candidates(markets, maxHealthRatio)))
+        for p in prepared:
+            self.log(f"{p}")
+        if not execute or not prepared:
+            return []
+        # Failing transactions are reported and skipped by submitMany
+        hashes = self.pipeline.submitMany([(p.label, p.fnct) for p in prepared])
+        sent = sum(h is not None for h in hashes)
+        self.log(f"{sent}/{len(prepared)} liquidations sent")
+        return hashes
@@ -1,17 +1,37 @@
 from web3 import Web3
-from web3 import Account
 import json
 from dotenv import load_dotenv
 import morpho
-from morpho import MorphoBlue, MetaMorpho
+from morpho import MorphoBlue, MetaMorpho, simulate_reallocation
+from morpho.account_index import account_index
+from morpho.backtest import GasModel, market_history, run_backtests
+from morpho.block_time import block_time
+from morpho.blocks import block_head
+from morpho.event_archive import event_archive
+from morpho.market_catalog import market_catalog
+from morpho.bulk_positions import bulk_positions
+from morpho.liquidation_ranking import LiquidationRanking, liquidation_incentive_factor
+from morpho.mathlib import MAX_UINT256
+from morpho.morphomarket import top_borrowers
+from morpho.strategy_equal_yield import StrategyEqualYield
+from morpho.strategy_max_yield import StrategyMaxYield
+from morpho.strategy_rate_target import StrategyRateTarget
 import os
 import sys
 import cmd
 import math
+import time
 import competition
 from texttable import Texttable
 from web3.gas_strategies.rpc import rpc_gas_price_strategy
 import oneinch
+from transactions import transaction_pipeline, wait_for_receipts
+from utils.middleware import chain_id_middleware
+from utils.output import ContextThreadPoolExecutor, capture, run_buffered
+from utils.profiler import profiled
+from utils.rpc_stats import stats as rpc_stats
+from liquidation import LiquidationBatchRunner
+from daemon import DEFAULT_SCHEDULE, BlockScheduler, parse_schedule
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -28,22 +48,8 @@ def log(message, addTimestamp=True):
             file.write(f"{message}\n")
 
 
-def executeTransaction(web3, fnct):
-    privateKey = os.environ.get("PRIVATE_KEY")
-    maxGas = int(os.environ.get("MAX_GWEI"))
-    account = Account.from_key(privateKey)
-    account_address = account.address
-    # print(account_address)
-    tx = fnct.build_transaction({"from": account_address})
-    nonce = web3.eth.get_transaction_count(account.address)
-    tx["nonce"] = nonce
-    signed_transaction = account.sign_transaction(tx)
-    log(f"gas prices => {web3.eth.generate_gas_price()/pow(10,9):,.0f}")
-    if web3.eth.generate_gas_price() < Web3.to_wei(maxGas, "gwei"):
-        tx_hash = web3.eth.send_raw_transaction(signed_transaction.rawTransaction)
-        log(f"Executed with hash => {tx_hash.hex()}")
-    else:
-        log(f"gas price too high => {web3.eth.generate_gas_price()/pow(10,9):,.0f}")
+def executeTransaction(web3, fnct, label=""):
+    return transaction_pipeline(web3, log).submit(fnct, label)
 
 
 class MorphoCli(cmd.Cmd):
@@ -51,12 +57,18 @@ class MorphoCli(cmd.Cmd):
     prompt = ">> "
     vault = None
     web3 = None
+    blue = None
+    liquidation_runner = None
 
     def __init__(self):
         cmd.Cmd.__init__(self)
 
         # Connect to web3
         self.web3 = Web3(Web3.HTTPProvider(os.environ.get("WEB3_HTTP_PROVIDER")))
+        self.web3.middleware_onion.inject(
+            rpc_stats.middleware, name="rpc_stats", layer=0
+        )
+        self.web3.middleware_onion.add(chain_id_middleware, name="chain_id")
         if not self.web3.is_connected():
             raise Exception("Issue to connect to Web3")
 
@@ -89,6 +101,54 @@ class MorphoCli(cmd.Cmd):
         else:
             self.vault = MetaMorpho(self.web3, os.environ.get(args.upper()))
 
+    def onecmd(self, line):
+        # Attribute the RPC calls to the command being run
+        command = line.split()[0] if line.strip() else "empty"
+        with rpc_stats.command(command), profiled(command):
+            try:
+                return cmd.Cmd.onecmd(self, line)
+            finally:
+                rpc_stats.export()
+
+    def do_stats(self, args):
+        """stats [reset] - JSON-RPC calls, bytes and latency of each command"""
+        if args == "reset":
+            rpc_stats.reset()
+            return
+        table = Texttable()
+        table.header(
+            [
+                "Command",
+                "Method",
+                "Calls",
+                "Errors",
+                "kB",
+                "Mean ms",
+                "p50 ms",
+                "p95 ms",
+            ]
+        )
+        table.set_cols_align(["l", "l", "r", "r", "r", "r", "r", "r"])
+        table.set_cols_dtype(["t", "t", "i", "i", "f", "f", "f", "f"])
+        table.set_precision(1)
+        table.set_deco(Texttable.HEADER)
+        for row in rpc_stats.table():
+            table.add_row(row)
+        print(table.draw())
+        print()
+
+    def do_block(self, policy):
+        """block [latest|safe|finalized|<number>] - block the data is read at"""
+        head = block_head(self.web3)
+        if policy:
+            try:
+                head.setPolicy(policy)
+            except ValueError as exc:
+                print(exc)
+                print("Usage: block [latest|safe|finalized|<number>]")
+                return
+        print(f"Reading at {head.policy} block {head.number()}")
+
     def do_summary(self, line):
         if self.vault is None:
             print("First add a MetaMorpho vault")
@@ -105,6 +165,27 @@ class MorphoCli(cmd.Cmd):
         self.vault.summary()
         print()
 
+    def do_monitor(self, args):
+        """monitor [seconds] - print markets extrapolated locally every few seconds"""
+        if self.vault is None:
+            print("First add a MetaMorpho vault")
+            return
+        interval = float(args) if args else 1.0
+        self.vault.watch()
+        try:
+            while True:
+                now = datetime.now()
+                for m in self.vault.getBorrowMarkets():
+                    data = m.expectedMarketData()
+                    print(
+                        f"{now:%H:%M:%S.%f} {m.name()} - supply: {data.totalSupplyAssets:,.2f} "
+                        f"borrow: {data.totalBorrowAssets:,.2f} util: {data.utilization*100:.2f}% "
+                        f"rates: {data.supplyRate*100:.2f}%/{data.borrowRate*100:.2f}%"
+                    )
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print()
+
     def do_position(self, address):
         if not address:
             address = input("Please provide a vault address or enter 'q' to go back: ")
@@ -119,15 +200,21 @@ class MorphoCli(cmd.Cmd):
             position = market.position(address)
             return market, position
 
+        markets = list(self.vault.getBorrowMarkets())
+        index = self.accountIndex()
+        if index is not None:
+            # Only the markets the address has used
+            ids = index.markets(address)
+            markets = [m for m in markets if m.id.lower() in ids]
+            if not markets:
+                print(f"No position of {address} in the vault markets")
+
         # Initialize ThreadPoolExecutor
-        with ThreadPoolExecutor(
+        with ContextThreadPoolExecutor(
             max_workers=os.environ.get("MAX_WORKERS", 10)
         ) as executor:
             # Submit tasks to executor
-            futures = [
-                executor.submit(fetch_position, m)
-                for m in self.vault.getBorrowMarkets()
-            ]
+            futures = [executor.submit(fetch_position, m) for m in markets]
 
             for future in as_completed(futures):
                 market, position = future.result()
@@ -141,6 +228,153 @@ class MorphoCli(cmd.Cmd):
                     )
                 )
 
+    def do_positions(self, args):
+        """positions <file|address,...> [--jsonl] [--output file] - positions of many
+        addresses (one per line or first CSV column of a file) in every vault market,
+        streamed as CSV or JSON lines
+        """
+        if self.vault is None:
+            print("First add a MetaMorpho vault")
+            return
+        words = args.split()
+        output = None
+        if "--output" in words:
+            index = words.index("--output")
+            output = words[index + 1]
+            del words[index : index + 2]
+        jsonl = "--jsonl" in words
+        addresses = []
+        for word in (w for w in words if w != "--jsonl"):
+            if os.path.isfile(word):
+                with open(word) as file:
+                    values = [line.split(",")[0].strip() for line in file]
+            else:
+                values = word.split(",")
+            addresses += [v for v in values if Web3.is_address(v)]
+        if not addresses:
+            print("Usage: positions <file|address,...> [--jsonl] [--output file]")
+            return
+
+        file = open(output, "w") if output else sys.stdout
+        try:
+            header = True
+            for market, table in bulk_positions(
+                self.web3, self.vault.markets, addresses, index=self.accountIndex()
+            ):
+                if jsonl:
+                    table.toJsonLines(file, market=market.id, name=market.name())
+                else:
+                    table.toCsv(file, header, market=market.id, name=market.name())
+                    header = False
+                file.flush()
+        finally:
+            if output:
+                file.close()
+
+    def accountIndex(self):
+        """The account index brought up to date, None until built by `index`"""
+        index = account_index(self.vault.blue if self.vault else self.blue)
+        if not index.ready():
+            return None
+        index.update()
+        return index
+
+    def do_index(self, args):
+        """index - build or update the index of the markets used by each account
+        from the Morpho Blue events, then used by position and positions
+        """
+        blue = self.vault.blue if self.vault else self.blue
+        if blue is None:
+            print("First add a some market to get a blue object")
+            return
+        index = account_index(blue)
+        start = time.time()
+        events = index.update()
+        print(
+            f"{events} events indexed in {time.time() - start:.1f}s, "
+            f"{len(index.accounts)} accounts up to block {index.lastBlock}"
+        )
+
+    def do_archive(self, args):
+        """archive [<market id>] - sync the event archive from the Morpho Blue events
+        and print the events archived per market, or the borrowers rebuilt from the
+        events of a market
+        """
+        blue = self.vault.blue if self.vault else self.blue
+        if blue is None:
+            print("First add a some market to get a blue object")
+            return
+        archive = event_archive(blue)
+        start = time.time()
+        added = archive.sync()
+        print(
+            f"{added} events archived in {time.time() - start:.1f}s, "
+            f"{archive.count} up to block {archive.lastBlock}"
+        )
+
+        table = Texttable(max_width=0)
+        table.set_deco(Texttable.HEADER)
+        if args.strip():
+            start = time.time()
+            accounts, borrowShares, collateral = archive.positions(args.strip())
+            elapsed = time.time() - start
+            table.header(["Account", "Borrow Shares", "Collateral"])
+            table.set_cols_dtype(["t", "e", "e"])
+            for i in borrowShares.argsort()[::-1]:
+                if borrowShares[i] > 0:
+                    table.add_row([accounts[i], borrowShares[i], collateral[i]])
+            print(table.draw())
+            print(f"{len(accounts)} accounts rebuilt in {elapsed * 1000:.1f}ms")
+            return
+        table.header(["Market", "Events", "First Block", "Last Block"])
+        for market, stats in zip(archive.markets, archive.marketStats):
+            table.add_row(
+                [market, stats["count"], stats["firstBlock"], stats["lastBlock"]]
+            )
+        print(table.draw())
+
+    def do_markets(self, args):
+        """markets [loan=<token>] [collateral=<token>] [lltv=<0.86>] [--add] - every
+        Morpho Blue market from the synced catalog matching the filters (tokens by
+        address or symbol), --add loads them in the Morpho Blue object
+        """
+        if self.blue is None:
+            self.blue = MorphoBlue(self.web3, os.environ.get("MORPHO_BLUE"))
+        catalog = market_catalog(self.blue)
+        created = catalog.sync()
+        if created:
+            print(f"{created} new markets, {len(catalog.markets)} in the catalog")
+        self.blue.catalog = catalog
+
+        filters = dict(w.split("=", 1) for w in args.split() if "=" in w)
+        unknown = set(filters) - {"loan", "collateral", "lltv"}
+        if unknown:
+            print(f"Unknown filter {', '.join(unknown)}, use loan, collateral, lltv")
+            return
+        ids = catalog.search(**filters)
+
+        table = Texttable(max_width=0)
+        table.header(["Id", "Loan", "Collateral", "LLTV", "Oracle", "IRM"])
+        table.set_deco(Texttable.HEADER)
+        for id in ids:
+            m = catalog.markets[id]
+            table.add_row(
+                [
+                    id,
+                    m["loanSymbol"],
+                    m["collateralSymbol"],
+                    f"{int(m['lltv']) / pow(10, 16):.1f}%",
+                    m["oracle"],
+                    m["irm"],
+                ]
+            )
+        print(table.draw())
+        print(f"{len(ids)} markets")
+        if "--add" in args.split():
+            for id in ids:
+                if self.blue.getMarketById(id) is None:
+                    self.blue.addMarket(id)
+
     def do_prices(self, address):
         # giving bad data in a number of ways
 
@@ -159,7 +393,19 @@ class MorphoCli(cmd.Cmd):
                 )
         print()
 
-    def do_borrowers(self, address):
+    def do_borrowers(self, args):
+        """borrowers [--top K] - borrowers of the vault markets by LTV, with --top
+        only the K riskiest of each market and across markets, printed as they come
+        """
+        words = args.split()
+        if "--top" in words:
+            value = words[words.index("--top") + 1 :][:1]
+            if not value or not value[0].isdigit() or int(value[0]) < 1:
+                print("Usage: borrowers --top <k> with k at least 1")
+                return
+            self.top_borrowers(int(value[0]))
+            return
+
         def fetch_borrowers(market):
             borrowers = []
             for p in market.borrowers():
@@ -169,7 +415,7 @@ class MorphoCli(cmd.Cmd):
         if self.vault is None:
             print("First add a MetaMorpho vault")
             return
-        with ThreadPoolExecutor(
+        with ContextThreadPoolExecutor(
             max_workers=os.environ.get("MAX_WORKERS", 10)
         ) as executor:
             futures = {
@@ -184,6 +430,21 @@ class MorphoCli(cmd.Cmd):
                     print(borrower_info[0])
                 print()
 
+    def top_borrowers(self, k):
+        if self.vault is None:
+            print("First add a MetaMorpho vault")
+            return
+        for market, positions in top_borrowers(self.vault.getBorrowMarkets(), k):
+            if market is None:
+                print(f"Top {k} across markets")
+                for m, p in positions:
+                    print(f"{p.ltv*100:.2f}% {m.name()} {p.address}")
+                continue
+            print(f"{market.name()}")
+            for p in positions:
+                print(f"{p.ltv*100:.2f}% {p.address}")
+            print()
+
     def do_market_borrowers(self, address):
         if self.blue is None:
             print("First add a some market to get a blue object")
@@ -209,10 +470,15 @@ class MorphoCli(cmd.Cmd):
             elif source == "spark":
                 return ("Spark DAI",) + competition.sparkRates(*args)
 
+        # 1 and 7 days windows from the block timestamps
+        head = block_head(self.web3).number()
+        times = block_time(self.web3)
+        now = times.timestamp(head)
+        day, week = times.resolve([now - 86400, now - 7 * 86400])
         tasks = [
             ("aaveV3", self.web3, self.vault.asset),
-            ("aaveV3_1d", self.web3, self.vault.asset, 7200),
-            ("aaveV3_7d", self.web3, self.vault.asset, 7 * 7200),
+            ("aaveV3_1d", self.web3, self.vault.asset, head - day),
+            ("aaveV3_7d", self.web3, self.vault.asset, head - week),
             ("spark", self.web3),  # only web3 needed
         ]
 
@@ -221,7 +487,7 @@ class MorphoCli(cmd.Cmd):
         table.set_cols_align(["l", "r", "r", "r"])
         table.set_deco(Texttable.HEADER)
 
-        with ThreadPoolExecutor(len(tasks)) as executor:
+        with ContextThreadPoolExecutor(len(tasks)) as executor:
             future_to_task = {
                 executor.submit(fetch_rates, *task): task[0] for task in tasks
             }
@@ -237,7 +503,7 @@ class MorphoCli(cmd.Cmd):
             rate = market.borrowRate()
             return market.collateralTokenSymbol, rate
 
-        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        with ContextThreadPoolExecutor(max_workers=len(tasks)) as executor:
             future_to_task = {
                 executor.submit(get_rate, m): m for m in self.vault.getBorrowMarkets()
             }
@@ -290,10 +556,25 @@ class MorphoCli(cmd.Cmd):
         )
         executeTransaction(self.web3, fnct)
 
+    def getBlueMarket(self, id):
+        """Market from the Morpho Blue object, loaded only once"""
+        if self.blue is None:
+            self.blue = MorphoBlue(self.web3, os.environ.get("MORPHO_BLUE"))
+        return self.blue.getMarketById(id) or self.blue.addMarket(id)
+
+    def liquidationRunner(self):
+        if self.liquidation_runner is None:
+            self.liquidation_runner = LiquidationBatchRunner(
+                self.web3,
+                os.environ.get("LIQUIDATOR_STEAKHOUSE"),
+                lambda: transaction_pipeline(self.web3, log),
+                log,
+                oneinch.quote_service(),
+            )
+        return self.liquidation_runner
+
     def liquidate(self, id, borrower):
-        blue = MorphoBlue(self.web3, os.environ.get("MORPHO_BLUE"), id)
-        market = blue.getMarketById(id)
-        marketParams = blue.marketParams(id)
+        market = self.getBlueMarket(id)
         pos = market.position(borrower)
         if pos.ltv < market.lltv:
             print(
@@ -309,42 +590,41 @@ class MorphoCli(cmd.Cmd):
         )
         # Compute seizable collateral
 
-        incentiveFactor = min(1.15, 1 / (1 - 0.3 * (1 - market.lltv)))
+        incentiveFactor = liquidation_incentive_factor(market.lltv)
         print(f"Incentive factor {incentiveFactor:,.4f}")
 
-        theoreticalSeizableCollateral = (
-            incentiveFactor * pos.borrowAssets * pos.collateralPrice
-        )
-
-        # In this case, we do not have to cover all the debt to retrieve the collateral. This is the case if there is a bad debt.
-        if theoreticalSeizableCollateral > pos.collateral:
-            seizedCollateral = pos.collateral
-        else:
-            seizedCollateral = theoreticalSeizableCollateral
-
-        print(
-            f"Will seize {seizedCollateral:,.4f} of collateral corresponding to {seizedCollateral * pos.collateralPrice:,.4f} in value"
-        )
+        # The whole collateral is seized if it doesn't cover the debt (bad debt)
+        for ranked in LiquidationRanking().rank([(market, pos)]):
+            print(
+                f"Will seize {ranked.seizedCollateral:,.4f} of collateral corresponding to {ranked.seizedCollateral * pos.collateralPrice:,.4f} in value"
+            )
 
-        abi = json.load(open("abis/MorphoLiquidator.json"))
-        liquidator = self.web3.eth.contract(
-            address=Web3.to_checksum_address(os.environ.get("LIQUIDATOR_STEAKHOUSE")),
-            abi=abi,
-        )
-        fnct = liquidator.functions.liquidate(
-            marketParams.toTuple(), Web3.to_checksum_address(borrower), 0, False
-        )
-        executeTransaction(self.web3, fnct)
+        prepared = self.liquidationRunner().prepare(market, pos)
+        if prepared is None:
+            return
+        executeTransaction(self.web3, prepared.fnct, prepared.label)
 
     def liquidate_1inch(self, id, borrower):
-        blue = MorphoBlue(self.web3, os.environ.get("MORPHO_BLUE"), id)
-        market = blue.getMarketById(id)
-        marketParams = blue.marketParams(id)
+        market = self.getBlueMarket(id)
+        marketParams = market.params
         pos = market.position(borrower)
         if pos.ltv < market.lltv:
             print(
                 f"LTV of {borrower} is {pos.ltv*100:.2f}%, limit LTV is {market.lltv*100:.2f}%"
             )
+            return
+        amount = pos.collateral * market.collateralTokenFactor
+        # Swap calldata of a liquidatable position fetched while it is reported,
+        # reused from the QuoteService cache when liquidate_markets prefetched it
+        executor = ThreadPoolExecutor(max_workers=1)
+        swap = executor.submit(
+            oneinch.quote_service().swap,
+            marketParams.collateralToken,
+            marketParams.loanToken,
+            amount,
+            os.environ.get("LIQUIDATOR_1INCH"),
+        )
+        executor.shutdown(wait=False)
 
         print(
             f"LTV of {borrower} is {pos.ltv*100:.2f}% above limit LTV {market.lltv*100:.2f}%, start liquidation"
@@ -355,43 +635,28 @@ class MorphoCli(cmd.Cmd):
         )
         # Compute seizable collateral
 
-        incentiveFactor = min(1.15, 1 / (1 - 0.3 * (1 - market.lltv)))
+        incentiveFactor = liquidation_incentive_factor(market.lltv)
         print(f"Incentive factor {incentiveFactor:,.4f}")
 
-        theoreticalSeizableCollateral = (
-            incentiveFactor * pos.borrowAssets * pos.collateralPrice
-        )
-
-        # In this case, we do not have to cover all the debt to retrieve the collateral. This is the case if there is a bad debt.
-        if theoreticalSeizableCollateral > pos.collateral:
-            seizedCollateral = pos.collateral
-        else:
-            seizedCollateral = theoreticalSeizableCollateral
-
-        print(
-            f"Will seize {seizedCollateral:,.4f} of collateral corresponding to {seizedCollateral * pos.collateralPrice:,.4f} in value"
-        )
+        # The whole collateral is seized if it doesn't cover the debt (bad debt)
+        for ranked in LiquidationRanking().rank([(market, pos)]):
+            print(
+                f"Will seize {ranked.seizedCollateral:,.4f} of collateral corresponding to {ranked.seizedCollateral * pos.collateralPrice:,.4f} in value"
+            )
 
         abi = json.load(open("abis/liquidator.json"))
-        amount = pos.collateral * market.collateralTokenFactor
         print(f"exact amount of collateral {amount}")
-        oneinch_result = oneinch.swapData(
-            marketParams.collateralToken,
-            marketParams.loanToken,
-            amount,
-            os.environ.get("LIQUIDATOR_1INCH"),
-        )
-        print(oneinch_result)
         liquidator = self.web3.eth.contract(
             address=Web3.to_checksum_address(os.environ.get("LIQUIDATOR_1INCH")),
             abi=abi,
         )
+        oneinch_result = swap.result()
         debug = {
             "tuple": marketParams.toTuple(),
             "who": Web3.to_checksum_address(borrower),
             "asset": int(pos.borrowShares * pow(10, 18)),
             "collateral": int(amount),
-            "data": oneinch_result.json()["tx"]["data"][2:],
+            "data": oneinch_result["tx"]["data"][2:],
         }
         print(debug)
         fnct = liquidator.functions.liquidate(
@@ -399,7 +664,7 @@ class MorphoCli(cmd.Cmd):
             Web3.to_checksum_address(borrower),
             0,
             int(pos.borrowShares * pow(10, 18)),
-            bytes.fromhex(oneinch_result.json()["tx"]["data"][2:]),
+            bytes.fromhex(oneinch_result["tx"]["data"][2:]),
         )
         executeTransaction(self.web3, fnct)
 
@@ -417,14 +682,15 @@ class MorphoCli(cmd.Cmd):
         if self.blue is None:
             print("First add a some market to get a blue object")
             return
-        for m in self.blue.markets:
-            print(f"{m.name()}")
-            for p in m.borrowers():
-                if p.healthRatio < 0.99:
-                    print(f"{p.address} health ratio is {p.healthRatio *100:.1f}%")
-                    self.liquidate(m.id, p.address)
+        self.liquidationRunner().run(self.blue.markets, 0.99, args != "dry")
         print()
 
+    def check_reallocation(self, allocations):
+        """Dry-run the allocations against a local model of MetaMorpho.reallocate"""
+        result = simulate_reallocation(self.vault.snapshot(), allocations)
+        log(f"Dry-run: {result}")
+        return result
+
     def reallocation_pyusd(self, execute=False):
         if self.vault.symbol != "steakPYUSD":
             print("Work only for steakPYUSD for now")
@@ -611,39 +877,27 @@ class MorphoCli(cmd.Cmd):
 
         print(script)
 
-        if execute:
-            privateKey = os.environ.get("PRIVATE_KEY")
-            maxGas = int(os.environ.get("MAX_GWEI"))
-            script = []
-            for i, action in enumerate(actions):
-                # script = script + [((action[2].loanToken, action[2].collateralToken, action[2].oracle, action[2].irm, action[2].lltv), math.floor(action[0]*pow(10,self.vault.assetDecimals)))]
-                script = script + [
-                    (
-                        action[2].toTuple(),
-                        math.floor(action[0] * pow(10, self.vault.assetDecimals)),
-                    )
-                ]
-            script = script + [(overflowMarket.params.toTuple(), OVERFLOW_AMOUNT)]
-            # print(script)
-            account = Account.from_key(privateKey)
-            account_address = account.address
-            # print(account_address)
-            tx = self.vault.contract.functions.reallocate(script).build_transaction(
-                {"from": account_address}
-            )
-            nonce = self.web3.eth.get_transaction_count(account.address)
-            tx["nonce"] = nonce
-            signed_transaction = account.sign_transaction(tx)
-            log(f"gas prices => {self.web3.eth.generate_gas_price()/pow(10,9):,.0f}")
-            if self.web3.eth.generate_gas_price() < Web3.to_wei(maxGas, "gwei"):
-                tx_hash = self.web3.eth.send_raw_transaction(
-                    signed_transaction.rawTransaction
-                )
-                log(f"Executed with hash => {tx_hash.hex()}")
-            else:
-                log(
-                    f"gas price too high => {self.web3.eth.generate_gas_price()/pow(10,9):,.0f}"
+        script = []
+        for i, action in enumerate(actions):
+            # script = script + [((action[2].loanToken, action[2].collateralToken, action[2].oracle, action[2].irm, action[2].lltv), math.floor(action[0]*pow(10,self.vault.assetDecimals)))]
+            script = script + [
+                (
+                    action[2].toTuple(),
+                    math.floor(action[0] * pow(10, self.vault.assetDecimals)),
                 )
+            ]
+        script = script + [(overflowMarket.params.toTuple(), OVERFLOW_AMOUNT)]
+        # print(script)
+        dryRun = self.check_reallocation(script)
+
+        if execute and not dryRun.ok:
+            log("Reallocation not executed, it would revert")
+        elif execute:
+            executeTransaction(
+                self.web3,
+                self.vault.contract.functions.reallocate(script),
+                f"{self.vault.symbol} reallocation",
+            )
 
         print()
 
@@ -733,7 +987,7 @@ class MorphoCli(cmd.Cmd):
                 )
                 return None
 
-        with ThreadPoolExecutor(
+        with ContextThreadPoolExecutor(
             max_workers=os.environ.get("MAX_WORKERS", 10)
         ) as executor:
             futures = {
@@ -777,7 +1031,7 @@ class MorphoCli(cmd.Cmd):
                 if to_add > 0:
                     return (target, to_add, m.marketParams())
 
-        with ThreadPoolExecutor(
+        with ContextThreadPoolExecutor(
             max_workers=os.environ.get("MAX_WORKERS", 10)
         ) as executor:
             futures = {
@@ -882,39 +1136,27 @@ class MorphoCli(cmd.Cmd):
 
         print(script)
 
-        if execute:
-            privateKey = os.environ.get("PRIVATE_KEY")
-            maxGas = int(os.environ.get("MAX_GWEI"))
-            script = []
-            for i, action in enumerate(actions):
-                # script = script + [((action[2].loanToken, action[2].collateralToken, action[2].oracle, action[2].irm, action[2].lltv), math.floor(action[0]*pow(10,self.vault.assetDecimals)))]
-                script = script + [
-                    (
-                        action[2].toTuple(),
-                        math.floor(action[0] * pow(10, self.vault.assetDecimals)),
-                    )
-                ]
-            script = script + [(overflowMarket.params.toTuple(), OVERFLOW_AMOUNT)]
-            # print(script)
-            account = Account.from_key(privateKey)
-            account_address = account.address
-            # print(account_address)
-            tx = self.vault.contract.functions.reallocate(script).build_transaction(
-                {"from": account_address}
-            )
-            nonce = self.web3.eth.get_transaction_count(account.address)
-            tx["nonce"] = nonce
-            signed_transaction = account.sign_transaction(tx)
-            log(f"gas prices => {self.web3.eth.generate_gas_price()/pow(10,9):,.0f}")
-            if self.web3.eth.generate_gas_price() < Web3.to_wei(maxGas, "gwei"):
-                tx_hash = self.web3.eth.send_raw_transaction(
-                    signed_transaction.rawTransaction
-                )
-                log(f"Executed with hash => {tx_hash.hex()}")
-            else:
-                log(
-                    f"gas price too high => {self.web3.eth.generate_gas_price()/pow(10,9):,.0f}"
+        script = []
+        for i, action in enumerate(actions):
+            # script = script + [((action[2].loanToken, action[2].collateralToken, action[2].oracle, action[2].irm, action[2].lltv), math.floor(action[0]*pow(10,self.vault.assetDecimals)))]
+            script = script + [
+                (
+                    action[2].toTuple(),
+                    math.floor(action[0] * pow(10, self.vault.assetDecimals)),
                 )
+            ]
+        script = script + [(overflowMarket.params.toTuple(), OVERFLOW_AMOUNT)]
+        # print(script)
+        dryRun = self.check_reallocation(script)
+
+        if execute and not dryRun.ok:
+            log("Reallocation not executed, it would revert")
+        elif execute:
+            executeTransaction(
+                self.web3,
+                self.vault.contract.functions.reallocate(script),
+                f"{self.vault.symbol} reallocation",
+            )
 
         print()
 
@@ -926,29 +1168,172 @@ class MorphoCli(cmd.Cmd):
         elif self.vault.symbol == "steakPYUSD":
             self.reallocation_pyusd(args == "execute")
 
+    def do_backtest(self, args):
+        """backtest [days=30] [step=3600] [every=24] [targets=0.04,0.047,0.055]
+        [overflow=<symbol>] [gas=<gwei>] [eth=<price>] - replay the vault markets
+        over the last days from the event archive, every step seconds, and compare
+        the realized APY, turnover and liquidity of the reallocation strategies run
+        every `every` steps (one rate target strategy per target borrow rate)
+        """
+        if self.vault is None:
+            print("First add a MetaMorpho vault")
+            return
+        options = dict(w.split("=", 1) for w in args.split() if "=" in w)
+        days = float(options.get("days", 30))
+        step = int(options.get("step", 3600))
+        every = int(options.get("every", 24))
+        targets = [
+            float(t) for t in options.get("targets", "0.04,0.047,0.055").split(",")
+        ]
+        overflow = options.get("overflow")
+        gasModel = GasModel(
+            gasPriceGwei=float(options.get("gas", GasModel.gasPriceGwei)),
+            nativePrice=float(options.get("eth", GasModel.nativePrice)),
+        )
+
+        start = time.time()
+        archive = event_archive(self.vault.blue)
+        archive.sync()
+        # The archive stops FINALITY_DEPTH blocks behind the head
+        head = archive.lastBlock or block_head(self.web3).number()
+        times = block_time(self.web3)
+        end = times.timestamp(head)
+        history = market_history(
+            archive,
+            times,
+            self.vault.address,
+            self.vault.markets,
+            int(end - days * 86400),
+            end,
+            step,
+        )
+        print(
+            f"{len(history.blocks)} steps of {len(history.markets)} markets "
+            f"loaded in {time.time() - start:.1f}s"
+        )
+
+        symbols = [
+            m.collateralTokenSymbol
+            for m in self.vault.markets
+            if m.collateralTokenSymbol != overflow
+        ]
+        strategies = {
+            "Equal yield": StrategyEqualYield(),
+            "Max yield": StrategyMaxYield(),
+        }
+        for target in targets:
+            rates = {symbol: target for symbol in symbols}
+            strategies[f"Rate target {target*100:.1f}%"] = StrategyRateTarget(
+                rates, rates, overflow
+            )
+        start = time.time()
+        reports = run_backtests(history, strategies, every, gasModel)
+
+        table = Texttable(max_width=0)
+        table.header(
+            ["Strategy", "APY", "Turnover", "Reallocations", "Gas", "Liquidity", "Min"]
+        )
+        table.set_cols_align(["l", "r", "r", "r", "r", "r", "r"])
+        table.set_deco(Texttable.HEADER)
+        for r in reports:
+            table.add_row(
+                [
+                    r.name,
+                    f"{r.apy*100:.2f}%",
+                    f"{r.turnover:.2f}",
+                    r.reallocations,
+                    f"{r.gasCost:,.0f}",
+                    f"{r.averageLiquidity:,.0f}",
+                    f"{r.minLiquidity:,.0f}",
+                ]
+            )
+        print(table.draw())
+        print(f"{len(strategies)} strategies run in {time.time() - start:.1f}s")
+
+    def do_simulate(self, args):
+        """simulate <marketId> <assets|max> ... - dry-run a reallocation locally,
+        assets are the target supply of the vault in each market in asset units
+        """
+        if self.vault is None:
+            print("First add a MetaMorpho vault")
+            return
+        words = args.split()
+        if not words or len(words) % 2:
+            print(
+                "Usage: simulate <marketId> <assets|max> [<marketId> <assets|max> ...]"
+            )
+            return
+        allocations = [
+            (
+                id,
+                MAX_UINT256
+                if assets == "max"
+                else int(float(assets) * self.vault.assetFactor),
+            )
+            for id, assets in zip(words[::2], words[1::2])
+        ]
+        print(simulate_reallocation(self.vault.snapshot(), allocations))
+
+    def runWorkflow(self, line):
+        """Run a command for the daemon, returns its output and RPC calls"""
+        command = line.split()[0]
+        calls = rpc_stats.calls(command)
+        with capture() as output:
+            self.onecmd(line)
+        return {
+            "output": output.getvalue(),
+            "rpcCalls": rpc_stats.calls(command) - calls,
+        }
+
+    def do_daemon(self, args):
+        """daemon [<command>@<blocks>;...] - run commands every few blocks from this
+        process until Ctrl-C, results are appended to DAEMON_RESULTS (JSON lines)
+        """
+        workflows = parse_schedule(
+            args or os.environ.get("DAEMON_SCHEDULE") or DEFAULT_SCHEDULE
+        )
+        # Markets are only read again when an event touches them
+        if self.vault is not None:
+            self.vault.watch()
+        scheduler = BlockScheduler(
+            block_head(self.web3), workflows, self.runWorkflow, log=log
+        )
+        log(
+            "Daemon started: "
+            + ", ".join(f"{w.line} every {w.every} blocks" for w in workflows)
+        )
+        scheduler.start()
+        scheduler.wait()
+
     def do_full(self, args):
-        # todo: print outs are async and cause confusion (obviously).  If this is important for speed we can make them vars and print at end in order (as a quick idea)
-        # tasks = [
-        #     (self.do_summary, ""),
-        #     (self.do_competition, ""),
-        #     (self.do_reallocation, "execute"),
-        #     (self.do_borrowers, ""),
-        # ]
-
-        # # Execute tasks in parallel
-        # with ThreadPoolExecutor() as executor:
-        #     # Executes the tasks [0] and gives the input [1]
-        #     futures = [executor.submit(task[0], task[1]) for task in tasks]
-        #     for future in futures:
-        #         future.result()  # This will re-raise any exceptions encountered in the task
-        self.do_summary("")
-        self.do_competition("")
-        self.do_reallocation("execute")
-        self.do_borrowers("")
+        """full - summary, competition, reallocation (execute) and borrowers run
+        concurrently at the same block, printed in this order
+        """
+        tasks = [
+            (self.do_summary, ("",)),
+            (self.do_competition, ("",)),
+            (self.do_reallocation, ("execute",)),
+            (self.do_borrowers, ("",)),
+        ]
+        with block_head(self.web3).pinned():
+            results = run_buffered(tasks)
+        for (fnct, _), (output, exc) in zip(tasks, results):
+            print(output, end="")
+            if exc is not None:
+                print(f"{fnct.__name__[3:]} failed: {exc}")
 
 
 if __name__ == "__main__":
+    # --profile profiles every command (see MORPHO_PROFILE)
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        os.environ["MORPHO_PROFILE"] = os.environ.get("MORPHO_PROFILE") or "1"
+    with profiled("init"):
+        cli = MorphoCli()
     if len(sys.argv) > 1:
-        MorphoCli().onecmd(" ".join(sys.argv[1:]))
+        cli.onecmd(" ".join(sys.argv[1:]))
+        # The receipt tracker is a daemon thread, confirm before exiting
+        if not wait_for_receipts():
+            log("Some transactions were not mined before the timeout")
     else:
-        MorphoCli().cmdloop()
+        cli.cmdloop()
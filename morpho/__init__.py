@@ -1,7 +1,14 @@
 from .morphoblue import MorphoBlue  # noqa: F401
 from .morphomarket import MorphoMarket, Position  # noqa: F401
+from .position_table import PositionTable  # noqa: F401
 from .metamorpho import MetaMorpho  # noqa: F401
 
 from .market_rewards import MORPHO_PRICE, MarketRewards, rewards_for_market
 
 from .reallocation_strategy import AllocationItem, Allocation, ReallocationStrategy
+
+from .reallocation_model import (  # noqa: F401
+    VaultSnapshot,
+    ReallocationResult,
+    simulate_reallocation,
+)
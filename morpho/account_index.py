@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+
+from utils.cache import cache_file_path
+from .blocks import block_head
+from .log_decoder import log_decoder
+from .log_scan import scan_logs
+from .morphoblue import DEPLOYMENT_BLOCK
+
+# Events touching a position, with the field holding the account
+ACCOUNT_FIELD = {
+    "Supply": "onBehalf",
+    "Withdraw": "onBehalf",
+    "Borrow": "onBehalf",
+    "Repay": "onBehalf",
+    "SupplyCollateral": "onBehalf",
+    "WithdrawCollateral": "onBehalf",
+    "Liquidate": "borrower",
+}
+
+
+class AccountIndex:
+    """Markets used by each account, from the Morpho Blue event log.
+
+    Maps every account (onBehalf, or the liquidated borrower) to the ids of the
+    markets it touched with the block of its last activity there. The index is
+    updated incrementally from the last indexed block with eth_getLogs over ranges
+    of LOGS_CHUNK blocks (halved when the node refuses a range) and saved
+    in the cache directory.
+    """
+
+    def __init__(self, blue, path=None):
+        self.blue = blue
+        self.web3 = blue.web3
+        self.path = path or cache_file_path("account_index.json")
+        self.chunk = int(os.environ.get("LOGS_CHUNK", 100000))
+        self.decoder = log_decoder()
+        self.topics = [self.decoder.topic(event) for event in ACCOUNT_FIELD]
+        self.lastBlock = None
+        self.accounts = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if data.get("blue", "").lower() == self.blue.address.lower():
+            self.lastBlock = data["lastBlock"]
+            self.accounts = data["accounts"]
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w") as file:
+            json.dump(
+                {
+                    "blue": self.blue.address,
+                    "lastBlock": self.lastBlock,
+                    "accounts": self.accounts,
+                },
+                file,
+            )
+
+    def ready(self) -> bool:
+        return self.lastBlock is not None
+
+    def add(self, logs):
+        """Index raw Morpho Blue logs"""
+        for event, decoded in self.decoder.decode(logs).items():
+            if event not in ACCOUNT_FIELD:
+                continue
+            for account, id, block in zip(
+                decoded.columns[ACCOUNT_FIELD[event]],
+                decoded.hex("id"),
+                decoded.blockNumber.tolist(),
+            ):
+                account = "0x" + account.ljust(20, b"\0").hex()
+                markets = self.accounts.setdefault(account, {})
+                markets[id] = max(markets.get(id, 0), block)
+
+    def update(self, toBlock=None, log=print) -> int:
+        """Index the events up to toBlock (the current block by default), returns
+        the number of events read
+        """
+        toBlock = toBlock if toBlock is not None else block_head(self.web3).number()
+        events = 0
+        with self._lock:
+            previous = self.lastBlock
+            start = (
+                self.lastBlock + 1
+                if self.lastBlock is not None
+                else int(os.environ.get("MORPHO_BLUE_START", DEPLOYMENT_BLOCK))
+            )
+            for end, logs in scan_logs(
+                self.web3,
+                self.blue.address,
+                [self.topics],
+                start,
+                toBlock,
+                self.chunk,
+                log,
+                raw=True,
+            ):
+                self.add(logs)
+                events += len(logs)
+                self.lastBlock = end
+            if self.lastBlock != previous:
+                self._save()
+        return events
+
+    def markets(self, address) -> dict[str, int]:
+        """{market id: block of the last activity} of an account"""
+        return dict(self.accounts.get(address.lower(), {}))
+
+
+_indexes = {}
+
+
+def account_index(blue) -> AccountIndex:
+    key = id(blue.web3)
+    if key not in _indexes:
+        _indexes[key] = AccountIndex(blue)
+    return _indexes[key]
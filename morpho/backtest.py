@@ -0,0 +1,370 @@
+"""Replay of vault reallocation strategies over the history of its markets.
+
+The supply, borrow, vault exposure and rate at target of every market of a vault
+are rebuilt from the event archive on a grid of blocks at a fixed time step, with
+cumulative sums over the archived events. A backtest then replays the vault
+flows (deposits and withdrawals) and interest on the allocation chosen by a
+strategy, every `every` steps, paying the gas of each reallocation.
+
+Approximations: the historical rate at target is kept whatever the counterfactual
+utilization (the adaptive IRM would have drifted), the current fee of each market
+is applied to the whole window (SetFee events aren't archived), supply caps and
+rewards (only used by the strategies) are ignored, flows are spread pro rata of
+the allocation.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import os
+
+import numpy as np
+
+from .event_archive import CODES
+from .market_rewards import rewards_for_market
+from .reallocation_strategy import Allocation, AllocationItem, ReallocationStrategy
+from .utils import CURVE_STEEPNESS, POW_10_18, TARGET_UTILIZATION
+
+YEAR = 365 * 24 * 3600
+
+
+def curve(utilization: np.ndarray) -> np.ndarray:
+    """Borrow rate over rate at target of the adaptive IRM, vectorized"""
+    above = utilization > TARGET_UTILIZATION
+    error = np.where(
+        above,
+        (utilization - TARGET_UTILIZATION) / (1 - TARGET_UTILIZATION),
+        (utilization - TARGET_UTILIZATION) / TARGET_UTILIZATION,
+    )
+    return np.where(
+        above,
+        1 + error * (CURVE_STEEPNESS - 1),
+        1 + error * (CURVE_STEEPNESS - 1) / CURVE_STEEPNESS,
+    )
+
+
+def supply_rates(supply, borrow, rateAtTarget, fee) -> np.ndarray:
+    """Supply APR of markets, fee as a fraction"""
+    utilization = np.divide(
+        borrow, supply, out=np.zeros_like(borrow, dtype=float), where=supply > 0
+    ).clip(0, 1)
+    return rateAtTarget * curve(utilization) * utilization * (1 - fee)
+
+
+@dataclass(frozen=True)
+class HistoricalMarket:
+    """Market of an AllocationItem during a backtest"""
+
+    id: str
+    collateralTokenSymbol: str
+
+
+@dataclass(frozen=True)
+class MarketHistory:
+    """States of the markets of a vault at each step, (steps, markets) arrays in
+    asset units, rateAtTarget as a borrow APR
+    """
+
+    markets: list[HistoricalMarket]
+    blocks: np.ndarray
+    timestamps: np.ndarray
+    supply: np.ndarray
+    borrow: np.ndarray
+    vaultSupply: np.ndarray
+    rateAtTarget: np.ndarray
+    fee: np.ndarray
+
+    @property
+    def otherSupply(self) -> np.ndarray:
+        """Supply of everyone but the vault"""
+        return self.supply - self.vaultSupply
+
+
+def _sample(blocks, values, grid, initial=0.0) -> np.ndarray:
+    """Values after the last row at or before each block of the grid"""
+    if len(values) == 0:
+        return np.full(len(grid), initial)
+    index = np.searchsorted(blocks, grid, side="right") - 1
+    return np.where(index >= 0, values[index.clip(0)], initial)
+
+
+def market_history(
+    archive, timeResolver, vault, markets, start, end, step=3600
+) -> MarketHistory:
+    """History of the markets (MorphoMarket) of a vault from timestamp start to end
+    every step seconds, from the event archive synced to end. The fee is the
+    current one of each market.
+    """
+    timestamps = np.arange(start, end + 1, step, dtype=np.int64)
+    grid = np.array(timeResolver.resolve(timestamps.tolist()), dtype=np.int64)
+    vaultIndex = archive.account(vault)
+    shape = (len(grid), len(markets))
+    supply = np.zeros(shape)
+    borrow = np.zeros(shape)
+    vaultSupply = np.zeros(shape)
+    rateAtTarget = np.zeros(shape)
+    fee = np.zeros(len(markets))
+
+    for j, market in enumerate(markets):
+        rows = archive.select(market=market.id, toBlock=int(grid[-1]))
+        events = archive.column("event")[rows]
+        blocks = archive.column("block")[rows]
+        amount0, amount1, amount2 = (archive.amount(i, rows) for i in range(3))
+
+        def signed(amount, signs):
+            result = np.zeros(len(rows))
+            for event, sign in signs.items():
+                result += np.where(events == CODES[event], sign * amount, 0)
+            return result
+
+        accrue = {"AccrueInterest": 1}
+        # Bad debt is removed from both the supply and the borrow assets
+        supplyDelta = signed(
+            amount0, {"Supply": 1, "Withdraw": -1, "BadDebt": -1, **accrue}
+        )
+        sharesDelta = signed(amount1, {"Supply": 1, "Withdraw": -1, **accrue})
+        borrowDelta = signed(
+            amount0,
+            {"Borrow": 1, "Repay": -1, "Liquidate": -1, "BadDebt": -1, **accrue},
+        )
+        vaultShares = np.where(
+            archive.column("account")[rows] == vaultIndex,
+            signed(amount1, {"Supply": 1, "Withdraw": -1}),
+            0,
+        )
+        totalSupply = np.cumsum(supplyDelta)
+        totalShares = np.cumsum(sharesDelta)
+        totalBorrow = np.cumsum(borrowDelta)
+        vaultAssets = np.divide(
+            np.cumsum(vaultShares) * totalSupply,
+            totalShares,
+            out=np.zeros(len(rows)),
+            where=totalShares > 0,
+        )
+
+        # Rate at target from the borrow rate of each accrual and the utilization
+        # before it
+        accruals = events == CODES["AccrueInterest"]
+        before = (
+            (totalBorrow - borrowDelta)[accruals],
+            (totalSupply - supplyDelta)[accruals],
+        )
+        utilization = np.divide(
+            before[0], before[1], out=np.zeros(len(before[0])), where=before[1] > 0
+        ).clip(0, 1)
+        targets = amount2[accruals] * YEAR / POW_10_18 / curve(utilization)
+
+        factor = market.loanTokenFactor
+        supply[:, j] = _sample(blocks, totalSupply, grid) / factor
+        borrow[:, j] = _sample(blocks, totalBorrow, grid) / factor
+        vaultSupply[:, j] = _sample(blocks, vaultAssets, grid) / factor
+        rateAtTarget[:, j] = _sample(blocks[accruals], targets, grid)
+        if not market.isIdleMarket():
+            fee[j] = market.marketData().fee / POW_10_18
+
+    return MarketHistory(
+        [HistoricalMarket(m.id, m.collateralTokenSymbol) for m in markets],
+        grid,
+        timestamps,
+        supply,
+        borrow,
+        vaultSupply,
+        rateAtTarget,
+        fee,
+    )
+
+
+@dataclass(frozen=True)
+class GasModel:
+    """Gas of a reallocate call and its cost in asset units"""
+
+    base: int = 100000
+    perMarket: int = 60000
+    gasPriceGwei: float = 20.0
+    nativePrice: float = 3000.0  # asset units per ETH
+
+    def cost(self, markets: int) -> float:
+        gas = self.base + self.perMarket * markets
+        return gas * self.gasPriceGwei / pow(10, 9) * self.nativePrice
+
+
+@dataclass(frozen=True)
+class BacktestReport:
+    name: str
+    apy: float
+    turnover: float
+    reallocations: int
+    gasCost: float
+    averageLiquidity: float
+    minLiquidity: float
+    values: np.ndarray
+
+
+def _report(name, history, exposures, growth, gas, moved, reallocations):
+    """Report of the exposures per step, growth and gas per step (the first one
+    excluded)
+    """
+    values = exposures.sum(axis=1)
+    previous = values[:-1]
+    returns = np.divide(
+        growth - gas, previous, out=np.zeros(len(previous)), where=previous > 0
+    )
+    elapsed = history.timestamps[-1] - history.timestamps[0]
+    apy = np.prod(1 + returns) ** (YEAR / elapsed) - 1 if elapsed else 0.0
+    supply = history.otherSupply + exposures
+    liquidity = np.minimum(exposures, (supply - history.borrow).clip(0)).sum(axis=1)
+    average = values.mean()
+    return BacktestReport(
+        name,
+        float(apy),
+        float(moved / average) if average else 0.0,
+        reallocations,
+        float(gas.sum()),
+        float(liquidity.mean()),
+        float(liquidity.min()),
+        values,
+    )
+
+
+def historical(history: MarketHistory) -> BacktestReport:
+    """Report of the allocation the vault actually had"""
+    exposures = history.vaultSupply
+    dt = np.diff(history.timestamps) / YEAR
+    rates = supply_rates(
+        history.supply, history.borrow, history.rateAtTarget, history.fee
+    )
+    growth = (exposures[:-1] * rates[:-1]).sum(axis=1) * dt
+    # Moves between markets, net of the vault flows
+    changes = np.diff(exposures, axis=0)
+    moved = (np.abs(changes).sum(axis=1) - np.abs(changes.sum(axis=1))) / 2
+    return _report(
+        "Historical",
+        history,
+        exposures,
+        growth,
+        np.zeros(len(growth)),
+        moved.sum(),
+        int((moved > 0).sum()),
+    )
+
+
+def _target(history, strategy, i, exposures) -> np.ndarray:
+    """Exposures chosen by the strategy at step i"""
+    supply = history.otherSupply[i] + exposures
+    liquidity = (supply - history.borrow[i]).clip(0)
+    # Strategies divide by the supply left once the vault liquidity is removed
+    active = [
+        j
+        for j in range(len(exposures))
+        if supply[j] - min(exposures[j], liquidity[j]) > 0
+    ]
+    if not active:
+        return exposures
+    allocation = Allocation(
+        [
+            AllocationItem(
+                history.markets[j],
+                rewards_for_market(history.markets[j].id),
+                exposures[j],
+                supply[j],
+                history.borrow[i, j],
+                history.rateAtTarget[i, j],
+            )
+            for j in active
+        ]
+    )
+    target = exposures.copy()
+    for j, item in zip(active, strategy.reallocate(allocation).items):
+        target[j] = max(item.exposure, 0.0)
+
+    # Withdraw at most the liquidity of each market, supply what was withdrawn
+    target = np.maximum(target, exposures - liquidity)
+    withdrawn = (exposures - target).clip(0)
+    supplied = (target - exposures).clip(0)
+    if supplied.sum() > 0:
+        target = exposures - withdrawn + supplied * withdrawn.sum() / supplied.sum()
+    else:
+        target = exposures
+    return target
+
+
+def backtest(
+    name,
+    history: MarketHistory,
+    strategy: ReallocationStrategy,
+    every=24,
+    gasModel=GasModel(),
+    threshold=0.0,
+) -> BacktestReport:
+    """Replay the vault with the allocation of strategy, reallocated every `every`
+    steps when more than threshold assets move
+    """
+    steps, count = history.supply.shape
+    exposures = np.zeros((steps, count))
+    x = history.vaultSupply[0].copy()
+    exposures[0] = x
+    growth = np.zeros(steps - 1)
+    gas = np.zeros(steps - 1)
+    moved = 0.0
+    reallocations = 0
+
+    dt = np.diff(history.timestamps) / YEAR
+    rates = supply_rates(
+        history.supply, history.borrow, history.rateAtTarget, history.fee
+    )
+    historicalValues = history.vaultSupply.sum(axis=1)
+    historicalGrowth = (history.vaultSupply[:-1] * rates[:-1]).sum(axis=1) * dt
+    flows = np.diff(historicalValues) - historicalGrowth
+
+    for i in range(1, steps):
+        rate = supply_rates(
+            history.otherSupply[i - 1] + x,
+            history.borrow[i - 1],
+            history.rateAtTarget[i - 1],
+            history.fee,
+        )
+        interest = x * rate * dt[i - 1]
+        growth[i - 1] = interest.sum()
+        x = x + interest
+        total = x.sum()
+        if total > 0:
+            x = (x + flows[i - 1] * x / total).clip(0)
+        elif flows[i - 1] > 0:
+            x = np.full(count, flows[i - 1] / count)
+
+        if i % every == 0:
+            target = _target(history, strategy, i, x)
+            change = (x - target).clip(0)
+            if change.sum() > threshold and change.sum() > 0:
+                cost = gasModel.cost(int((np.abs(target - x) > 0).sum()))
+                gas[i - 1] = cost
+                moved += change.sum()
+                reallocations += 1
+                x = target * max(1 - cost / target.sum(), 0)
+        exposures[i] = x
+
+    return _report(name, history, exposures, growth, gas, moved, reallocations)
+
+
+def _run(args):
+    return backtest(*args)
+
+
+def run_backtests(
+    history: MarketHistory, strategies: dict, every=24, gasModel=GasModel()
+) -> list[BacktestReport]:
+    """Historical report then the backtest of each {name: strategy}, run in a
+    process pool
+    """
+    with ProcessPoolExecutor(
+        max_workers=int(os.environ.get("MAX_WORKERS", 10))
+    ) as executor:
+        reports = list(
+            executor.map(
+                _run,
+                [
+                    (name, history, strategy, every, gasModel)
+                    for name, strategy in strategies.items()
+                ],
+            )
+        )
+    return [historical(history)] + reports
@@ -0,0 +1,164 @@
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+
+from utils.cache import cache_file_path
+from .blocks import block_head
+
+# Samples closer to the head may be reorged, they are not saved
+FINALITY_DEPTH = 64
+
+
+class BlockTime:
+    """Timestamp to block resolution over a cache of (block, timestamp) samples.
+
+    The block of a timestamp is searched between the two nearest samples, probing
+    the block interpolated from their timestamps (a bisection when the last probe
+    didn't halve the range), so with regular block times most lookups need one or
+    two eth_getBlockByNumber. Every probe becomes a sample, saved in the cache
+    directory unless within FINALITY_DEPTH blocks of the head. resolve() searches
+    many timestamps at once, the probes of each round fetched concurrently.
+    """
+
+    def __init__(self, web3, path=None):
+        self.web3 = web3
+        self.path = path or cache_file_path("block_times.json")
+        self.blocks = []
+        self.timestamps = []
+        self._saved = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                samples = json.load(file)["samples"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return
+        for block, timestamp in sorted(samples):
+            self.blocks.append(block)
+            self.timestamps.append(timestamp)
+        self._saved = len(samples)
+
+    def _save(self, head):
+        with self._lock:
+            samples = [
+                [b, t]
+                for b, t in zip(self.blocks, self.timestamps)
+                if b <= head - FINALITY_DEPTH
+            ]
+        if len(samples) == self._saved:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as file:
+            json.dump({"samples": samples}, file)
+        os.replace(self.path + ".tmp", self.path)
+        self._saved = len(samples)
+
+    def _add(self, block, timestamp):
+        with self._lock:
+            i = bisect_left(self.blocks, block)
+            if i < len(self.blocks) and self.blocks[i] == block:
+                self.timestamps[i] = timestamp
+            else:
+                self.blocks.insert(i, block)
+                self.timestamps.insert(i, timestamp)
+
+    def _fetch(self, blocks):
+        """Fetch and add the timestamps of blocks, concurrently"""
+        blocks = sorted(set(blocks))
+        if len(blocks) == 1:
+            timestamps = [self.web3.eth.get_block(blocks[0])["timestamp"]]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=os.environ.get("MAX_WORKERS", 10)
+            ) as executor:
+                timestamps = list(
+                    executor.map(
+                        lambda b: self.web3.eth.get_block(b)["timestamp"], blocks
+                    )
+                )
+        for block, timestamp in zip(blocks, timestamps):
+            self._add(block, timestamp)
+
+    def timestamp(self, block) -> int:
+        with self._lock:
+            i = bisect_left(self.blocks, block)
+            if i < len(self.blocks) and self.blocks[i] == block:
+                return self.timestamps[i]
+        self._fetch([block])
+        return self.timestamp(block)
+
+    def _bracket(self, timestamp):
+        """Nearest (block, timestamp) samples lo and hi with lo timestamp <
+        timestamp <= hi timestamp, None on a side without sample
+        """
+        with self._lock:
+            i = bisect_left(self.timestamps, timestamp)
+            lo = (self.blocks[i - 1], self.timestamps[i - 1]) if i > 0 else None
+            hi = (self.blocks[i], self.timestamps[i]) if i < len(self.blocks) else None
+        return lo, hi
+
+    def block(self, timestamp) -> int:
+        """First block at or after timestamp"""
+        return self.resolve([timestamp])[0]
+
+    def resolve(self, timestamps) -> list[int]:
+        """First block at or after each timestamp, the head for the timestamps
+        after it and the genesis block for the ones before it
+        """
+        head = block_head(self.web3).number()
+        # The head (whose timestamp changes with it) is only needed as upper bound
+        if any(self._bracket(t)[1] is None for t in timestamps):
+            self.timestamp(head)
+        if any(self._bracket(t)[0] is None for t in timestamps):
+            self.timestamp(0)
+
+        result = {}
+        widths = {}
+        pending = sorted(set(timestamps))
+        while pending:
+            probes = set()
+            unresolved = []
+            for t in pending:
+                lo, hi = self._bracket(t)
+                if hi is None or hi[0] > head:
+                    hi = (head, self.timestamp(head))
+                    if t > hi[1]:
+                        result[t] = head
+                        continue
+                if lo is None:
+                    result[t] = hi[0]
+                    continue
+                (lo, tlo), (hi, thi) = lo, hi
+                if hi - lo <= 1:
+                    result[t] = hi
+                    continue
+                width = hi - lo
+                widths[t], previous = width, widths.get(t, 2 * width + 1)
+                if width * 2 > previous:
+                    probes.add((lo + hi) // 2)
+                else:
+                    # The interpolated block and its parent, which end the search
+                    # when the interpolation is exact
+                    probe = lo + round((t - tlo) * width / (thi - tlo))
+                    probe = min(max(probe, lo + 1), hi - 1)
+                    probes.update((probe, max(probe - 1, lo + 1)))
+                unresolved.append(t)
+            if probes:
+                self._fetch(probes)
+            pending = unresolved
+        self._save(head)
+        return [result[t] for t in timestamps]
+
+
+_blockTimes = {}
+
+
+def block_time(web3) -> BlockTime:
+    key = id(web3)
+    if key not in _blockTimes:
+        _blockTimes[key] = BlockTime(web3)
+    return _blockTimes[key]
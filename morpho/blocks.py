@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+import time
+
+# Block tags accepted by BLOCK_TAG, any other value is a pinned block number
+BLOCK_TAGS = ("latest", "safe", "finalized")
+
+
+class BlockHead:
+    """Block number the block keyed caches read at, shared by the whole process.
+
+    The freshness policy (BLOCK_TAG) is one of latest, safe, finalized or a pinned
+    block number. Without a running notifier the node is asked at most once per poll
+    interval (BLOCK_POLL_INTERVAL seconds) whatever the number of readers. Once
+    start() is called a background thread follows new heads and number() doesn't
+    make any RPC. Subscribers are called with each new block number. pinned() only
+    pins the current context (and the thread pools started with it, see
+    ContextThreadPoolExecutor), concurrent commands keep their own block.
+    """
+
+    def __init__(self, web3, interval=None, policy=None):
+        self.web3 = web3
+        self.interval = float(
+            interval
+            if interval is not None
+            else os.environ.get("BLOCK_POLL_INTERVAL", 1)
+        )
+        self._lock = threading.Lock()
+        self._fetchLock = threading.Lock()
+        self._number = None
+        self._checked = 0.0
+        self._pinned = None
+        self._contextPin = ContextVar(f"pinned_block_{id(self)}", default=None)
+        self._subscribers = []
+        self._notifier = None
+        self._stop = threading.Event()
+        self.setPolicy(policy or os.environ.get("BLOCK_TAG") or "latest")
+
+    def setPolicy(self, policy):
+        policy = str(policy).lower()
+        if policy in BLOCK_TAGS:
+            self.policy = policy
+            self._pinned = None
+        elif policy.isdigit():
+            self.policy = "pinned"
+            self._pinned = int(policy)
+        else:
+            raise ValueError(
+                f"Invalid block policy {policy}, expected one of "
+                f"{', '.join(BLOCK_TAGS)} or a block number"
+            )
+        with self._lock:
+            self._number = None
+
+    def _fetch(self) -> int:
+        if self.policy == "latest":
+            return self.web3.eth.block_number
+        return self.web3.eth.get_block(self.policy).number
+
+    def _update(self, number):
+        with self._lock:
+            changed = number != self._number
+            self._number = number
+            self._checked = time.time()
+            subscribers = list(self._subscribers) if changed else []
+        for callback in subscribers:
+            callback(number)
+
+    def number(self) -> int:
+        pinned = self._contextPin.get()
+        if pinned is not None:
+            return pinned
+        if self._pinned is not None:
+            return self._pinned
+        if self._fresh():
+            return self._number
+        # A single reader asks the node, the concurrent ones wait for its answer
+        with self._fetchLock:
+            if not self._fresh():
+                self._update(self._fetch())
+        return self._number
+
+    def _fresh(self) -> bool:
+        with self._lock:
+            return self._number is not None and (
+                self.running or time.time() < self._checked + self.interval
+            )
+
+    def subscribe(self, callback):
+        """Call callback(blockNumber) on every new block"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    @property
+    def running(self) -> bool:
+        return self._notifier is not None and self._notifier.is_alive()
+
+    def start(self):
+        """Follow new heads in a background thread"""
+        if self.running or self.policy == "pinned":
+            return
+        self._stop.clear()
+        self._update(self._fetch())
+        self._notifier = threading.Thread(target=self._follow, daemon=True)
+        self._notifier.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _follow(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._update(self._fetch())
+            except Exception as exc:
+                print(f"Block head update failed: {exc}")
+
+    @contextmanager
+    def pinned(self, number=None):
+        """Read every cache at the same block (the current one by default) in this
+        context
+        """
+        number = number if number is not None else self.number()
+        token = self._contextPin.set(number)
+        try:
+            yield number
+        finally:
+            self._contextPin.reset(token)
+
+
+_heads = {}
+
+
+def block_head(web3) -> BlockHead:
+    key = id(web3)
+    if key not in _heads:
+        _heads[key] = BlockHead(web3)
+    return _heads[key]
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from .blocks import block_head
+from .codec import checksum, decode_position, encode_position
+from .multicall import multicall
+
+
+def raw_positions(blue, pairs, block="latest"):
+    """Raw Morpho Blue (supplyShares, borrowShares, collateral) of the (market id,
+    address) pairs, aggregated in multicalls
+    """
+    results = multicall(blue.web3).call(
+        [(blue.address, encode_position(id, address)) for id, address in pairs],
+        block,
+    )
+    return [
+        decode_position(data) if success else (0, 0, 0) for success, data in results
+    ]
+
+
+def bulk_positions(web3, markets, addresses, batchSize=None, empty=False, index=None):
+    """Yield (market, PositionTable) of the addresses in every market, one batch of
+    addresses at a time in the order of the addresses.
+
+    Every batch is read in one multicall (split by MULTICALL_BATCH) at the same
+    block, positions are converted locally at the block timestamp. Addresses without
+    any supply, borrow or collateral in a market are left out unless empty is set.
+    With an AccountIndex only the markets each address has used are read.
+    """
+    markets = list(markets)
+    addresses = [checksum(a) for a in addresses]
+    batchSize = int(batchSize or os.environ.get("POSITIONS_BATCH", 200))
+    if not markets:
+        return
+    head = block_head(web3)
+    # The block is passed to the workers rather than pinned around the yields
+    block = head.number()
+    timestamp = web3.eth.get_block(block)["timestamp"]
+
+    def used(address):
+        if index is None:
+            return markets
+        ids = index.markets(address)
+        return [m for m in markets if m.id.lower() in ids]
+
+    def state(market):
+        with head.pinned(block):
+            return market.marketState()
+
+    def fetch(batch):
+        pairs = [(m, a) for a in batch for m in used(a)]
+        raws = raw_positions(markets[0].blue, [(m.id, a) for m, a in pairs], block)
+        kept = {m.id: [] for m in markets}
+        for (market, address), raw in zip(pairs, raws):
+            if empty or any(raw):
+                kept[market.id].append((address, raw))
+        # Market states read at the block too
+        with head.pinned(block):
+            return [
+                (
+                    m,
+                    m.positionTable(
+                        [a for a, _ in kept[m.id]],
+                        [r for _, r in kept[m.id]],
+                        timestamp,
+                    ),
+                )
+                for m in markets
+            ]
+
+    batches = [
+        addresses[i : i + batchSize] for i in range(0, len(addresses), batchSize)
+    ]
+    with ThreadPoolExecutor(max_workers=os.environ.get("MAX_WORKERS", 10)) as executor:
+        # Read each market state once before the batches need it
+        list(executor.map(state, markets))
+        for tables in executor.map(fetch, batches):
+            yield from tables
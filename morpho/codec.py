@@ -0,0 +1,132 @@
+"""Fast path for the hot Morpho Blue and reader calls.
+
+The calls are encoded with precomputed selectors, decoded as fixed size uint words
+and sent as raw eth_call requests to the provider, only through the rpc_stats
+middleware and the middlewares of the provider itself (the HTTPProvider retries).
+This skips the function lookup, argument normalization, request formatting
+middlewares and generic ABI decoding of web3 contract calls. Reverts raise
+ContractLogicError as with web3.
+"""
+
+from functools import lru_cache
+
+from eth_utils import function_signature_to_4byte_selector
+from web3 import Web3
+from web3._utils.method_formatters import raise_contract_logic_error_on_revert
+from web3.manager import RequestManager
+from web3.middleware import combine_middlewares
+
+GET_POSITION = function_signature_to_4byte_selector("getPosition(bytes32,address)")
+GET_MARKET_DATA = function_signature_to_4byte_selector("getMarketData(bytes32)")
+MARKET = function_signature_to_4byte_selector("market(bytes32)")
+POSITION = function_signature_to_4byte_selector("position(bytes32,address)")
+
+
+@lru_cache(maxsize=None)
+def checksum(address: str) -> str:
+    """Memoized Web3.to_checksum_address, a keccak per new address only"""
+    return Web3.to_checksum_address(address)
+
+
+@lru_cache(maxsize=None)
+def encode_id(id: str) -> bytes:
+    return bytes.fromhex(id[2:] if id.startswith("0x") else id).rjust(32, b"\0")
+
+
+def encode_address(address: str) -> bytes:
+    return bytes(12) + bytes.fromhex(address[2:])
+
+
+def decode_uints(data: bytes, count: int) -> tuple[int, ...]:
+    """The first count uint words of a static ABI result"""
+    if len(data) < 32 * count:
+        raise Exception(f"Expected {count} words, got {len(data)} bytes")
+    return tuple(
+        int.from_bytes(data[i : i + 32], "big") for i in range(0, 32 * count, 32)
+    )
+
+
+def _block(block):
+    if isinstance(block, int):
+        return hex(block)
+    return block or "latest"
+
+
+# id(web3) -> (web3, request function, provider), web3 is kept so its id isn't reused
+_requests = {}
+
+
+def _request(web3):
+    """make_request of the provider wrapped by its own middlewares (retries) and
+    the rpc_stats middleware if any, built again when the provider changes
+    """
+    entry = _requests.get(id(web3))
+    if entry is None or entry[0] is not web3 or entry[2] is not web3.provider:
+        outer = []
+        if "rpc_stats" in web3.middleware_onion:
+            outer.append(web3.middleware_onion.get("rpc_stats"))
+        request = combine_middlewares(
+            outer + list(web3.provider.middlewares), web3, web3.provider.make_request
+        )
+        entry = _requests[id(web3)] = (web3, request, web3.provider)
+    return entry[1]
+
+
+def eth_call(web3, to: str, data: bytes, block="latest") -> bytes:
+    """Raw eth_call, returns the result bytes"""
+    params = [{"to": to, "data": "0x" + data.hex()}, _block(block)]
+    response = _request(web3)("eth_call", params)
+    result = RequestManager.formatted_response(
+        response, params, raise_contract_logic_error_on_revert
+    )
+    return bytes.fromhex(result[2:] if isinstance(result, str) else result.hex())
+
+
+def get_logs(web3, filter) -> list[dict]:
+    """Raw eth_getLogs, logs as JSON-RPC dicts of hex strings (see log_decoder)"""
+    params = [
+        {
+            **filter,
+            **{
+                key: _block(filter[key])
+                for key in ("fromBlock", "toBlock")
+                if key in filter
+            },
+        }
+    ]
+    response = _request(web3)("eth_getLogs", params)
+    return RequestManager.formatted_response(response, params)
+
+
+def get_position(web3, reader, id, address, block="latest") -> tuple[int, ...]:
+    """Reader getPosition: (suppliedShares, suppliedAssets, borrowedShares,
+    borrowedAssets, collateral, collateralValue, ltv, healthFactor)
+    """
+    data = GET_POSITION + encode_id(id) + encode_address(address)
+    return decode_uints(eth_call(web3, reader, data, block), 8)
+
+
+def get_market_data(web3, reader, id, block="latest") -> tuple[int, ...]:
+    """Reader getMarketData: (totalSupplyAssets, totalSupplyShares,
+    totalBorrowAssets, totalBorrowShares, fee, utilization, supplyRate, borrowRate)
+    """
+    return decode_uints(
+        eth_call(web3, reader, GET_MARKET_DATA + encode_id(id), block), 8
+    )
+
+
+def market(web3, blue, id, block="latest") -> tuple[int, ...]:
+    """Morpho Blue market: (totalSupplyAssets, totalSupplyShares,
+    totalBorrowAssets, totalBorrowShares, lastUpdate, fee)
+    """
+    return decode_uints(eth_call(web3, blue, MARKET + encode_id(id), block), 6)
+
+
+def encode_position(id, address) -> bytes:
+    """Calldata of Morpho Blue position(id, address)"""
+    return POSITION + encode_id(id) + encode_address(address)
+
+
+def decode_position(data: bytes) -> tuple[int, int, int]:
+    """(supplyShares, borrowShares, collateral) of Morpho Blue position"""
+    return decode_uints(data, 3)
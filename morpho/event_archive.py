@@ -0,0 +1,330 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils.cache import cache_file_path
+from .block_time import FINALITY_DEPTH
+from .blocks import block_head
+from .log_decoder import log_decoder
+from .log_scan import scan_logs
+from .morphoblue import DEPLOYMENT_BLOCK
+
+# Archived events: code -> (event, account field, amount0, amount1, amount2)
+EVENTS = (
+    ("Supply", "onBehalf", "assets", "shares", None),
+    ("Withdraw", "onBehalf", "assets", "shares", None),
+    ("Borrow", "onBehalf", "assets", "shares", None),
+    ("Repay", "onBehalf", "assets", "shares", None),
+    ("SupplyCollateral", "onBehalf", "assets", None, None),
+    ("WithdrawCollateral", "onBehalf", "assets", None, None),
+    ("Liquidate", "borrower", "repaidAssets", "repaidShares", "seizedAssets"),
+    ("AccrueInterest", None, "interest", "feeShares", "prevBorrowRate"),
+    ("BadDebt", "borrower", "badDebtAssets", "badDebtShares", None),
+)
+CODES = {event[0]: code for code, event in enumerate(EVENTS)}
+# Rows archived from the logs of another event, only when an amount isn't zero
+SOURCES = {"BadDebt": "Liquidate"}
+# Archives of another layout are archived again from the start
+VERSION = 2
+
+# Fixed width columns, uint128 amounts as high and low uint64
+COLUMNS = {
+    "block": np.int64,
+    "logIndex": np.uint32,
+    "event": np.uint8,
+    "market": np.uint16,
+    "account": np.uint32,
+    "amount0Hi": np.uint64,
+    "amount0Lo": np.uint64,
+    "amount1Hi": np.uint64,
+    "amount1Lo": np.uint64,
+    "amount2Hi": np.uint64,
+    "amount2Lo": np.uint64,
+}
+# Account index of the events without an account (AccrueInterest)
+NO_ACCOUNT = np.iinfo(np.uint32).max
+
+
+class EventArchive:
+    """Append-only columnar archive of the Morpho Blue events.
+
+    Every column is a file of fixed width values in the archive directory, read as
+    memory mapped NumPy arrays, so scans cost neither parsing nor RAM. Markets and
+    accounts are stored as indexes in the market ids of the header and in
+    accounts.bin (20 bytes per address). The header (archive.json) holds the number
+    of rows, the last block archived and the count and block range of each market;
+    rows past the count (an interrupted append) are ignored and overwritten. The
+    bad debt of a liquidation is a BadDebt row after its Liquidate row. Only blocks
+    FINALITY_DEPTH behind the head are archived, so no reorged event is kept.
+    """
+
+    def __init__(self, blue, directory=None):
+        self.blue = blue
+        self.web3 = blue.web3
+        self.directory = directory or cache_file_path("events")
+        self.chunk = int(os.environ.get("LOGS_CHUNK", 100000))
+        self.decoder = log_decoder()
+        self.topics = [
+            self.decoder.topic(event[0]) for event in EVENTS if event[0] not in SOURCES
+        ]
+        self.count = 0
+        self.lastBlock = None
+        self.markets = []
+        self.marketStats = []
+        self.accounts = []
+        self._marketIndex = {}
+        self._accountIndex = {}
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        try:
+            with open(self._path("archive.json")) as file:
+                header = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if header.get("blue", "").lower() != self.blue.address.lower():
+            raise Exception(
+                f"Event archive {self.directory} is for Morpho Blue {header.get('blue')}"
+            )
+        if header.get("version", 1) != VERSION:
+            return
+        self.count = header["count"]
+        self.lastBlock = header["lastBlock"]
+        self.markets = header["markets"]
+        self.marketStats = header["marketStats"]
+        self._marketIndex = {id: i for i, id in enumerate(self.markets)}
+        raw = np.fromfile(self._path("accounts.bin"), dtype="S20")
+        self.accounts = raw[: header["accounts"]].tolist()
+        self._accountIndex = {a: i for i, a in enumerate(self.accounts)}
+
+    def _saveHeader(self):
+        path = self._path("archive.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(
+                {
+                    "blue": self.blue.address,
+                    "version": VERSION,
+                    "count": self.count,
+                    "lastBlock": self.lastBlock,
+                    "accounts": len(self.accounts),
+                    "markets": self.markets,
+                    "marketStats": self.marketStats,
+                },
+                file,
+            )
+        os.replace(path + ".tmp", path)
+
+    def _index(self, values, index, items, key=lambda value: value):
+        """Indexes of the key of values, new ones appended to items"""
+        unique, inverse = np.unique(values, return_inverse=True)
+        positions = np.empty(len(unique), dtype=np.uint32)
+        for i, value in enumerate(map(key, unique.tolist())):
+            position = index.get(value)
+            if position is None:
+                position = index[value] = len(items)
+                items.append(value)
+            positions[i] = position
+        return positions[inverse]
+
+    def append(self, decoded):
+        """Append the DecodedLogs (by event) of a range of blocks, in block order"""
+        parts = []
+        known = len(self.accounts)
+        for code, (event, accountField, *amounts) in enumerate(EVENTS):
+            logs = decoded.get(SOURCES.get(event, event))
+            if logs is None or not len(logs):
+                continue
+            n = len(logs)
+            part = {
+                "block": logs.blockNumber,
+                "logIndex": logs.logIndex.astype(np.uint32),
+                "event": np.full(n, code, dtype=np.uint8),
+                "market": self._index(
+                    logs.columns["id"],
+                    self._marketIndex,
+                    self.markets,
+                    lambda id: "0x" + id.ljust(32, b"\0").hex(),
+                ).astype(np.uint16),
+                "account": (
+                    self._index(
+                        logs.columns[accountField],
+                        self._accountIndex,
+                        self.accounts,
+                    )
+                    if accountField
+                    else np.full(n, NO_ACCOUNT, dtype=np.uint32)
+                ),
+            }
+            for i, field in enumerate(amounts):
+                limbs = logs.columns[field] if field else np.zeros((n, 4), np.uint64)
+                part[f"amount{i}Hi"] = limbs[:, 2]
+                part[f"amount{i}Lo"] = limbs[:, 3]
+            if event in SOURCES:
+                keep = np.zeros(n, dtype=bool)
+                for i in range(3):
+                    keep |= (part[f"amount{i}Hi"] | part[f"amount{i}Lo"]) != 0
+                if not keep.any():
+                    continue
+                part = {column: values[keep] for column, values in part.items()}
+            parts.append(part)
+        if not parts:
+            return 0
+        rows = {c: np.concatenate([p[c] for p in parts]) for c in COLUMNS}
+        order = np.lexsort((rows["logIndex"], rows["block"]))
+
+        os.makedirs(self.directory, exist_ok=True)
+        for column, dtype in COLUMNS.items():
+            with open(self._path(f"{column}.bin"), "r+b" if self.count else "wb") as f:
+                f.seek(self.count * np.dtype(dtype).itemsize)
+                f.write(rows[column][order].astype(dtype).tobytes())
+                f.truncate()
+        with open(self._path("accounts.bin"), "r+b" if known else "wb") as file:
+            file.seek(known * 20)
+            file.write(np.array(self.accounts[known:], dtype="S20").tobytes())
+            file.truncate()
+
+        markets = rows["market"]
+        blocks = rows["block"]
+        while len(self.marketStats) < len(self.markets):
+            self.marketStats.append({"count": 0, "firstBlock": None, "lastBlock": None})
+        for market in np.unique(markets).tolist():
+            selected = blocks[markets == market]
+            stats = self.marketStats[market]
+            stats["count"] += len(selected)
+            if stats["firstBlock"] is None:
+                stats["firstBlock"] = int(selected.min())
+            stats["lastBlock"] = int(selected.max())
+        self.count += len(order)
+        self._maps = {}
+        return len(order)
+
+    def sync(self, toBlock=None, log=print) -> int:
+        """Archive the events up to toBlock, at most FINALITY_DEPTH blocks behind the
+        current block, returns the number of new events
+        """
+        final = block_head(self.web3).number() - FINALITY_DEPTH
+        toBlock = min(toBlock, final) if toBlock is not None else final
+        added = 0
+        with self._lock:
+            start = (
+                self.lastBlock + 1
+                if self.lastBlock is not None
+                else int(os.environ.get("MORPHO_BLUE_START", DEPLOYMENT_BLOCK))
+            )
+            for end, logs in scan_logs(
+                self.web3,
+                self.blue.address,
+                [self.topics],
+                start,
+                toBlock,
+                self.chunk,
+                log,
+                raw=True,
+            ):
+                added += self.append(self.decoder.decode(logs))
+                self.lastBlock = end
+                os.makedirs(self.directory, exist_ok=True)
+                self._saveHeader()
+        return added
+
+    def column(self, name) -> np.ndarray:
+        """Memory mapped column, read only"""
+        if name not in self._maps:
+            if self.count == 0:
+                return np.empty(0, dtype=COLUMNS[name])
+            self._maps[name] = np.memmap(
+                self._path(f"{name}.bin"),
+                dtype=COLUMNS[name],
+                mode="r",
+                shape=(self.count,),
+            )
+        return self._maps[name]
+
+    def amount(self, index, rows=slice(None)) -> np.ndarray:
+        """amount0, 1 or 2 of the rows as floats"""
+        return self.column(f"amount{index}Hi")[rows] * 2.0**64 + self.column(
+            f"amount{index}Lo"
+        )[rows].astype(float)
+
+    def account(self, address) -> int | None:
+        """Index of an account in the account column, None if never seen"""
+        return self._accountIndex.get(bytes.fromhex(address[2:]).rstrip(b"\0"))
+
+    def select(self, event=None, market=None, fromBlock=None, toBlock=None):
+        """Row numbers of the events matching every given criterion"""
+        mask = np.ones(self.count, dtype=bool)
+        if event is not None:
+            mask &= self.column("event") == CODES[event]
+        if market is not None:
+            index = self._marketIndex.get(market.lower())
+            if index is None:
+                return np.empty(0, dtype=np.int64)
+            mask &= self.column("market") == index
+        if fromBlock is not None or toBlock is not None:
+            # Rows are in block order
+            blocks = self.column("block")
+            start = np.searchsorted(blocks, fromBlock or 0, side="left")
+            end = np.searchsorted(
+                blocks, toBlock if toBlock is not None else blocks[-1], side="right"
+            )
+            mask[:start] = False
+            mask[end:] = False
+        return np.flatnonzero(mask)
+
+    def positions(self, market, toBlock=None):
+        """(accounts, borrowShares, collateral) of the market rebuilt from the
+        events up to toBlock, as floats in raw token units
+        """
+        rows = self.select(market=market, toBlock=toBlock)
+        events = self.column("event")[rows]
+        accounts = self.column("account")[rows]
+        sign = {
+            "Borrow": (1, 0),
+            "Repay": (-1, 0),
+            "SupplyCollateral": (0, 1),
+            "WithdrawCollateral": (0, -1),
+            "Liquidate": (-1, -1),
+            "BadDebt": (-1, 0),
+        }
+        shareSign = np.zeros(len(EVENTS))
+        collateralSign = np.zeros(len(EVENTS))
+        for event, (shares, collateral) in sign.items():
+            shareSign[CODES[event]] = shares
+            collateralSign[CODES[event]] = collateral
+        # Collateral moves in amount0, except seizedAssets (amount2) of Liquidate
+        collateralAmount = np.where(
+            events == CODES["Liquidate"], self.amount(2, rows), self.amount(0, rows)
+        )
+        touched = accounts != NO_ACCOUNT
+        used, inverse = np.unique(accounts[touched], return_inverse=True)
+        borrowShares = np.bincount(
+            inverse,
+            weights=(shareSign[events] * self.amount(1, rows))[touched],
+            minlength=len(used),
+        )
+        collateral = np.bincount(
+            inverse,
+            weights=(collateralSign[events] * collateralAmount)[touched],
+            minlength=len(used),
+        )
+        addresses = [
+            "0x" + self.accounts[i].ljust(20, b"\0").hex() for i in used.tolist()
+        ]
+        return addresses, borrowShares, collateral
+
+
+_archives = {}
+
+
+def event_archive(blue) -> EventArchive:
+    key = id(blue.web3)
+    if key not in _archives:
+        _archives[key] = EventArchive(blue)
+    return _archives[key]
@@ -0,0 +1,125 @@
+from dataclasses import dataclass
+import os
+
+import numpy as np
+
+from .morphomarket import MorphoMarket, Position
+
+# Morpho Blue liquidation incentive factor parameters
+MAX_LIQUIDATION_INCENTIVE_FACTOR = 1.15
+LIQUIDATION_CURSOR = 0.3
+
+# Default haircut on the oracle price when there is no swap quote for a pair
+DEFAULT_SLIPPAGE = 0.01
+
+
+def liquidation_incentive_factor(lltv):
+    """LIF = min(1.15, 1 / (1 - 0.3 * (1 - lltv))), works on floats and arrays"""
+    return np.minimum(
+        MAX_LIQUIDATION_INCENTIVE_FACTOR,
+        1 / (1 - LIQUIDATION_CURSOR * (1 - np.asarray(lltv, dtype=float))),
+    )
+
+
+@dataclass(frozen=True)
+class RankedLiquidation:
+    market: MorphoMarket
+    position: Position
+    repaidAssets: float
+    seizedCollateral: float
+    proceeds: float
+    gasCost: float
+
+    @property
+    def profit(self) -> float:
+        return self.proceeds - self.repaidAssets - self.gasCost
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.market.name()} {self.position.address} ltv {self.position.ltv*100:.2f}% "
+            f"repay {self.repaidAssets:,.2f} seize {self.seizedCollateral:,.4f} "
+            f"proceeds {self.proceeds:,.2f} gas {self.gasCost:,.2f} profit {self.profit:,.2f}"
+        )
+
+
+class LiquidationRanking:
+    """Rank liquidation candidates of any market by expected profit.
+
+    For each unhealthy position the whole collateral is seized if it covers the debt
+    times the incentive factor, otherwise the whole debt is repaid. Proceeds come from
+    the swap rates (loan token per collateral token) keyed by (collateral, loan,
+    borrower) or (collateral, loan) token, falling back to the oracle price minus a
+    slippage haircut. Gas cost is converted in loan token with the native token
+    price of each loan token.
+    """
+
+    def __init__(
+        self,
+        gasPrice: int = 0,
+        gasUnits: int | None = None,
+        nativePrices: dict[str, float] | None = None,
+        slippage: float = DEFAULT_SLIPPAGE,
+    ):
+        self.gasPrice = gasPrice
+        self.gasUnits = (
+            gasUnits
+            if gasUnits is not None
+            else int(os.environ.get("LIQUIDATION_GAS", 350000))
+        )
+        self.nativePrices = nativePrices or {}
+        self.slippage = slippage
+
+    def rank(
+        self,
+        candidates: list[tuple[MorphoMarket, Position]],
+        swapRates: dict[tuple[str, str, str], float] | None = None,
+    ) -> list[RankedLiquidation]:
+        """Profit sorted liquidations of the unhealthy candidates"""
+        candidates = [
+            (m, p) for m, p in candidates if p.borrowAssets > 0 and p.ltv >= m.lltv
+        ]
+        if not candidates:
+            return []
+        swapRates = swapRates or {}
+
+        borrowed = np.array([p.borrowAssets for _, p in candidates])
+        collateral = np.array([p.collateral for _, p in candidates])
+        price = np.array([p.collateralPrice for _, p in candidates])
+        lif = liquidation_incentive_factor([m.lltv for m, _ in candidates])
+        swapRate = np.array(
+            [
+                swapRates.get(
+                    (m.collateralToken, m.loanToken, p.address),
+                    swapRates.get(
+                        (m.collateralToken, m.loanToken),
+                        p.collateralPrice * (1 - self.slippage),
+                    ),
+                )
+                for m, p in candidates
+            ]
+        )
+        nativePrice = np.array(
+            [self.nativePrices.get(m.loanToken, 0.0) for m, _ in candidates]
+        )
+
+        # Collateral needed to repay the whole debt, capped by the collateral
+        with np.errstate(divide="ignore", invalid="ignore"):
+            seized = np.minimum(
+                collateral, np.where(price > 0, borrowed * lif / price, collateral)
+            )
+        repaid = np.minimum(borrowed, seized * price / lif)
+        proceeds = seized * swapRate
+        gasCost = self.gasUnits * self.gasPrice / pow(10, 18) * nativePrice
+        profit = proceeds - repaid - gasCost
+
+        return [
+            RankedLiquidation(
+                candidates[i][0],
+                candidates[i][1],
+                float(repaid[i]),
+                float(seized[i]),
+                float(proceeds[i]),
+                float(gasCost[i]),
+            )
+            for i in np.argsort(-profit, kind="stable")
+        ]
@@ -0,0 +1,217 @@
+"""Columnar decoding of the raw logs of the events we consume.
+
+The layout of each event (the topic or data word of each field) is computed once
+from the ABI, then the topics and data of all the logs of an event are read into
+NumPy arrays in one pass, without the AttributeDicts of the web3 log formatters and
+event decoding. Data words are kept as 4 big-endian uint64 limbs so uint256 values
+convert to floats in a vectorized way, exact ints are built only on demand.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+import numpy as np
+from eth_utils import event_abi_to_log_topic
+
+from .codec import checksum
+
+# Events decoded by default: ABI file -> names
+EVENTS = {
+    "abis/morphoblue.json": (
+        "Supply",
+        "Withdraw",
+        "Borrow",
+        "Repay",
+        "SupplyCollateral",
+        "WithdrawCollateral",
+        "Liquidate",
+        "AccrueInterest",
+    ),
+    "abis/aave_v3_pool.json": ("ReserveDataUpdated",),
+}
+
+# Limbs of a 32 bytes word as float: 2^192, 2^128, 2^64, 1
+LIMBS = np.array([2.0**192, 2.0**128, 2.0**64, 1.0])
+
+
+def layouts(abis=None) -> dict:
+    """{topic0: (event name, [(field, type, topic index or None, data word)])} of
+    the events with static fields only
+    """
+    abis = abis or {
+        path: names for path, names in EVENTS.items() if os.path.exists(path)
+    }
+    result = {}
+    for path, names in abis.items():
+        for abi in json.load(open(path)):
+            if abi.get("type") != "event" or abi["name"] not in names:
+                continue
+            fields = []
+            topic, word = 1, 0
+            for input in abi["inputs"]:
+                if input["indexed"]:
+                    fields.append((input["name"], input["type"], topic, None))
+                    topic += 1
+                else:
+                    fields.append((input["name"], input["type"], None, word))
+                    word += 1
+            topic0 = "0x" + event_abi_to_log_topic(abi).hex()
+            result[topic0] = (abi["name"], fields)
+    return result
+
+
+class DecodedLogs:
+    """Logs of one event as columns: blockNumber, logIndex and one array per field.
+    address fields are S20 arrays, bytes32 ones S32 arrays and uint ones (n, 4)
+    arrays of uint64 limbs, see floats() and ints().
+    """
+
+    def __init__(self, event, blockNumber, logIndex, columns, types):
+        self.event = event
+        self.blockNumber = blockNumber
+        self.logIndex = logIndex
+        self.columns = columns
+        self.types = types
+
+    def __len__(self):
+        return len(self.blockNumber)
+
+    def floats(self, field) -> np.ndarray:
+        return self.columns[field].astype(float) @ LIMBS
+
+    def ints(self, field) -> list[int]:
+        return [
+            (a << 192) | (b << 128) | (c << 64) | d
+            for a, b, c, d in self.columns[field].tolist()
+        ]
+
+    def addresses(self, field) -> list[str]:
+        return [checksum("0x" + a.ljust(20, b"\0").hex()) for a in self.columns[field]]
+
+    def hex(self, field) -> list[str]:
+        return ["0x" + v.ljust(32, b"\0").hex() for v in self.columns[field]]
+
+    @staticmethod
+    def concatenate(parts) -> "DecodedLogs":
+        parts = list(parts)
+        first = parts[0]
+        return DecodedLogs(
+            first.event,
+            np.concatenate([p.blockNumber for p in parts]),
+            np.concatenate([p.logIndex for p in parts]),
+            {
+                field: np.concatenate([p.columns[field] for p in parts])
+                for field in first.columns
+            },
+            first.types,
+        )
+
+
+def _words(values, size) -> np.ndarray:
+    """(n, size) uint8 array of the hex strings (or bytes) values"""
+    raw = b"".join(
+        bytes.fromhex(v[2:]) if isinstance(v, str) else bytes(v) for v in values
+    )
+    return np.frombuffer(raw, dtype=np.uint8).reshape(len(values), -1)[:, :size]
+
+
+def _int(value) -> int:
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+def _decode_event(event, fields, logs) -> DecodedLogs:
+    columns = {}
+    types = {}
+    data = None
+    words = max((w for _, _, _, w in fields if w is not None), default=-1) + 1
+    if words:
+        data = _words([log["data"] for log in logs], 32 * words)
+        limbs = data.copy().view(">u8").reshape(len(logs), words, 4)
+    for name, type, topic, word in fields:
+        types[name] = type
+        if topic is not None:
+            column = _words([log["topics"][topic] for log in logs], 32)
+        else:
+            column = data[:, 32 * word : 32 * (word + 1)]
+        if type == "address":
+            columns[name] = np.ascontiguousarray(column[:, 12:]).view("S20").ravel()
+        elif type.startswith("uint"):
+            columns[name] = (
+                limbs[:, word].astype(np.uint64)
+                if word is not None
+                else np.ascontiguousarray(column).view(">u8").astype(np.uint64)
+            )
+        else:
+            columns[name] = np.ascontiguousarray(column).view("S32").ravel()
+    return DecodedLogs(
+        event,
+        np.array([_int(log["blockNumber"]) for log in logs], dtype=np.int64),
+        np.array([_int(log.get("logIndex", 0)) for log in logs], dtype=np.int64),
+        columns,
+        types,
+    )
+
+
+def _decode(layout, logs) -> dict[str, DecodedLogs]:
+    groups = {}
+    for log in logs:
+        topics = log["topics"]
+        if not topics:
+            continue
+        # HexBytes.hex() may or may not have the 0x prefix depending on hexbytes
+        topic0 = (
+            topics[0].lower()
+            if isinstance(topics[0], str)
+            else "0x" + bytes(topics[0]).hex()
+        )
+        if topic0 in layout:
+            groups.setdefault(topic0, []).append(log)
+    return {
+        layout[topic0][0]: _decode_event(*layout[topic0], group)
+        for topic0, group in groups.items()
+    }
+
+
+class LogDecoder:
+    """Decode raw logs (JSON-RPC dicts of hex strings, or web3 log entries) into a
+    DecodedLogs per event. Batches of more than LOG_DECODE_POOL logs are split
+    over a process pool.
+    """
+
+    def __init__(self, abis=None, poolThreshold=None):
+        self.layout = layouts(abis)
+        self.topics = {name: topic0 for topic0, (name, _) in self.layout.items()}
+        self.poolThreshold = int(
+            poolThreshold or os.environ.get("LOG_DECODE_POOL", 200000)
+        )
+
+    def topic(self, event) -> str:
+        return self.topics[event]
+
+    def decode(self, logs) -> dict[str, DecodedLogs]:
+        logs = list(logs)
+        if len(logs) <= self.poolThreshold:
+            return _decode(self.layout, logs)
+        workers = os.cpu_count() or 1
+        size = -(-len(logs) // workers)
+        chunks = [logs[i : i + size] for i in range(0, len(logs), size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_decode, [self.layout] * len(chunks), chunks))
+        events = {}
+        for part in parts:
+            for name, decoded in part.items():
+                events.setdefault(name, []).append(decoded)
+        return {
+            name: DecodedLogs.concatenate(decoded) for name, decoded in events.items()
+        }
+
+
+_decoder = None
+
+
+def log_decoder() -> LogDecoder:
+    global _decoder
+    if _decoder is None:
+        _decoder = LogDecoder()
+    return _decoder
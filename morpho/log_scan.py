@@ -0,0 +1,28 @@
+from .codec import get_logs
+
+
+def scan_logs(web3, address, topics, fromBlock, toBlock, chunk, log=print, raw=False):
+    """Yield (last block, logs) of eth_getLogs over ranges of chunk blocks from
+    fromBlock to toBlock. A range refused by the node (too many results or too
+    wide) is halved and retried, down to 1000 blocks. With raw the logs are left
+    as JSON-RPC dicts for the log decoder.
+    """
+    start = fromBlock
+    while start <= toBlock:
+        end = min(start + chunk - 1, toBlock)
+        try:
+            filter = {
+                "address": address,
+                "fromBlock": start,
+                "toBlock": end,
+                "topics": topics,
+            }
+            logs = get_logs(web3, filter) if raw else web3.eth.get_logs(filter)
+        except Exception as exc:
+            if chunk <= 1000:
+                raise
+            chunk //= 2
+            log(f"eth_getLogs {start}-{end} failed ({exc}), retrying")
+            continue
+        yield end, logs
+        start = end + 1
@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+
+from eth_abi import decode
+from eth_utils import event_abi_to_log_topic, function_signature_to_4byte_selector
+
+from utils.cache import cache_file_path, cache_token_details, get_token_details
+from .blocks import block_head
+from .log_scan import scan_logs
+from .morphoblue import DEPLOYMENT_BLOCK, MaketParams
+from .multicall import multicall
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+DECIMALS_SELECTOR = function_signature_to_4byte_selector("decimals()")
+SYMBOL_SELECTOR = function_signature_to_4byte_selector("symbol()")
+
+
+def _symbol(data: bytes) -> str:
+    """symbol() as a string, or as bytes32 for the old tokens (e.g. MKR)"""
+    try:
+        return decode(["string"], data)[0]
+    except Exception:
+        return data[:32].rstrip(b"\0").decode(errors="replace")
+
+
+class MarketCatalog:
+    """Every Morpho Blue market, from the CreateMarket events.
+
+    Keeps the params, token symbols and decimals, IRM and oracle of each market in
+    the cache directory, synced incrementally from the last block read. Metadata of
+    the new tokens is read in one multicall and shared with the token cache, so
+    markets of the catalog are loaded without any RPC. Markets are indexed by loan
+    token, collateral token (address or symbol) and LLTV.
+    """
+
+    def __init__(self, blue, path=None):
+        self.blue = blue
+        self.web3 = blue.web3
+        self.path = path or cache_file_path("market_catalog.json")
+        self.chunk = int(os.environ.get("LOGS_CHUNK", 100000))
+        self.topic = (
+            "0x"
+            + event_abi_to_log_topic(
+                next(e for e in blue.abi if e.get("name") == "CreateMarket")
+            ).hex()
+        )
+        self.lastBlock = None
+        self.markets = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        if data.get("blue", "").lower() == self.blue.address.lower():
+            self.lastBlock = data["lastBlock"]
+            self.markets = data["markets"]
+        self._reindex()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w") as file:
+            json.dump(
+                {
+                    "blue": self.blue.address,
+                    "lastBlock": self.lastBlock,
+                    "markets": self.markets,
+                },
+                file,
+            )
+
+    def _reindex(self):
+        self.byToken = {}
+        self.byLltv = {}
+        for id, m in self.markets.items():
+            for key in (
+                "loan:" + m["loanToken"].lower(),
+                "loan:" + m["loanSymbol"].lower(),
+                "collateral:" + m["collateralToken"].lower(),
+                "collateral:" + m["collateralSymbol"].lower(),
+            ):
+                self.byToken.setdefault(key, set()).add(id)
+            self.byLltv.setdefault(m["lltv"], set()).add(id)
+
+    def _tokens(self, addresses, block):
+        """{address: (decimals, symbol)} from the token cache, the missing ones
+        read in a single multicall and cached
+        """
+        tokens = {}
+        missing = []
+        for address in addresses:
+            if address == ZERO_ADDRESS:
+                tokens[address] = (0, "Idle")
+                continue
+            cached = get_token_details(address)
+            if cached:
+                tokens[address] = (cached["decimals"], cached["symbol"])
+            else:
+                missing.append(address)
+        results = multicall(self.web3).call(
+            [(a, s) for a in missing for s in (DECIMALS_SELECTOR, SYMBOL_SELECTOR)],
+            block,
+        )
+        for i, address in enumerate(missing):
+            (okDecimals, decimals), (okSymbol, symbol) = results[2 * i : 2 * i + 2]
+            details = (
+                decode(["uint8"], decimals)[0] if okDecimals else 18,
+                _symbol(symbol) if okSymbol else address[:8],
+            )
+            tokens[address] = details
+            if okDecimals and okSymbol:
+                cache_token_details(
+                    address,
+                    {
+                        "decimals": details[0],
+                        "factor": pow(10, details[0]),
+                        "symbol": details[1],
+                    },
+                )
+        return tokens
+
+    def sync(self, toBlock=None, log=print) -> int:
+        """Add the markets created up to toBlock (the current block by default),
+        returns the number of new markets
+        """
+        toBlock = toBlock if toBlock is not None else block_head(self.web3).number()
+        created = []
+        with self._lock:
+            previous = self.lastBlock
+            start = (
+                self.lastBlock + 1
+                if self.lastBlock is not None
+                else int(os.environ.get("MORPHO_BLUE_START", DEPLOYMENT_BLOCK))
+            )
+            for end, logs in scan_logs(
+                self.web3,
+                self.blue.address,
+                [self.topic],
+                start,
+                toBlock,
+                self.chunk,
+                log,
+            ):
+                for entry in logs:
+                    params = decode(
+                        ["address", "address", "address", "address", "uint256"],
+                        bytes(entry["data"]),
+                    )
+                    created.append(
+                        (
+                            "0x" + bytes(entry["topics"][1]).hex(),
+                            [self.web3.to_checksum_address(a) for a in params[:4]],
+                            params[4],
+                            int(entry["blockNumber"]),
+                        )
+                    )
+                self.lastBlock = end
+
+            tokens = self._tokens(
+                {a for _, params, _, _ in created for a in params[:2]}, toBlock
+            )
+            for id, (loan, collateral, oracle, irm), lltv, block in created:
+                self.markets[id] = {
+                    "loanToken": loan,
+                    "loanSymbol": tokens[loan][1],
+                    "loanDecimals": tokens[loan][0],
+                    "collateralToken": collateral,
+                    "collateralSymbol": tokens[collateral][1],
+                    "collateralDecimals": tokens[collateral][0],
+                    "oracle": oracle,
+                    "irm": irm,
+                    "lltv": str(lltv),
+                    "block": block,
+                }
+            if self.lastBlock != previous:
+                self._reindex()
+                self._save()
+        return len(created)
+
+    def params(self, id) -> MaketParams | None:
+        m = self.markets.get(id.lower())
+        if m is None:
+            return None
+        return MaketParams(
+            m["loanToken"], m["collateralToken"], m["oracle"], m["irm"], int(m["lltv"])
+        )
+
+    def search(self, loan=None, collateral=None, lltv=None) -> list[str]:
+        """Ids of the markets matching every given criterion, tokens by address or
+        symbol (case insensitive), lltv as a fraction (e.g. 0.86)
+        """
+        ids = set(self.markets)
+        if loan is not None:
+            ids &= self.byToken.get("loan:" + loan.lower(), set())
+        if collateral is not None:
+            ids &= self.byToken.get("collateral:" + collateral.lower(), set())
+        if lltv is not None:
+            ids &= self.byLltv.get(str(round(float(lltv) * pow(10, 18))), set())
+        return sorted(ids, key=lambda id: self.markets[id]["block"])
+
+
+_catalogs = {}
+
+
+def market_catalog(blue) -> MarketCatalog:
+    key = id(blue.web3)
+    if key not in _catalogs:
+        _catalogs[key] = MarketCatalog(blue)
+    return _catalogs[key]
@@ -0,0 +1,133 @@
+"""Integer math mirroring Morpho Blue's MathLib and SharesMathLib.
+
+The *Bulk variants take sequences (or numpy arrays) of uint values and work on numpy
+object arrays so that the arithmetic stays exact on Python integers.
+"""
+
+import numpy as np
+
+WAD = pow(10, 18)
+ORACLE_PRICE_SCALE = pow(10, 36)
+
+# Virtual shares and assets used by Morpho Blue to mitigate share price manipulation
+VIRTUAL_SHARES = pow(10, 6)
+VIRTUAL_ASSETS = 1
+
+MAX_UINT256 = pow(2, 256) - 1
+
+
+def mulDivDown(x: int, y: int, d: int) -> int:
+    return (x * y) // d
+
+
+def mulDivUp(x: int, y: int, d: int) -> int:
+    return (x * y + (d - 1)) // d
+
+
+def zeroFloorSub(x: int, y: int) -> int:
+    return x - y if x > y else 0
+
+
+def toSharesDown(assets: int, totalAssets: int, totalShares: int) -> int:
+    return mulDivDown(
+        assets, totalShares + VIRTUAL_SHARES, totalAssets + VIRTUAL_ASSETS
+    )
+
+
+def toSharesUp(assets: int, totalAssets: int, totalShares: int) -> int:
+    return mulDivUp(assets, totalShares + VIRTUAL_SHARES, totalAssets + VIRTUAL_ASSETS)
+
+
+def toAssetsDown(shares: int, totalAssets: int, totalShares: int) -> int:
+    return mulDivDown(
+        shares, totalAssets + VIRTUAL_ASSETS, totalShares + VIRTUAL_SHARES
+    )
+
+
+def toAssetsUp(shares: int, totalAssets: int, totalShares: int) -> int:
+    return mulDivUp(shares, totalAssets + VIRTUAL_ASSETS, totalShares + VIRTUAL_SHARES)
+
+
+def wMulDown(x: int, y: int) -> int:
+    return mulDivDown(x, y, WAD)
+
+
+def wDivDown(x: int, y: int) -> int:
+    return mulDivDown(x, WAD, y)
+
+
+def wDivUp(x: int, y: int) -> int:
+    return mulDivUp(x, WAD, y)
+
+
+def wTaylorCompounded(x: int, n: int) -> int:
+    """Approximation of e^(x*n) - 1 with the first three terms of the Taylor series"""
+    firstTerm = x * n
+    secondTerm = mulDivDown(firstTerm, firstTerm, 2 * WAD)
+    thirdTerm = mulDivDown(secondTerm, firstTerm, 3 * WAD)
+    return firstTerm + secondTerm + thirdTerm
+
+
+def uintArray(values) -> np.ndarray:
+    """Exact integer array (numpy int64 would overflow on uint256 values)"""
+    return np.asarray([int(v) for v in values], dtype=object)
+
+
+def mulDivDownBulk(x, y, d) -> np.ndarray:
+    return (uintArray(x) * y) // d
+
+
+def mulDivUpBulk(x, y, d) -> np.ndarray:
+    return (uintArray(x) * y + (d - 1)) // d
+
+
+def toSharesDownBulk(assets, totalAssets: int, totalShares: int) -> np.ndarray:
+    return mulDivDownBulk(
+        assets, totalShares + VIRTUAL_SHARES, totalAssets + VIRTUAL_ASSETS
+    )
+
+
+def toSharesUpBulk(assets, totalAssets: int, totalShares: int) -> np.ndarray:
+    return mulDivUpBulk(
+        assets, totalShares + VIRTUAL_SHARES, totalAssets + VIRTUAL_ASSETS
+    )
+
+
+def toAssetsDownBulk(shares, totalAssets: int, totalShares: int) -> np.ndarray:
+    return mulDivDownBulk(
+        shares, totalAssets + VIRTUAL_ASSETS, totalShares + VIRTUAL_SHARES
+    )
+
+
+def toAssetsUpBulk(shares, totalAssets: int, totalShares: int) -> np.ndarray:
+    return mulDivUpBulk(
+        shares, totalAssets + VIRTUAL_ASSETS, totalShares + VIRTUAL_SHARES
+    )
+
+
+def positionsBulk(
+    supplyShares,
+    borrowShares,
+    collateral,
+    totalSupplyAssets: int,
+    totalSupplyShares: int,
+    totalBorrowAssets: int,
+    totalBorrowShares: int,
+    price: int,
+    lltv: int,
+):
+    """Balances of many positions of a market, rounded as Morpho Blue does.
+    Returns exact (supplyAssets, borrowAssets, collateralValue, maxBorrow) arrays
+    and float (ltv, healthRatio) arrays.
+    """
+    supplyAssets = toAssetsDownBulk(supplyShares, totalSupplyAssets, totalSupplyShares)
+    borrowAssets = toAssetsUpBulk(borrowShares, totalBorrowAssets, totalBorrowShares)
+    collateralValue = mulDivDownBulk(collateral, price, ORACLE_PRICE_SCALE)
+    maxBorrow = (collateralValue * lltv) // WAD
+
+    borrowed = borrowAssets.astype(float)
+    value = collateralValue.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ltv = np.where(value > 0, borrowed / value, np.where(borrowed > 0, np.inf, 0))
+        healthRatio = np.where(borrowed > 0, maxBorrow.astype(float) / borrowed, np.inf)
+    return supplyAssets, borrowAssets, collateralValue, maxBorrow, ltv, healthRatio
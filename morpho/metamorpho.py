@@ -9,12 +9,16 @@ from utils.cache import (
     get_morpho_details,
     get_token_details,
 )
+from utils.output import ContextThreadPoolExecutor
 
-from .morphoblue import MorphoBlue
+from .blocks import block_head
+from .morphoblue import MarketWatcher, MorphoBlue
+from .reallocation_model import vault_snapshot
 
 
 class MetaMorpho:
     def __init__(self, web3, address):
+        self.web3 = web3
         self.abi = json.load(open("abis/metamorpho.json"))
         self.address = web3.to_checksum_address(address)
         self.contract = web3.eth.contract(address=self.address, abi=self.abi)
@@ -73,6 +77,7 @@ class MetaMorpho:
             self.assetFactor = cached_details_tokens["factor"]
 
         self.blue = MorphoBlue(web3, morphoAddress, "")
+        self.watcher = None
         self.initMarkets()
 
     def fetch_market_data(self, market):
@@ -80,8 +85,11 @@ class MetaMorpho:
         marketData = market.marketData()
         return (market, position, marketData)
 
-    def totalAssets(self):
-        return self.contract.functions.totalAssets().call() / pow(
+    def totalAssets(self, block=None):
+        """Total assets at block, the block of the block head policy by default"""
+        if block is None:
+            block = block_head(self.web3).number()
+        return self.contract.functions.totalAssets().call(block_identifier=block) / pow(
             10, self.assetDecimals
         )
 
@@ -134,7 +142,7 @@ class MetaMorpho:
         liquidity = 0.0
 
         # Get data in parallel
-        with ThreadPoolExecutor(
+        with ContextThreadPoolExecutor(
             max_workers=os.environ.get("MAX_WORKERS", 10)
         ) as executor:
             futures = [
@@ -191,6 +199,17 @@ class MetaMorpho:
             f"{self.symbol} rate {vaultRate*100.0:.2f}%, total liquidity {liquidity:,.0f}"
         )
 
+    def watch(self):
+        """Follow new blocks and only read again the markets touched by an event"""
+        if self.watcher is None:
+            self.watcher = MarketWatcher(self.blue, self.markets)
+            block_head(self.web3).start()
+        return self.watcher
+
+    def snapshot(self):
+        """Return a VaultSnapshot used to model reallocations locally"""
+        return vault_snapshot(self)
+
     def rate(self):
         totalAssets = self.totalAssets()
         vaultRate = 0.0
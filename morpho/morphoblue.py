@@ -1,7 +1,18 @@
 import json
 from .morphomarket import MorphoMarket
 from dataclasses import dataclass
+from eth_abi import encode
+from eth_utils import keccak
 import os
+import threading
+
+from . import codec
+from .block_time import FINALITY_DEPTH
+from .blocks import block_head
+from .log_decoder import log_decoder
+
+# First block with Morpho Blue markets on mainnet, logs are searched from there
+DEPLOYMENT_BLOCK = 18920518
 
 
 @dataclass
@@ -24,6 +35,20 @@ class MaketParams:
     def toTuple(self):
         return (self.loanToken, self.collateralToken, self.oracle, self.irm, self.lltv)
 
+    def id(self):
+        """Morpho Blue market id, keccak256(abi.encode(marketParams))"""
+        encoded = encode(
+            ["address", "address", "address", "address", "uint256"],
+            [
+                self.loanToken,
+                self.collateralToken,
+                self.oracle,
+                self.irm,
+                int(self.lltv),
+            ],
+        )
+        return "0x" + keccak(encoded).hex()
+
 
 class MorphoBlue:
     def __init__(self, web3, address, markets=""):
@@ -35,6 +60,11 @@ class MorphoBlue:
         readerAbi = json.load(open("abis/MorphoReader.json"))
         readerAddress = web3.to_checksum_address(os.environ.get("MORPHO_READER"))
         self.reader = web3.eth.contract(address=readerAddress, abi=readerAbi)
+        # MarketCatalog giving the params of the markets without RPC when set
+        self.catalog = None
+        # market id -> (borrower addresses, last block scanned)
+        self._borrowers = {}
+        self._borrowersLock = threading.Lock()
 
         self.markets = []
         markets = markets or ""
@@ -42,10 +72,13 @@ class MorphoBlue:
             if not id == "":
                 self.addMarket(id.lower().strip())
 
-    def marketData(self, id):
-        return self.reader.functions.getMarketData(id).call()
+    def marketData(self, id, block="latest"):
+        return codec.get_market_data(self.web3, self.reader.address, id, block)
 
     def marketParams(self, id):
+        params = self.catalog.params(id) if self.catalog is not None else None
+        if params is not None:
+            return params
         data = self.contract.functions.idToMarketParams(id).call()
         return MaketParams(data[0], data[1], data[2], data[3], data[4])
 
@@ -66,16 +99,71 @@ class MorphoBlue:
             if m.id == id:
                 return m
 
-    def position(self, id, address):
-        return self.reader.functions.getPosition(id, address).call()
+    def position(self, id, address, block="latest"):
+        return codec.get_position(self.web3, self.reader.address, id, address, block)
 
     def borrowers(self, id):
-        borrowers = set()
-        logs = (
-            self.contract.events.Borrow()
-            .create_filter(fromBlock=18920518, argument_filters={"id": id})
-            .get_all_entries()
+        """Addresses that ever borrowed in the market. The Borrow logs are scanned
+        once from the deployment, then only from the last block scanned (less
+        FINALITY_DEPTH blocks, for reorgs) to the block head.
+        """
+        head = block_head(self.web3).number()
+        with self._borrowersLock:
+            known, lastBlock = self._borrowers.get(id, (set(), None))
+        if lastBlock is not None and head <= lastBlock:
+            return list(known)
+        fromBlock = (
+            DEPLOYMENT_BLOCK
+            if lastBlock is None
+            else max(lastBlock - FINALITY_DEPTH + 1, DEPLOYMENT_BLOCK)
+        )
+        decoder = log_decoder()
+        logs = codec.get_logs(
+            self.web3,
+            {
+                "address": self.address,
+                "fromBlock": fromBlock,
+                "toBlock": head,
+                "topics": [decoder.topic("Borrow"), "0x" + codec.encode_id(id).hex()],
+            },
         )
-        for log in logs:
-            borrowers.add(log.args.onBehalf)
-        return list(borrowers)
+        borrows = decoder.decode(logs).get("Borrow")
+        found = set(borrows.addresses("onBehalf")) if borrows is not None else set()
+        with self._borrowersLock:
+            known, lastBlock = self._borrowers.get(id, (set(), None))
+            known = known | found
+            self._borrowers[id] = (known, max(head, lastBlock or head))
+        return list(known)
+
+
+class MarketWatcher:
+    """Invalidate the state of watched markets only when an event touches them.
+    On every new block of the block head a single eth_getLogs on Morpho Blue, filtered
+    on the market ids, tells which markets have to be read again; the others are
+    extrapolated locally (see MorphoMarket.expectedMarketData).
+    """
+
+    def __init__(self, blue, markets):
+        self.blue = blue
+        self.markets = {m.id.lower(): m for m in markets}
+        self.lastBlock = None
+        for m in self.markets.values():
+            m.watched = True
+            m.invalidateState()
+        block_head(blue.web3).subscribe(self.onNewHead)
+
+    def onNewHead(self, number):
+        if self.lastBlock is not None and number > self.lastBlock:
+            logs = self.blue.web3.eth.get_logs(
+                {
+                    "address": self.blue.address,
+                    "fromBlock": self.lastBlock + 1,
+                    "toBlock": number,
+                    "topics": [None, list(self.markets)],
+                }
+            )
+            for log in logs:
+                market = self.markets.get("0x" + bytes(log["topics"][1]).hex())
+                if market is not None:
+                    market.invalidateState()
+        self.lastBlock = number
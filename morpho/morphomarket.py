@@ -1,29 +1,27 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+import heapq
+import itertools
 import json
 import os
-from morpho.utils import POW_10_18
-from morpho.utils import rateToTargetRate
+from morpho.utils import POW_10_18, POW_10_36
+from morpho.utils import rateToTargetRate, secondToAPYRate
+from morpho.mathlib import positionsBulk, toSharesDown, wMulDown, wTaylorCompounded
 from dataclasses import dataclass
+import threading
 import time
 
-from utils.cache import cache_token_details, get_token_details
-
+import numpy as np
 
-@dataclass
-class Position:
-    address: str
-    supplyShares: float
-    supplyAssets: float
-    borrowShares: float
-    borrowAssets: float
-    collateral: float
-    collateralValue: float
-    collateralPrice: float
-    ltv: float
-    healthRatio: float
+from morpho import codec
+from morpho.blocks import block_head
+from morpho.codec import checksum
+from morpho.position_table import Position, PositionTable
+from morpho.price_cache import oracle_price_cache
+from utils.cache import cache_token_details, get_token_details
+from utils.output import ContextThreadPoolExecutor
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class MaketData:
     totalSupplyAssets: float
     totalSupplyShares: float
@@ -36,6 +34,46 @@ class MaketData:
     borrowRateAtTarget: float
 
 
+@dataclass(frozen=True)
+class MarketState:
+    """Raw Morpho Blue market storage with the IRM borrow rate (per second, WAD)"""
+
+    totalSupplyAssets: int
+    totalSupplyShares: int
+    totalBorrowAssets: int
+    totalBorrowShares: int
+    lastUpdate: int
+    fee: int
+    borrowRate: int
+
+    def accrued(self, timestamp: int) -> "MarketState":
+        """State after accruing interest until timestamp, as Morpho's
+        expectedMarketBalances does with the borrow rate kept constant
+        """
+        elapsed = int(timestamp) - self.lastUpdate
+        if elapsed <= 0 or self.totalBorrowAssets == 0 or self.borrowRate == 0:
+            return self
+        interest = wMulDown(
+            self.totalBorrowAssets, wTaylorCompounded(self.borrowRate, elapsed)
+        )
+        totalSupplyAssets = self.totalSupplyAssets + interest
+        totalSupplyShares = self.totalSupplyShares
+        if self.fee != 0:
+            feeAmount = wMulDown(interest, self.fee)
+            totalSupplyShares += toSharesDown(
+                feeAmount, totalSupplyAssets - feeAmount, totalSupplyShares
+            )
+        return MarketState(
+            totalSupplyAssets,
+            totalSupplyShares,
+            self.totalBorrowAssets + interest,
+            self.totalBorrowShares,
+            int(timestamp),
+            self.fee,
+            self.borrowRate,
+        )
+
+
 class MorphoMarket:
     def __init__(self, web3, blue, id):
         self.web3 = web3
@@ -55,7 +93,7 @@ class MorphoMarket:
                 address=web3.to_checksum_address(params.oracle),
                 abi=json.load(open("abis/oracle.json")),
             )
-        self.lastOracleUpdate = 0
+            oracle_price_cache(web3).register(params.oracle)
         self.lltv = self.params.lltv / POW_10_18
 
         # Get some data from erc20
@@ -121,7 +159,13 @@ class MorphoMarket:
         self.lastRate = 0
         self.lastRateUpdate = 0
         self.lastMarketData = None
-        self.lastMarketDataUpdate = 0
+        self.lastMarketDataBlock = None
+        self.lastState = None
+        self.lastStateBlock = None
+        self.watched = False
+        self.lock = threading.Lock()
+        # Last LTV read for each borrower, bounds for topBorrowers
+        self.lastLtv = {}
 
     def isIdleMarket(self):
         return self.collateralToken == "0x0000000000000000000000000000000000000000"
@@ -135,17 +179,76 @@ class MorphoMarket:
     def rateAtTarget(self):
         return self.marketData().borrowRateAtTarget
 
-    def _marketData(self):
-        if time.time() < self.lastMarketDataUpdate + 5:
-            return self.lastMarketData
-        self.lastMarketData = self.blue.marketData(self.id)
-        self.lastMarketDataUpdate = time.time()
-        return self.lastMarketData
+    def _marketData(self, block=None):
+        """Raw reader market data, read once per block of the block head policy"""
+        if block is None:
+            block = block_head(self.web3).number()
+        with self.lock:
+            if self.lastMarketDataBlock == block:
+                return self.lastMarketData
+        marketData = self.blue.marketData(self.id, block)
+        with self.lock:
+            if self.lastMarketDataBlock is None or block >= self.lastMarketDataBlock:
+                self.lastMarketData = marketData
+                self.lastMarketDataBlock = block
+        return marketData
 
     def marketParams(self):
         return self.params
 
-    def marketData(self):
+    def _fetchState(self, block) -> MarketState:
+        market = codec.market(self.web3, self.blue.address, self.id, block)
+        borrowRate = 0
+        if not self.isIdleMarket():
+            borrowRate = self.irmContract.functions.borrowRateView(
+                self.params.toTuple(), market
+            ).call(block_identifier=block)
+        return MarketState(*market, borrowRate)
+
+    def marketState(self) -> MarketState:
+        """Raw market state. When the market is watched (see MarketWatcher) it is only
+        read again after an event touched the market, otherwise once per block.
+        """
+        block = None if self.watched else block_head(self.web3).number()
+        with self.lock:
+            if self.lastState is not None and (
+                self.watched or self.lastStateBlock == block
+            ):
+                return self.lastState
+        state = self._fetchState(block if block is not None else "latest")
+        with self.lock:
+            self.lastState = state
+            self.lastStateBlock = block
+        return state
+
+    def invalidateState(self):
+        with self.lock:
+            self.lastState = None
+
+    def expectedMarketData(self, timestamp=None):
+        """Market data extrapolated locally to timestamp (now by default) from the
+        last read state, without any RPC while the market isn't touched
+        """
+        state = self.marketState().accrued(
+            timestamp if timestamp is not None else time.time()
+        )
+        totalSupplyAssets = state.totalSupplyAssets / self.loanTokenFactor
+        totalBorrowAssets = state.totalBorrowAssets / self.loanTokenFactor
+        utilization = totalBorrowAssets / totalSupplyAssets if totalSupplyAssets else 0
+        borrowRate = secondToAPYRate(state.borrowRate)
+        return MaketData(
+            totalSupplyAssets,
+            state.totalSupplyShares / POW_10_18,
+            totalBorrowAssets,
+            state.totalBorrowShares / POW_10_18,
+            state.fee,
+            utilization,
+            borrowRate * utilization * (1 - state.fee / POW_10_18),
+            borrowRate,
+            rateToTargetRate(borrowRate, utilization) if borrowRate else 0,
+        )
+
+    def marketData(self, block=None):
         (
             totalSupplyAssets,
             totalSupplyShares,
@@ -155,7 +258,7 @@ class MorphoMarket:
             utilization,
             supplyRate,
             borrowRate,
-        ) = self._marketData()
+        ) = self._marketData(block)
 
         if self.isIdleMarket():
             return MaketData(
@@ -190,7 +293,10 @@ class MorphoMarket:
             rateAtTarget,
         )
 
-    def position(self, address):
+    def position(self, address, block=None):
+        """Position read at block, the block of the block head policy by default"""
+        if block is None:
+            block = block_head(self.web3).number()
         (
             suppliedShares,
             suppliedAssets,
@@ -200,9 +306,7 @@ class MorphoMarket:
             collateralValue,
             ltv,
             healthRatio,
-        ) = self.blue.reader.functions.getPosition(
-            self.id, self.web3.to_checksum_address(address)
-        ).call()
+        ) = self.blue.position(self.id, checksum(address), block)
 
         if self.isIdleMarket():
             return Position(
@@ -236,37 +340,169 @@ class MorphoMarket:
             healthRatio / POW_10_18,
         )
 
-    def collateralPrice(self):
-        # todo: this oracle pricing is giving old and wrong results
-        lastUpdate = getattr(self, "lastOracleUpdate", None)
-        if lastUpdate is None or time.time() > lastUpdate + 5:
-            self.lastOracleUpdate = time.time()
-            self.oraclePrice = self.oracleContract.functions.price().call() / (
-                # Look at this for the decimals
-                self.loanTokenFactor * self.collateralTokenFactor
+    def positionsFromShares(self, addresses, rawPositions, timestamp=None, price=None):
+        """Positions computed locally from the raw Morpho Blue (supplyShares,
+        borrowShares, collateral) of each address, without a reader call per
+        position. Interest is accrued up to timestamp (now by default).
+        """
+        return self.positionTable(addresses, rawPositions, timestamp, price).positions()
+
+    def positionTable(self, addresses, rawPositions, timestamp=None, price=None):
+        """PositionTable filled in bulk from the raw Morpho Blue positions, see
+        positionsFromShares
+        """
+        state = self.marketState().accrued(
+            timestamp if timestamp is not None else time.time()
+        )
+        if price is None:
+            price = (
+                0
+                if self.isIdleMarket()
+                else oracle_price_cache(self.web3).price(self.params.oracle)
             )
-        return self.oraclePrice
-
-    def borrowers(self):
-        def fetch_position(borrower):
-            return self.position(borrower)
+        supplyShares, borrowShares, collateral = (
+            zip(*rawPositions) if rawPositions else ((), (), ())
+        )
+        (
+            supplyAssets,
+            borrowAssets,
+            collateralValue,
+            _,
+            ltv,
+            healthRatio,
+        ) = positionsBulk(
+            supplyShares,
+            borrowShares,
+            collateral,
+            state.totalSupplyAssets,
+            state.totalSupplyShares,
+            state.totalBorrowAssets,
+            state.totalBorrowShares,
+            price,
+            int(self.params.lltv),
+        )
+        columns = {
+            "supplyShares": np.asarray(supplyShares, dtype=float) / POW_10_18,
+            "supplyAssets": supplyAssets.astype(float) / self.loanTokenFactor,
+        }
+        if not self.isIdleMarket():
+            collateral = np.asarray(collateral, dtype=float)
+            collateralPrice = (
+                price * self.collateralTokenFactor / (POW_10_36 * self.loanTokenFactor)
+            )
+            columns.update(
+                borrowShares=np.asarray(borrowShares, dtype=float) / POW_10_18,
+                borrowAssets=borrowAssets.astype(float) / self.loanTokenFactor,
+                collateral=collateral / self.collateralTokenFactor,
+                collateralValue=collateralValue.astype(float) / self.loanTokenFactor,
+                collateralPrice=np.where(collateral > 0, collateralPrice, 0),
+                ltv=ltv,
+                healthRatio=healthRatio,
+            )
+        return PositionTable.fromColumns(addresses, **columns)
 
-        borrowers = []
-        with ThreadPoolExecutor(
+    def localPosition(self, address):
+        """Position from the Morpho Blue shares, converted locally"""
+        raw = self.blue.contract.functions.position(
+            self.id, self.web3.to_checksum_address(address)
+        ).call()
+        return self.positionsFromShares([address], [raw])[0]
+
+    def collateralPrice(self, block=None):
+        """Price of one collateral token in loan token, from the shared oracle cache.
+        Morpho oracles are scaled by 1e36 * 10^(loan decimals - collateral decimals)
+        """
+        price = oracle_price_cache(self.web3).price(self.params.oracle, block)
+        return price * self.collateralTokenFactor / (POW_10_36 * self.loanTokenFactor)
+
+    def streamBorrowers(self, borrowers=None):
+        """Yield the positions of the borrowers as they arrive"""
+        borrowers = self.blue.borrowers(self.id) if borrowers is None else borrowers
+        with ContextThreadPoolExecutor(
             max_workers=os.environ.get("MAX_WORKERS", 10)
         ) as executor:
-            # Create a future for each borrower
-            future_to_borrower = {
-                executor.submit(fetch_position, b): b
-                for b in self.blue.borrowers(self.id)
-            }
-
-            for future in as_completed(future_to_borrower):
+            futures = [executor.submit(self.position, b) for b in borrowers]
+            for future in as_completed(futures):
                 try:
-                    borrower_position = future.result()
-                    borrowers.append(borrower_position)
+                    position = future.result()
                 except Exception as exc:
                     print(f"An error occurred: {exc}")
+                    continue
+                self.lastLtv[position.address] = position.ltv
+                yield position
+
+    def topBorrowers(self, k, margin=None):
+        """The k positions with the highest LTV, highest first.
+
+        Borrowers are fetched by decreasing last known LTV and fetching stops once
+        none of the remaining ones can beat the k-th, assuming their LTV didn't rise
+        by more than margin (LTV_BOUND_MARGIN) since it was last read. Borrowers
+        never read are always fetched.
+        """
+        if k < 1:
+            raise ValueError(f"Number of top borrowers must be at least 1, got {k}")
+        margin = float(
+            margin if margin is not None else os.environ.get("LTV_BOUND_MARGIN", 0.05)
+        )
+        bounds = {
+            b: self.lastLtv[b] + margin if b in self.lastLtv else float("inf")
+            for b in self.blue.borrowers(self.id)
+        }
+        pending = iter(sorted(bounds, key=bounds.get, reverse=True))
+        heap = []
+        counter = itertools.count()
+        workers = int(os.environ.get("MAX_WORKERS", 10))
+
+        def beaten(borrower):
+            return len(heap) == k and bounds[borrower] <= heap[0][0]
+
+        with ContextThreadPoolExecutor(max_workers=workers) as executor:
+            running = set()
+            exhausted = False
+            while True:
+                while not exhausted and len(running) < workers:
+                    borrower = next(pending, None)
+                    if borrower is None or beaten(borrower):
+                        exhausted = True
+                        break
+                    running.add(executor.submit(self.position, borrower))
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        position = future.result()
+                    except Exception as exc:
+                        print(f"An error occurred: {exc}")
+                        continue
+                    self.lastLtv[position.address] = position.ltv
+                    item = (position.ltv, next(counter), position)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+        return [p for _, _, p in sorted(heap, reverse=True)]
 
-        # Sort the borrowers by LTV in reverse order
-        return sorted(borrowers, key=lambda p: p.ltv, reverse=True)
+    def borrowers(self):
+        """PositionTable of the borrowers sorted by LTV in reverse order"""
+        return PositionTable.fromPositions(self.streamBorrowers()).sortedBy("ltv")
+
+
+def top_borrowers(markets, k):
+    """Yield (market, top k positions) as each market completes, then
+    (None, top k (market, position) across the markets)
+    """
+    best = []
+    with ContextThreadPoolExecutor(
+        max_workers=os.environ.get("MAX_WORKERS", 10)
+    ) as executor:
+        futures = {executor.submit(m.topBorrowers, k): m for m in markets}
+        for future in as_completed(futures):
+            positions = future.result()
+            best = heapq.nlargest(
+                k,
+                best + [(futures[future], p) for p in positions],
+                key=lambda x: x[1].ltv,
+            )
+            yield futures[future], positions
+    yield None, best
@@ -0,0 +1,45 @@
+import json
+import os
+
+from .codec import checksum
+
+MULTICALL3 = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+
+class Multicall:
+    """Aggregate many eth_call into one through the Multicall3 contract"""
+
+    def __init__(self, web3, address=None):
+        self.web3 = web3
+        self.address = web3.to_checksum_address(
+            address or os.environ.get("MULTICALL3") or MULTICALL3
+        )
+        self.contract = web3.eth.contract(
+            address=self.address, abi=json.load(open("abis/multicall3.json"))
+        )
+        self.batchSize = int(os.environ.get("MULTICALL_BATCH", 500))
+
+    def call(self, calls, block="latest"):
+        """Execute the (target, calldata) calls at the given block, returns a list of
+        (success, returnData). Failing calls don't make the whole batch revert.
+        """
+        results = []
+        for start in range(0, len(calls), self.batchSize):
+            batch = [
+                (checksum(target), True, data)
+                for target, data in calls[start : start + self.batchSize]
+            ]
+            results += self.contract.functions.aggregate3(batch).call(
+                block_identifier=block
+            )
+        return results
+
+
+_multicalls = {}
+
+
+def multicall(web3) -> Multicall:
+    key = id(web3)
+    if key not in _multicalls:
+        _multicalls[key] = Multicall(web3)
+    return _multicalls[key]
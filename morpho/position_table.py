@@ -0,0 +1,168 @@
+import csv
+from dataclasses import dataclass
+import json
+import math
+
+import numpy as np
+
+from .codec import checksum
+
+
+@dataclass(frozen=True, slots=True)
+class Position:
+    address: str
+    supplyShares: float
+    supplyAssets: float
+    borrowShares: float
+    borrowAssets: float
+    collateral: float
+    collateralValue: float
+    collateralPrice: float
+    ltv: float
+    healthRatio: float
+
+
+# One row per position, addresses as their 20 raw bytes (~92 bytes per position)
+POSITION_DTYPE = np.dtype(
+    [
+        ("address", "S20"),
+        ("supplyShares", "f8"),
+        ("supplyAssets", "f8"),
+        ("borrowShares", "f8"),
+        ("borrowAssets", "f8"),
+        ("collateral", "f8"),
+        ("collateralValue", "f8"),
+        ("collateralPrice", "f8"),
+        ("ltv", "f8"),
+        ("healthRatio", "f8"),
+    ]
+)
+FIELDS = POSITION_DTYPE.names
+
+
+def _exported(row) -> tuple:
+    """Row values with the infinite ltv (debt without collateral) and health ratio
+    (no debt) as None, written as null in JSON and an empty CSV cell
+    """
+    return tuple(
+        None if isinstance(v, float) and not math.isfinite(v) else v for v in row
+    )
+
+
+def _address(raw: bytes) -> str:
+    # numpy strips the trailing zero bytes of "S" values
+    return checksum("0x" + raw.ljust(20, b"\0").hex())
+
+
+class PositionTable:
+    """Columnar positions backed by a NumPy structured array.
+
+    Columns (e.g. `table.ltv`) and slices are views on the array, sorting and
+    filtering are vectorized. Rows are materialized as Position only when indexed
+    or iterated.
+    """
+
+    __slots__ = ("rows",)
+
+    def __init__(self, rows: np.ndarray):
+        self.rows = rows
+
+    @classmethod
+    def empty(cls, size: int = 0) -> "PositionTable":
+        return cls(np.zeros(size, dtype=POSITION_DTYPE))
+
+    @classmethod
+    def fromColumns(cls, addresses, **columns) -> "PositionTable":
+        """Table from the addresses and one sequence per field, missing ones are 0"""
+        table = cls.empty(len(addresses))
+        table.rows["address"] = [bytes.fromhex(a[2:]) for a in addresses]
+        for name, values in columns.items():
+            table.rows[name] = values
+        return table
+
+    @classmethod
+    def fromPositions(cls, positions) -> "PositionTable":
+        positions = list(positions)
+        return cls.fromColumns(
+            [p.address for p in positions],
+            **{f: [getattr(p, f) for p in positions] for f in FIELDS[1:]},
+        )
+
+    @classmethod
+    def concatenate(cls, tables) -> "PositionTable":
+        tables = list(tables)
+        if not tables:
+            return cls.empty()
+        return cls(np.concatenate([t.rows for t in tables]))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getattr__(self, name):
+        if name in FIELDS[1:]:
+            return self.rows[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._position(self.rows[key])
+        return PositionTable(self.rows[key])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self._position(row)
+
+    def _position(self, row) -> Position:
+        return Position(_address(row["address"]), *(float(row[f]) for f in FIELDS[1:]))
+
+    def addresses(self) -> list[str]:
+        return [_address(a) for a in self.rows["address"]]
+
+    def positions(self) -> list[Position]:
+        return list(self)
+
+    def order(self, field: str = "ltv", reverse: bool = True) -> np.ndarray:
+        """Indices sorting the table by field, highest first by default"""
+        order = np.argsort(self.rows[field], kind="stable")
+        return order[::-1] if reverse else order
+
+    def sortedBy(self, field: str = "ltv", reverse: bool = True) -> "PositionTable":
+        return PositionTable(self.rows[self.order(field, reverse)])
+
+    def top(self, k: int, field: str = "ltv") -> "PositionTable":
+        """The k rows with the highest field, highest first"""
+        if k >= len(self.rows):
+            return self.sortedBy(field)
+        values = self.rows[field]
+        best = np.argpartition(values, len(values) - k)[len(values) - k :]
+        return PositionTable(self.rows[best[np.argsort(values[best])[::-1]]])
+
+    def borrowing(self) -> "PositionTable":
+        return PositionTable(self.rows[self.rows["borrowAssets"] > 0])
+
+    def unhealthy(self, maxHealthRatio: float = 1.0) -> "PositionTable":
+        """Borrowing positions with a health ratio below maxHealthRatio"""
+        rows = self.rows
+        return PositionTable(
+            rows[(rows["borrowAssets"] > 0) & (rows["healthRatio"] < maxHealthRatio)]
+        )
+
+    def toCsv(self, file, header=True, **columns):
+        """Write the rows as CSV, columns are constant values prepended to each row
+        (e.g. market=name)
+        """
+        writer = csv.writer(file)
+        if header:
+            writer.writerow(tuple(columns) + FIELDS)
+        for address, row in zip(self.addresses(), self.rows.tolist()):
+            writer.writerow(tuple(columns.values()) + (address,) + _exported(row[1:]))
+
+    def toJsonLines(self, file, **columns):
+        for address, row in zip(self.addresses(), self.rows.tolist()):
+            file.write(
+                json.dumps(
+                    {**columns, **dict(zip(FIELDS, (address,) + _exported(row[1:])))},
+                    allow_nan=False,
+                )
+                + "\n"
+            )
@@ -0,0 +1,62 @@
+import threading
+
+from eth_utils import function_signature_to_4byte_selector
+
+from .blocks import block_head
+from .multicall import multicall
+
+PRICE_SELECTOR = function_signature_to_4byte_selector("price()")
+
+
+class OraclePriceCache:
+    """Oracle prices keyed by (oracle, block), shared by all the markets of the
+    process. Every registered oracle is read in a single multicall the first time a
+    price is asked for a new block, older blocks are dropped.
+    """
+
+    def __init__(self, web3):
+        self.web3 = web3
+        self.oracles = set()
+        self.block = None
+        self.prices = {}
+        self._lock = threading.Lock()
+
+    def register(self, oracle):
+        with self._lock:
+            self.oracles.add(oracle.lower())
+
+    def price(self, oracle, block=None) -> int:
+        """Raw oracle price (scaled by 1e36) at the block, latest by default"""
+        oracle = oracle.lower()
+        block = block if block is not None else block_head(self.web3).number()
+        with self._lock:
+            self.oracles.add(oracle)
+            if (oracle, block) not in self.prices:
+                self._refresh(block)
+            price = self.prices[(oracle, block)]
+        if price is None:
+            raise Exception(f"Oracle {oracle} price() reverted at block {block}")
+        return price
+
+    def _refresh(self, block):
+        oracles = sorted(self.oracles)
+        results = multicall(self.web3).call(
+            [(o, PRICE_SELECTOR) for o in oracles], block
+        )
+        if self.block is None or block > self.block:
+            self.prices = {}
+            self.block = block
+        for oracle, (success, data) in zip(oracles, results):
+            self.prices[(oracle, block)] = (
+                int.from_bytes(data, "big") if success else None
+            )
+
+
+_caches = {}
+
+
+def oracle_price_cache(web3) -> OraclePriceCache:
+    key = id(web3)
+    if key not in _caches:
+        _caches[key] = OraclePriceCache(web3)
+    return _caches[key]
@@ -0,0 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+import os
+
+from .blocks import block_head
+from .mathlib import (
+    MAX_UINT256,
+    WAD,
+    toAssetsDown,
+    toSharesDown,
+    toSharesUp,
+    zeroFloorSub,
+)
+from .morphoblue import MaketParams
+from .utils import rate_from_target
+
+
+@dataclass(frozen=True)
+class MarketSnapshot:
+    """State of a vault market as seen by MetaMorpho.reallocate (raw uint values)"""
+
+    id: str
+    name: str
+    totalSupplyAssets: int
+    totalSupplyShares: int
+    totalBorrowAssets: int
+    totalBorrowShares: int
+    fee: int
+    vaultSupplyShares: int
+    cap: int
+    enabled: bool
+    rateAtTarget: float
+    idle: bool = False
+
+    @property
+    def vaultSupplyAssets(self) -> int:
+        return toAssetsDown(
+            self.vaultSupplyShares, self.totalSupplyAssets, self.totalSupplyShares
+        )
+
+    @property
+    def liquidity(self) -> int:
+        return zeroFloorSub(self.totalSupplyAssets, self.totalBorrowAssets)
+
+    @property
+    def utilization(self) -> float:
+        if self.totalSupplyAssets == 0:
+            return 0.0
+        return self.totalBorrowAssets / self.totalSupplyAssets
+
+    @property
+    def borrowRate(self) -> float:
+        if self.idle:
+            return 0.0
+        return rate_from_target(self.rateAtTarget, self.utilization)
+
+    @property
+    def supplyRate(self) -> float:
+        return self.borrowRate * self.utilization * (1 - self.fee / WAD)
+
+
+@dataclass(frozen=True)
+class VaultSnapshot:
+    """Markets of a MetaMorpho vault at a given block, keyed by market id"""
+
+    address: str
+    block: int
+    assetFactor: int
+    markets: dict[str, MarketSnapshot]
+
+    @property
+    def totalAssets(self) -> int:
+        return sum(m.vaultSupplyAssets for m in self.markets.values())
+
+    def __repr__(self) -> str:
+        return "\n".join(
+            f"{m.name}: exposure {m.vaultSupplyAssets / self.assetFactor:,.0f} "
+            f"util: {m.utilization*100:.2f}% rates: {m.supplyRate*100:.2f}%/{m.borrowRate*100:.2f}%"
+            for m in self.markets.values()
+        )
+
+
+@dataclass(frozen=True)
+class ReallocationFailure:
+    """Step of a reallocation that would make the transaction revert"""
+
+    step: int
+    marketId: str
+    name: str
+    reason: str
+
+    def __repr__(self) -> str:
+        return f"step {self.step} ({self.name}) reverts: {self.reason}"
+
+
+@dataclass(frozen=True)
+class ReallocationResult:
+    before: VaultSnapshot
+    after: VaultSnapshot
+    totalWithdrawn: int
+    totalSupplied: int
+    failure: ReallocationFailure | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.failure is None
+
+    def __repr__(self) -> str:
+        if not self.ok:
+            return f"Reallocation fails at {self.failure}"
+        lines = []
+        for id, after in self.after.markets.items():
+            before = self.before.markets[id]
+            if before == after:
+                continue
+            lines.append(
+                f"{after.name}: {before.vaultSupplyAssets / self.after.assetFactor:,.0f} -> "
+                f"{after.vaultSupplyAssets / self.after.assetFactor:,.0f} "
+                f"util: {before.utilization*100:.2f}% -> {after.utilization*100:.2f}% "
+                f"borrow rate: {before.borrowRate*100:.2f}% -> {after.borrowRate*100:.2f}%"
+            )
+        lines.append(
+            f"Moved {self.totalWithdrawn / self.after.assetFactor:,.0f}, "
+            f"vault rate {vaultRate(self.before)*100:.2f}% -> {vaultRate(self.after)*100:.2f}%"
+        )
+        return "\n".join(lines)
+
+
+def vaultRate(snapshot: VaultSnapshot) -> float:
+    """Supply rate of the vault weighted by its exposure on each market"""
+    totalAssets = snapshot.totalAssets
+    if totalAssets == 0:
+        return 0.0
+    return (
+        sum(m.supplyRate * m.vaultSupplyAssets for m in snapshot.markets.values())
+        / totalAssets
+    )
+
+
+def _marketId(marketParams) -> str:
+    if isinstance(marketParams, MaketParams):
+        return marketParams.id()
+    if isinstance(marketParams, str):
+        return marketParams.lower()
+    return MaketParams(*marketParams).id()
+
+
+def simulate_reallocation(
+    snapshot: VaultSnapshot, allocations: list[tuple]
+) -> ReallocationResult:
+    """Apply a list of (marketParams, assets) allocations the way MetaMorpho.reallocate
+    does: withdraw when the target is below the current supply, supply otherwise, with
+    MAX_UINT256 supplying whatever has been withdrawn and not yet supplied.
+    marketParams can be a MaketParams, a tuple or a market id.
+    """
+    markets = dict(snapshot.markets)
+    totalWithdrawn = 0
+    totalSupplied = 0
+
+    def result(failure=None):
+        return ReallocationResult(
+            snapshot,
+            replace(snapshot, markets=markets),
+            totalWithdrawn,
+            totalSupplied,
+            failure,
+        )
+
+    for step, (marketParams, assets) in enumerate(allocations):
+        id = _marketId(marketParams)
+        m = markets.get(id)
+        if m is None:
+            m = MarketSnapshot(id, id, 0, 0, 0, 0, 0, 0, 0, False, 0.0)
+        assets = int(assets)
+        supplyAssets = m.vaultSupplyAssets
+        withdrawn = zeroFloorSub(supplyAssets, assets)
+
+        if withdrawn > 0:
+            if not m.enabled:
+                return result(ReallocationFailure(step, id, m.name, "MarketNotEnabled"))
+            # assets == 0 withdraws all the shares, rounding in favor of Morpho
+            if assets == 0:
+                shares = m.vaultSupplyShares
+                withdrawn = toAssetsDown(
+                    shares, m.totalSupplyAssets, m.totalSupplyShares
+                )
+            else:
+                shares = toSharesUp(withdrawn, m.totalSupplyAssets, m.totalSupplyShares)
+            if shares > m.vaultSupplyShares:
+                return result(
+                    ReallocationFailure(step, id, m.name, "Not enough supply shares")
+                )
+            if m.totalSupplyAssets - withdrawn < m.totalBorrowAssets:
+                return result(
+                    ReallocationFailure(step, id, m.name, "insufficient liquidity")
+                )
+            markets[id] = replace(
+                m,
+                totalSupplyAssets=m.totalSupplyAssets - withdrawn,
+                totalSupplyShares=m.totalSupplyShares - shares,
+                vaultSupplyShares=m.vaultSupplyShares - shares,
+            )
+            totalWithdrawn += withdrawn
+        else:
+            if assets == MAX_UINT256:
+                suppliedAssets = zeroFloorSub(totalWithdrawn, totalSupplied)
+            else:
+                suppliedAssets = zeroFloorSub(assets, supplyAssets)
+            if suppliedAssets == 0:
+                continue
+            if m.cap == 0:
+                return result(
+                    ReallocationFailure(step, id, m.name, "UnauthorizedMarket")
+                )
+            if supplyAssets + suppliedAssets > m.cap:
+                return result(
+                    ReallocationFailure(step, id, m.name, "SupplyCapExceeded")
+                )
+            shares = toSharesDown(
+                suppliedAssets, m.totalSupplyAssets, m.totalSupplyShares
+            )
+            markets[id] = replace(
+                m,
+                totalSupplyAssets=m.totalSupplyAssets + suppliedAssets,
+                totalSupplyShares=m.totalSupplyShares + shares,
+                vaultSupplyShares=m.vaultSupplyShares + shares,
+            )
+            totalSupplied += suppliedAssets
+
+    if totalWithdrawn != totalSupplied:
+        return result(
+            ReallocationFailure(
+                len(allocations), "", "all markets", "InconsistentReallocation"
+            )
+        )
+    return result()
+
+
+def vault_snapshot(vault) -> VaultSnapshot:
+    """Read the state of every market of a MetaMorpho vault, all at the block of the
+    block head policy
+    """
+    block = block_head(vault.web3).number()
+
+    def fetch(market):
+        (
+            totalSupplyAssets,
+            totalSupplyShares,
+            totalBorrowAssets,
+            totalBorrowShares,
+            fee,
+            *_,
+        ) = market._marketData(block)
+        vaultSupplyShares = market.blue.position(market.id, vault.address, block)[0]
+        cap, enabled, _ = vault.contract.functions.config(market.id).call(
+            block_identifier=block
+        )
+        return MarketSnapshot(
+            market.id,
+            market.name(),
+            totalSupplyAssets,
+            totalSupplyShares,
+            totalBorrowAssets,
+            totalBorrowShares,
+            fee,
+            vaultSupplyShares,
+            cap,
+            enabled,
+            (
+                0.0
+                if market.isIdleMarket()
+                else market.marketData(block).borrowRateAtTarget
+            ),
+            market.isIdleMarket(),
+        )
+
+    with ThreadPoolExecutor(max_workers=os.environ.get("MAX_WORKERS", 10)) as executor:
+        snapshots = list(executor.map(fetch, vault.markets))
+    return VaultSnapshot(
+        vault.address, block, vault.assetFactor, {m.id: m for m in snapshots}
+    )
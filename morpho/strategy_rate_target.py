@@ -0,0 +1,77 @@
+from morpho.reallocation_strategy import Allocation, ReallocationStrategy
+from morpho.utils import rate_from_target, utilizationForRate
+
+MAX_UTILIZATION_TARGET = 0.995
+
+
+class StrategyRateTarget(ReallocationStrategy):
+    """Strategy that keeps the borrow rate of markets between a min and a max rate,
+    as the steakUSDC reallocation: liquidity is removed from the markets below
+    their min rate and added to the ones above their max rate, scaled down when not
+    enough is available. The overflow market (by collateral symbol) gives all its
+    liquidity when needed and receives what isn't, without it nothing more than
+    needed is removed. Rates are keyed by collateral symbol.
+    """
+
+    def __init__(
+        self,
+        minRate: dict[str, float],
+        maxRate: dict[str, float],
+        overflow: str | None = None,
+        minAllocation: float = 100000,
+    ):
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.overflow = overflow
+        self.minAllocation = minAllocation
+
+    def reallocate(self, allocation: Allocation) -> Allocation:
+        deltas = [0.0] * len(allocation.items)
+        overflow = None
+        available = 0.0
+        needed = 0.0
+        for idx, item in enumerate(allocation.items):
+            symbol = item.market.collateralTokenSymbol
+            if symbol == self.overflow:
+                overflow = idx
+                continue
+            rate = rate_from_target(item.rate_u_target, item.utilization)
+            if symbol in self.minRate and rate < self.minRate[symbol]:
+                utilization = min(
+                    MAX_UTILIZATION_TARGET,
+                    utilizationForRate(item.rate_u_target, self.minRate[symbol]),
+                )
+                target = item.borrow / utilization if utilization > 0 else 0
+                remove = min(item.exposure, item.supply - target)
+                if remove > 0:
+                    deltas[idx] = -remove
+                    available += remove
+            elif symbol in self.maxRate and rate > self.maxRate[symbol]:
+                utilization = utilizationForRate(
+                    item.rate_u_target, self.maxRate[symbol]
+                )
+                target = (
+                    item.borrow / utilization
+                    if utilization > 0
+                    else item.borrow + self.minAllocation
+                )
+                if target > item.supply:
+                    deltas[idx] = target - item.supply
+                    needed += target - item.supply
+
+        if overflow is not None and available < needed:
+            liquidity = allocation.items[overflow].liquidity
+            deltas[overflow] = -liquidity
+            available += liquidity
+
+        # Scale down the needs, or without overflow market the removals
+        if needed > available:
+            deltas = [d * available / needed if d > 0 else d for d in deltas]
+        elif overflow is not None:
+            deltas[overflow] += available - needed
+        elif available > 0:
+            deltas = [d * needed / available if d < 0 else d for d in deltas]
+
+        return Allocation(
+            [item.copy(delta) for item, delta in zip(allocation.items, deltas)]
+        )
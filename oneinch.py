@@ -1,37 +1,234 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import math
 import os
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # load_dotenv()
 # response = requests.get('https://api.1inch.dev/swap/v5.2/1/tokens', headers= headers)
 # print(response.content)
 
+API_URL = "https://api.1inch.dev/swap/v5.2/1"
+
+
+def _dstAmount(result):
+    """Output amount of a swap response (v5 uses toAmount, v6 dstAmount)"""
+    return int(result.get("dstAmount", result.get("toAmount", 0)))
+
+
+class QuoteService:
+    """Client of the 1inch swap API with a pooled session, a short lived cache and
+    concurrent prefetching. Rates are cached by (src, dst, amount bucket) so close
+    amounts share a quote, swap calldata is only reused for the exact same request.
+    """
+
+    def __init__(
+        self,
+        apiUrl=None,
+        apiKey=None,
+        ttl=None,
+        timeout=None,
+        retries=None,
+        bucketWidth=0.01,
+    ):
+        self.apiUrl = apiUrl or os.environ.get("1INCH_API_URL") or API_URL
+        self.apiKey = apiKey if apiKey is not None else os.environ.get("1INCH_KEY")
+        self.ttl = float(ttl or os.environ.get("1INCH_CACHE_TTL", 10))
+        self.timeout = float(timeout or os.environ.get("1INCH_TIMEOUT", 3))
+        self.bucketWidth = bucketWidth
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        retries = int(
+            retries if retries is not None else os.environ.get("1INCH_RETRIES", 2)
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=int(os.environ.get("MAX_WORKERS", 10)),
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.2,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        headers = {"accept": "application/json"}
+        if self.apiKey:
+            headers["Authorization"] = "Bearer " + self.apiKey
+        self.session.headers.update(headers)
+
+    @property
+    def enabled(self) -> bool:
+        """The public API needs a key, a custom url (e.g. the stand-in) doesn't"""
+        return bool(self.apiKey) or self.apiUrl != API_URL
+
+    def _bucket(self, amount):
+        return int(math.log(max(int(amount), 1)) / math.log(1 + self.bucketWidth))
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and time.time() < entry[0] + self.ttl:
+            return entry[1]
+        return None
+
+    def _put(self, key, value):
+        with self._lock:
+            self._cache[key] = (time.time(), value)
+
+    def swap(self, src, dst, amount, fromWallet, slippage=1):
+        """Swap response (with tx calldata) for the exact amount"""
+        exact = ("swap", src.lower(), dst.lower(), int(amount), fromWallet.lower())
+        result = self._get(exact)
+        if result is not None:
+            return result
+        params = {
+            "src": src,
+            "dst": dst,
+            "amount": f"{amount:.0f}",
+            "from": fromWallet,
+            "slippage": slippage,
+            "disableEstimate": "true",
+            "allowPartialFill": "false",
+            "includeTokensInfo": "true",
+            "compatibility": "true",
+        }
+        response = self.session.get(
+            self.apiUrl + "/swap", params=params, timeout=self.timeout
+        )
+        response.raise_for_status()
+        result = response.json()
+        self._put(exact, result)
+        self._put(
+            ("rate", src.lower(), dst.lower(), self._bucket(amount)),
+            _dstAmount(result) / int(amount),
+        )
+        return result
+
+    def rate(self, src, dst, amount):
+        """Raw dst units received per raw src unit for an amount close to amount"""
+        key = ("rate", src.lower(), dst.lower(), self._bucket(amount))
+        rate = self._get(key)
+        if rate is not None:
+            return rate
+        response = self.session.get(
+            self.apiUrl + "/quote",
+            params={"src": src, "dst": dst, "amount": f"{amount:.0f}"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        rate = _dstAmount(response.json()) / int(amount)
+        self._put(key, rate)
+        return rate
+
+    def _swapRate(self, src, dst, amount, fromWallet):
+        return _dstAmount(self.swap(src, dst, amount, fromWallet)) / int(amount)
+
+    def prefetch(self, quotes, budget=None, swaps=()):
+        """Fetch concurrently the rates of (src, dst, amount) tuples and return the
+        ones available within the time budget (seconds), keyed by the tuple.
+        swaps are (src, dst, amount, fromWallet) tuples fetched with their swap
+        calldata, cached for a swap() of the same amount, their rate is keyed by
+        (src, dst, amount) as well.
+        """
+        budget = float(budget or os.environ.get("1INCH_PREFETCH_BUDGET", 5))
+        executor = ThreadPoolExecutor(max_workers=os.environ.get("MAX_WORKERS", 10))
+        futures = {executor.submit(self.rate, *q): q for q in set(quotes)}
+        for s in set(swaps):
+            futures[executor.submit(self._swapRate, *s)] = s[:3]
+        done, _ = wait(futures, timeout=budget)
+        executor.shutdown(wait=False, cancel_futures=True)
+        rates = {}
+        for future in done:
+            if future.exception() is None:
+                rates[futures[future]] = future.result()
+        return rates
+
+
+_service = None
+
+
+def quote_service() -> QuoteService:
+    global _service
+    if _service is None:
+        _service = QuoteService()
+    return _service
+
 
 def swapData(fromToken, toToken, amount, fromWallet):
-    apiUrl = "https://api.1inch.dev/swap/v5.2/1/swap"
-
-    headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + os.environ.get("1INCH_KEY"),
-    }
-
-    print(str(amount))
-
-    params = {
-        "src": fromToken,
-        "dst": toToken,
-        "amount": f"{amount:.0f}",
-        "from": fromWallet,
-        "slippage": 1,
-        "disableEstimate": "true",
-        "allowPartialFill": "false",
-        "includeTokensInfo": "true",
-        "compatibility": "true",
-    }
-    print(params)
-    response = requests.get(apiUrl, headers=headers, params=params)
-
-    print(response.json())
-    return response
-
-
-# swapData("0x7f39c581f595b53c5cb19bd0b3f8da6c935e2ca0","0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48", 10*pow(10, 18), "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48")
+    return quote_service().swap(fromToken, toToken, amount, fromWallet)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Mimic the 1inch /quote and /swap endpoints, the rates are raw dst units per
+    raw src unit keyed by (src, dst) in lower case, defaulting to 1.
+    """
+
+    rates = {}
+    latency = 0.0
+    router = "0x1111111254eeb25477b68fb85ed929f73a960582"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.rstrip("/").split("/")[-1] not in ("quote", "swap"):
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        src, dst = query.get("src", "").lower(), query.get("dst", "").lower()
+        amount = int(query.get("amount", "0"))
+        toAmount = int(amount * self.rates.get((src, dst), 1))
+        result = {"toAmount": str(toAmount), "dstAmount": str(toAmount)}
+        if url.path.endswith("swap"):
+            result["tx"] = {
+                "from": query.get("from"),
+                "to": self.router,
+                "data": "0x12aa3caf" + f"{amount:064x}{toAmount:064x}",
+                "value": "0",
+                "gas": 0,
+            }
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(port=0, rates=None, latency=0.0):
+    """Start the stand-in server in a background thread, returns (server, url)"""
+    handler = type(
+        "Handler",
+        (StandInHandler,),
+        {"rates": rates or {}, "latency": latency},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    # python oneinch.py [port] [latency] to run the stand-in, then set 1INCH_API_URL
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server, url = start_standin(port, latency=latency)
+    print(f"1inch stand-in listening on {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
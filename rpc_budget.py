@@ -0,0 +1,137 @@
+"""RPC call budgets of the core commands, checked against a synthetic chain.
+
+    python rpc_budget.py                  # default grid of vault sizes
+    python rpc_budget.py <markets> <borrowers>
+
+Each command runs against utils.synthetic_chain with a vault of N borrow markets
+(plus the idle market) and M borrowers per market. The JSON-RPC calls and the round
+trips (requests on the critical path, see SyntheticChain.roundTrips) must stay
+under budgets written as functions of N, M and MAX_WORKERS, the script exits with 1
+when one is exceeded.
+"""
+
+from contextlib import redirect_stdout
+import io
+import math
+import os
+import sys
+import tempfile
+
+# Keep the token and vault caches of the synthetic chains out of data/
+os.environ["MORPHO_CACHE_DIR"] = tempfile.mkdtemp(prefix="morpho-budget-")
+# The synthetic chain doesn't move, the block number is read once per web3
+os.environ["BLOCK_POLL_INTERVAL"] = "3600"
+
+from web3 import Web3  # noqa: E402
+
+from morpho import MetaMorpho  # noqa: E402
+from utils.middleware import chain_id_middleware  # noqa: E402
+from utils.synthetic_chain import SyntheticChain, SyntheticProvider  # noqa: E402
+
+LATENCY = 0.01  # seconds per request, so that worker threads overlap as on a node
+WORKERS = int(os.environ.get("MAX_WORKERS", 10))
+
+# Web3 instances are kept alive, the process wide caches are keyed by id(web3)
+_web3s = []
+
+
+def rounds(n):
+    """Round trips of n parallel requests on the thread pool, tasks aren't evenly
+    spread so a worker may pick up to 20% more tasks than its share, plus one
+    """
+    if n <= WORKERS:
+        return 1 if n else 0
+    return math.ceil(1.2 * n / WORKERS) + 1
+
+
+# command -> (calls budget, round trips budget) as functions of (N, M)
+BUDGETS = {
+    # eth_chainId, MORPHO, symbol, name, asset, decimals, symbol, withdrawQueueLength,
+    # then for each market withdrawQueue, idToMarketParams, collateral decimals and
+    # symbol
+    "open (cold)": (
+        lambda n, m: 7 + 4 * (n + 1) + 1,
+        lambda n, m: 8 + 4 * rounds(n + 1),
+    ),
+    # eth_chainId, withdrawQueueLength, then withdrawQueue and idToMarketParams per
+    # market
+    "open (warm)": (
+        lambda n, m: 1 + 2 * (n + 1) + 1,
+        lambda n, m: 2 + 2 * rounds(n + 1),
+    ),
+    # totalAssets, block number, position and market data per market
+    "summary": (
+        lambda n, m: 2 + 2 * (n + 1),
+        lambda n, m: 3 + 2 * rounds(n) + 2,
+    ),
+    # market data is cached for the block, only positions are read again
+    "summary (same block)": (
+        lambda n, m: 1 + (n + 1),
+        lambda n, m: 1 + rounds(n) + 1,
+    ),
+    # One eth_getLogs of the Borrow events, the block number if not read yet, then a
+    # position per borrower
+    "borrowers": (
+        lambda n, m: 2 + m,
+        lambda n, m: 2 + rounds(m),
+    ),
+    # The borrowers are known up to the block head, only the positions are read
+    "borrowers (same block)": (
+        lambda n, m: m,
+        lambda n, m: rounds(m),
+    ),
+}
+
+
+def measure(chain, fnct):
+    chain.resetCounts()
+    with redirect_stdout(io.StringIO()):
+        result = fnct()
+    return result, chain.requests, chain.roundTrips(), dict(chain.methods)
+
+
+def run(n, m, seed):
+    chain = SyntheticChain(markets=n, borrowers=m, seed=seed, latency=LATENCY)
+    os.environ["MORPHO_READER"] = chain.reader
+
+    def web3():
+        # Same middlewares as the CLI
+        w3 = Web3(SyntheticProvider(chain))
+        w3.middleware_onion.add(chain_id_middleware, name="chain_id")
+        _web3s.append(w3)
+        return w3
+
+    results = {}
+    vault, *results["open (cold)"] = measure(
+        chain, lambda: MetaMorpho(web3(), chain.vault)
+    )
+    _, *results["open (warm)"] = measure(chain, lambda: MetaMorpho(web3(), chain.vault))
+    _, *results["summary"] = measure(chain, vault.summary)
+    _, *results["summary (same block)"] = measure(chain, vault.summary)
+    market = next(vault.getBorrowMarkets())
+    positions, *results["borrowers"] = measure(chain, market.borrowers)
+    if len(positions) != m:
+        raise Exception(f"borrowers returned {len(positions)} positions, {m} expected")
+    _, *results["borrowers (same block)"] = measure(chain, market.borrowers)
+
+    failed = False
+    for command, (calls, roundTrips, methods) in results.items():
+        callsBudget, roundTripsBudget = (b(n, m) for b in BUDGETS[command])
+        ok = calls <= callsBudget and roundTrips <= roundTripsBudget
+        failed = failed or not ok
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {command:<22} N={n:<4} M={m:<5} "
+            f"calls {calls:>5}/{callsBudget:<5} round trips {roundTrips:>4}/{roundTripsBudget}"
+        )
+        if not ok:
+            print(f"     {methods}")
+    return not failed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        sizes = [(int(sys.argv[1]), int(sys.argv[2]))]
+    else:
+        sizes = [(1, 1), (3, 10), (12, 25), (25, 60)]
+    ok = all([run(n, m, seed) for seed, (n, m) in enumerate(sizes)])
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,64 @@
+"""Run from the repository root (the ABIs are read from abis/): python -m pytest"""
+
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from morpho.log_decoder import LogDecoder
+
+ID = "0x" + "ab" * 32
+CALLER = "0x" + "11" * 20
+ON_BEHALF = "0x" + "22" * 20
+RECEIVER = "0x" + "33" * 20
+
+
+def word(value: int) -> str:
+    return f"{value:064x}"
+
+
+def raw_borrow(decoder, assets, shares, block):
+    """Borrow log as returned by a raw eth_getLogs (JSON-RPC dict of hex strings)"""
+    return {
+        "topics": [
+            decoder.topic("Borrow"),
+            ID,
+            "0x" + "00" * 12 + ON_BEHALF[2:],
+            "0x" + "00" * 12 + RECEIVER[2:],
+        ],
+        "data": "0x" + "00" * 12 + CALLER[2:] + word(assets) + word(shares),
+        "blockNumber": hex(block),
+        "logIndex": "0x0",
+    }
+
+
+def web3_borrow(decoder, assets, shares, block):
+    """The same log as a web3 get_logs entry: AttributeDict of HexBytes and ints"""
+    log = raw_borrow(decoder, assets, shares, block)
+    return AttributeDict(
+        {
+            "topics": [HexBytes(topic) for topic in log["topics"]],
+            "data": HexBytes(log["data"]),
+            "blockNumber": block,
+            "logIndex": 0,
+        }
+    )
+
+
+def test_decode_web3_log_entries():
+    decoder = LogDecoder()
+    logs = [web3_borrow(decoder, 10**18, 2 * 10**18, 100 + i) for i in range(3)]
+    borrows = decoder.decode(logs)["Borrow"]
+    assert len(borrows) == 3
+    assert borrows.blockNumber.tolist() == [100, 101, 102]
+    assert borrows.ints("assets") == [10**18] * 3
+    assert borrows.ints("shares") == [2 * 10**18] * 3
+    assert {a.lower() for a in borrows.addresses("onBehalf")} == {ON_BEHALF}
+    assert {a.lower() for a in borrows.addresses("caller")} == {CALLER}
+    assert borrows.hex("id") == [ID] * 3
+
+
+def test_web3_and_raw_logs_decode_the_same():
+    decoder = LogDecoder()
+    raw = decoder.decode([raw_borrow(decoder, 7, 9, 5)])["Borrow"]
+    entry = decoder.decode([web3_borrow(decoder, 7, 9, 5)])["Borrow"]
+    for field in raw.columns:
+        assert raw.columns[field].tolist() == entry.columns[field].tolist()
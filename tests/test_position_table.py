@@ -0,0 +1,31 @@
+import io
+import json
+
+from morpho.position_table import Position, PositionTable
+
+
+def test_json_lines_write_null_for_infinite_ratios():
+    table = PositionTable.fromPositions(
+        [
+            # Supply only: no debt, infinite health ratio
+            Position("0x" + "11" * 20, 1, 1, 0, 0, 0, 0, 0, 0, float("inf")),
+            # Debt without collateral: infinite LTV
+            Position("0x" + "22" * 20, 0, 0, 1, 1, 0, 0, 0, float("inf"), 0),
+        ]
+    )
+    file = io.StringIO()
+    table.toJsonLines(file, market="m")
+
+    def strict(constant):
+        raise ValueError(f"{constant} is not JSON")
+
+    rows = {
+        row["address"]: row
+        for row in (
+            json.loads(line, parse_constant=strict)
+            for line in file.getvalue().splitlines()
+        )
+    }
+    assert rows["0x" + "11" * 20]["healthRatio"] is None
+    assert rows["0x" + "22" * 20]["ltv"] is None
+    assert rows["0x" + "22" * 20]["healthRatio"] == 0
@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+import threading
+import time
+
+from web3 import Account, Web3
+
+from morpho.blocks import block_head
+
+
+@dataclass(frozen=True)
+class PreparedTransaction:
+    label: str
+    nonce: int
+    rawTransaction: bytes
+    hash: str
+
+
+@dataclass
+class Fees:
+    block: int
+    baseFee: int
+    priorityFee: int
+    gasPrice: int
+
+    def txFields(self, maxFee: int) -> dict:
+        """Fee fields for a transaction, EIP-1559 when the chain supports it"""
+        if self.baseFee is None:
+            return {"gasPrice": min(self.gasPrice, maxFee)}
+        return {
+            "maxPriorityFeePerGas": self.priorityFee,
+            "maxFeePerGas": max(
+                min(2 * self.baseFee + self.priorityFee, maxFee), self.priorityFee
+            ),
+        }
+
+    @property
+    def effectiveGasPrice(self) -> int:
+        if self.baseFee is None:
+            return self.gasPrice
+        return self.baseFee + self.priorityFee
+
+
+class TransactionPipeline:
+    """Sign and send transactions from one account without an RPC round trip per
+    nonce or gas price. Nonces are tracked locally so several transactions can be
+    sent back-to-back, fees are cached for the current block and receipts are
+    followed by a background thread (see waitForReceipts).
+    """
+
+    def __init__(self, web3, privateKey, maxGwei, log=print):
+        self.web3 = web3
+        self.account = Account.from_key(privateKey)
+        self.maxFee = Web3.to_wei(maxGwei, "gwei")
+        self.log = log
+        self._lock = threading.Lock()
+        self._nonce = None
+        self._fees = None
+        self._pending = {}
+        self._tracker = None
+        self.receipts = {}
+
+    @property
+    def address(self):
+        return self.account.address
+
+    def fees(self) -> Fees:
+        """Fees of the current block of the block head, read once per block"""
+        number = block_head(self.web3).number()
+        with self._lock:
+            if self._fees is not None and self._fees.block == number:
+                return self._fees
+        block = self.web3.eth.get_block(number)
+        baseFee = block.get("baseFeePerGas")
+        if baseFee is None:
+            priorityFee = None
+            gasPrice = self.web3.eth.generate_gas_price() or self.web3.eth.gas_price
+        else:
+            priorityFee = self.web3.eth.max_priority_fee
+            gasPrice = baseFee + priorityFee
+        fees = Fees(block.number, baseFee, priorityFee, gasPrice)
+        with self._lock:
+            self._fees = fees
+        return fees
+
+    def _nextNonce(self) -> int:
+        with self._lock:
+            if self._nonce is None:
+                self._nonce = self.web3.eth.get_transaction_count(
+                    self.address, "pending"
+                )
+            nonce = self._nonce
+            self._nonce += 1
+            return nonce
+
+    def resync(self):
+        """Forget the local nonce, the next transaction reads it from the node"""
+        with self._lock:
+            self._nonce = None
+
+    def build(self, fnct) -> dict:
+        """Build (and estimate the gas of) a contract call, the nonce is only set
+        when signing
+        """
+        fees = self.fees()
+        tx = fnct.build_transaction(
+            {"from": self.address, **fees.txFields(self.maxFee)}
+        )
+        tx.pop("nonce", None)
+        return tx
+
+    def sign(self, tx, label="") -> PreparedTransaction:
+        """Sign a built transaction, reserving the next nonce"""
+        tx["nonce"] = self._nextNonce()
+        signed = self.account.sign_transaction(tx)
+        return PreparedTransaction(
+            label, tx["nonce"], signed.rawTransaction, signed.hash.hex()
+        )
+
+    def prepare(self, fnct, label="") -> PreparedTransaction:
+        return self.sign(self.build(fnct), label)
+
+    def send(self, prepared: PreparedTransaction):
+        """Send a signed transaction if gas is below MAX_GWEI, returns its hash"""
+        fees = self.fees()
+        if fees.effectiveGasPrice >= self.maxFee:
+            self.log(f"gas price too high => {fees.effectiveGasPrice/pow(10,9):,.0f}")
+            # The nonce won't be used, later transactions have to reuse it
+            self.resync()
+            return None
+        self.log(f"gas prices => {fees.effectiveGasPrice/pow(10,9):,.0f}")
+        try:
+            txHash = self.web3.eth.send_raw_transaction(prepared.rawTransaction)
+        except Exception:
+            self.resync()
+            raise
+        self.log(f"Executed {prepared.label} with hash => {txHash.hex()}")
+        with self._lock:
+            self._pending[txHash.hex()] = prepared
+        self._startTracker()
+        return txHash
+
+    def submit(self, fnct, label=""):
+        return self.send(self.prepare(fnct, label))
+
+    def _tryBuild(self, fnct):
+        try:
+            return self.build(fnct)
+        except Exception as exc:
+            return exc
+
+    def submitMany(self, fncts):
+        """Build all (label, function) in parallel then sign and send them in order
+        with consecutive nonces so they can be included in the same block. A
+        transaction failing to build or send is reported and skipped (hash None),
+        the nonce is read again from the node so the next ones don't leave a gap.
+        """
+        with ThreadPoolExecutor(
+            max_workers=os.environ.get("MAX_WORKERS", 10)
+        ) as executor:
+            txs = list(executor.map(lambda f: self._tryBuild(f[1]), fncts))
+        hashes = []
+        for tx, (label, _) in zip(txs, fncts):
+            if isinstance(tx, Exception):
+                self.log(f"{label} not sent, build failed: {tx}")
+                hashes.append(None)
+                continue
+            try:
+                hashes.append(self.send(self.sign(tx, label)))
+            except Exception as exc:
+                self.resync()
+                self.log(f"{label} not sent: {exc}")
+                hashes.append(None)
+        return hashes
+
+    def _startTracker(self):
+        with self._lock:
+            # Cleared by the tracker under the lock when it has nothing left
+            if self._tracker is not None:
+                return
+            self._tracker = threading.Thread(target=self._trackReceipts, daemon=True)
+            self._tracker.start()
+
+    def _trackReceipts(self):
+        interval = float(os.environ.get("TX_RECEIPT_POLL", 2))
+        while True:
+            with self._lock:
+                pending = dict(self._pending)
+                if not pending:
+                    # A send() after this starts a new tracker
+                    self._tracker = None
+                    return
+            for txHash, prepared in pending.items():
+                try:
+                    receipt = self.web3.eth.get_transaction_receipt(txHash)
+                except Exception:
+                    continue
+                status = "succeeded" if receipt.status == 1 else "reverted"
+                self.log(
+                    f"{prepared.label} {txHash} {status} in block {receipt.blockNumber}"
+                )
+                with self._lock:
+                    self.receipts[txHash] = receipt
+                    del self._pending[txHash]
+            time.sleep(interval)
+
+    def waitForReceipts(self, timeout=120):
+        """Block until all sent transactions are mined or the timeout expires"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if not self._pending:
+                    return True
+            time.sleep(0.5)
+        return False
+
+
+_pipelines = {}
+
+
+def wait_for_receipts(timeout=120) -> bool:
+    """Wait for the receipts of the transactions sent by every pipeline, for the
+    one-shot runs which would exit before the receipt tracker
+    """
+    return all(p.waitForReceipts(timeout) for p in list(_pipelines.values()))
+
+
+def transaction_pipeline(web3, log=print) -> TransactionPipeline:
+    """Process wide pipeline for the PRIVATE_KEY account"""
+    key = id(web3)
+    if key not in _pipelines:
+        _pipelines[key] = TransactionPipeline(
+            web3, os.environ.get("PRIVATE_KEY"), int(os.environ.get("MAX_GWEI")), log
+        )
+    return _pipelines[key]
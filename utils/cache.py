@@ -1,15 +1,27 @@
 import json
 import os
+import threading
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
-token_cache_file_path = os.path.join(current_dir, "..", "data", "token_cache.json")
-morpho_cache_file_path = os.path.join(current_dir, "..", "data", "morpho_cache.json")
+
+def cache_file_path(name):
+    """MORPHO_CACHE_DIR allows to keep the caches of another chain (e.g. a test
+    node) apart, it is read on each access as .env may be loaded after the import
+    """
+    directory = os.environ.get("MORPHO_CACHE_DIR") or os.path.join(
+        current_dir, "..", "data"
+    )
+    return os.path.join(directory, name)
+
+
+# Markets are loaded in threads, don't lose an update between a load and a save
+_lock = threading.Lock()
 
 
 def load_tokens_cache():
     try:
-        with open(token_cache_file_path, "r") as file:
+        with open(cache_file_path("token_cache.json"), "r") as file:
             return json.load(file)
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
@@ -17,39 +29,43 @@ def load_tokens_cache():
 
 def load_morpho_cache():
     try:
-        with open(morpho_cache_file_path, "r") as file:
+        with open(cache_file_path("morpho_cache.json"), "r") as file:
             return json.load(file)
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
 
 def save_token_cache(cache):
-    with open(token_cache_file_path, "w") as file:
+    with open(cache_file_path("token_cache.json"), "w") as file:
         json.dump(cache, file)
 
 
 def save_morpho_cache(cache):
-    with open(morpho_cache_file_path, "w") as file:
+    with open(cache_file_path("morpho_cache.json"), "w") as file:
         json.dump(cache, file)
 
 
 def get_token_details(address):
-    cache = load_tokens_cache()
+    with _lock:
+        cache = load_tokens_cache()
     return cache.get(address)
 
 
 def get_morpho_details(address):
-    cache = load_morpho_cache()
+    with _lock:
+        cache = load_morpho_cache()
     return cache.get(address)
 
 
 def cache_token_details(address, details):
-    cache = load_tokens_cache()
-    cache[address] = details
-    save_token_cache(cache)
+    with _lock:
+        cache = load_tokens_cache()
+        cache[address] = details
+        save_token_cache(cache)
 
 
 def cache_morpho_details(address, details):
-    cache = load_morpho_cache()
-    cache[address] = details
-    save_morpho_cache(cache)
+    with _lock:
+        cache = load_morpho_cache()
+        cache[address] = details
+        save_morpho_cache(cache)
@@ -0,0 +1,22 @@
+import threading
+
+
+def chain_id_middleware(make_request, w3):
+    """Answer eth_chainId from memory after the first success. web3 validates every
+    eth_call with an eth_chainId request, and its simple cache is per thread.
+    """
+    lock = threading.Lock()
+    cached = {}
+
+    def middleware(method, params):
+        if method != "eth_chainId":
+            return make_request(method, params)
+        with lock:
+            if "response" not in cached:
+                response = make_request(method, params)
+                if "result" not in response:
+                    return response
+                cached["response"] = response
+            return cached["response"]
+
+    return middleware
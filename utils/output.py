@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+import io
+import sys
+
+_buffer = ContextVar("output_buffer", default=None)
+
+
+class _Router(io.TextIOBase):
+    """sys.stdout replacement writing to the buffer of the current context if any.
+    Threads started without the context print directly, inner thread pools use
+    ContextThreadPoolExecutor to print into the buffer of their caller.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = _buffer.get()
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        if _buffer.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor running each task in a copy of the context it is
+    submitted from, so the workers of a buffered command print into its buffer
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(copy_context().run, fn, *args, **kwargs)
+
+
+def install():
+    if not isinstance(sys.stdout, _Router):
+        sys.stdout = _Router(sys.stdout)
+
+
+@contextmanager
+def capture():
+    """Collect what is printed in this context into a StringIO"""
+    install()
+    buffer = io.StringIO()
+    token = _buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _buffer.reset(token)
+
+
+def _captured(fnct, args):
+    with capture() as buffer:
+        try:
+            fnct(*args)
+        except Exception as exc:
+            return buffer.getvalue(), exc
+    return buffer.getvalue(), None
+
+
+def run_buffered(tasks):
+    """Run the (fnct, args) tasks concurrently, each printing into its own buffer.
+    Returns the (output, exception) of each task in the order of the tasks.
+    """
+    install()
+    with ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as executor:
+        futures = [
+            executor.submit(copy_context().run, _captured, fnct, args)
+            for fnct, args in tasks
+        ]
+        return [future.result() for future in futures]
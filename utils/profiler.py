@@ -0,0 +1,212 @@
+from contextlib import contextmanager, nullcontext
+import datetime
+import os
+import sys
+import sysconfig
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+LIBRARIES = tuple(
+    os.path.abspath(sysconfig.get_paths()[p]) for p in ("purelib", "platlib", "stdlib")
+)
+
+# Path fragments of the frames spent waiting for the node, and encoding/decoding
+NETWORK = (
+    "/socket.py",
+    "/ssl.py",
+    "/http/client.py",
+    "/urllib3/",
+    "/requests/",
+    "/web3/providers/",
+)
+ABI = (
+    "/eth_abi/",
+    "/eth_utils/",
+    "/eth_hash/",
+    "/Crypto/Hash/",
+    "/hexbytes/",
+    "/web3/_utils/",
+    "/web3/contract/",
+    "/web3/middleware/",
+)
+
+# (file, function) at the top of a thread doing nothing, these samples are dropped
+IDLE = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+    ("socketserver.py", "serve_forever"),
+}
+
+
+def category(filename):
+    if any(p in filename for p in NETWORK):
+        return "network"
+    if any(p in filename for p in ABI):
+        return "abi"
+    if filename.startswith(ROOT) and not filename.startswith(LIBRARIES):
+        return "ours"
+    return None
+
+
+class SamplingProfiler:
+    """Sample the stacks of every thread each `interval` seconds.
+
+    Each sample is attributed to the innermost frame of a known category: network
+    (sockets, HTTP, web3 providers), abi (web3 and eth_abi encoding, decoding and
+    formatting) or ours (the repo), other otherwise. Idle threads are ignored.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = float(
+            interval or os.environ.get("MORPHO_PROFILE_INTERVAL", 0.005)
+        )
+        self.stacks = {}
+        self.duration = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+        self._labels = {}
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for prefix in LIBRARIES + (ROOT,):
+                if filename.startswith(prefix):
+                    filename = os.path.relpath(filename, prefix)
+                    break
+            label = (f"{filename}:{code.co_name}", category(code.co_filename))
+            self._labels[code] = label
+        return label
+
+    def _sample(self):
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format of flamegraph.pl and speedscope"""
+        return "".join(
+            ";".join(label for label, _ in stack) + f" {count}\n"
+            for stack, count in sorted(self.stacks.items())
+        )
+
+    def _category(self, stack):
+        for _, cat in reversed(stack):
+            if cat is not None:
+                return cat
+        return "other"
+
+    def categories(self) -> dict[str, int]:
+        """Samples by category"""
+        totals = {"network": 0, "abi": 0, "ours": 0, "other": 0}
+        for stack, count in self.stacks.items():
+            totals[self._category(stack)] += count
+        return totals
+
+    def top(self, n=20):
+        """Rows (function, category, self samples, total samples) of the n functions
+        with the most samples on top of the stack
+        """
+        own = {}
+        total = {}
+        categories = {}
+        for stack, count in self.stacks.items():
+            label, _ = stack[-1]
+            own[label] = own.get(label, 0) + count
+            categories[label] = self._category(stack)
+            for label in {label for label, _ in stack}:
+                total[label] = total.get(label, 0) + count
+        rows = sorted(own.items(), key=lambda x: x[1], reverse=True)[:n]
+        return [
+            (label, categories[label], count, total[label]) for label, count in rows
+        ]
+
+    def report(self, n=20) -> str:
+        samples = self.samples or 1
+        lines = [
+            f"{self.samples} samples in {self.duration:.2f}s, "
+            + ", ".join(
+                f"{cat} {count / samples * 100:.1f}%"
+                for cat, count in self.categories().items()
+            ),
+            f"{'self %':>7} {'total %':>7}  {'category':<8} function",
+        ]
+        for label, cat, own, total in self.top(n):
+            lines.append(
+                f"{own / samples * 100:>6.1f}% {total / samples * 100:>6.1f}%  {cat:<8} {label}"
+            )
+        return "\n".join(lines)
+
+
+def profile_directory():
+    """Directory of the profiles from MORPHO_PROFILE, None when profiling is off"""
+    value = os.environ.get("MORPHO_PROFILE", "").strip()
+    if value.lower() in ("", "0", "false", "no"):
+        return None
+    if value.lower() in ("1", "true", "yes"):
+        return "profiles"
+    return value
+
+
+@contextmanager
+def _profiled(name, directory, top):
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory,
+            f"{name}-{datetime.datetime.now():%Y%m%d-%H%M%S}.collapsed",
+        )
+        with open(path, "w") as file:
+            file.write(profiler.collapsed())
+        print(f"Profile of {name} written to {path}", file=sys.stderr)
+        print(profiler.report(top), file=sys.stderr)
+
+
+def profiled(name, top=None):
+    """Profile the block when MORPHO_PROFILE is set: write the collapsed stacks in
+    the profile directory and print the top functions and time by category
+    """
+    directory = profile_directory()
+    if directory is None:
+        return nullcontext()
+    return _profiled(
+        name, directory, int(top or os.environ.get("MORPHO_PROFILE_TOP", 20))
+    )
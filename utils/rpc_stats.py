@@ -0,0 +1,194 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_command = ContextVar("rpc_command", default=None)
+
+
+class MethodStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.latency = 0.0
+        self.maxLatency = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, latency, bytesOut, bytesIn, error):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.bytesOut += bytesOut
+        self.bytesIn += bytesIn
+        self.latency += latency
+        self.maxLatency = max(self.maxLatency, latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """Latency quantile estimated from the histogram (bucket upper bound)"""
+        rank = q * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return (
+                    LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.maxLatency
+                )
+        return 0.0
+
+
+class RpcStats:
+    """JSON-RPC calls, bytes, errors and latency by (command, method).
+    The command is the one set with command() in the current context, falling back
+    to the last command started in the process (thread pools don't copy contexts).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.activeCommand = "init"
+        self.methods = {}
+
+    @contextmanager
+    def command(self, name):
+        token = _command.set(name)
+        previous = self.activeCommand
+        self.activeCommand = name
+        try:
+            yield
+        finally:
+            self.activeCommand = previous
+            _command.reset(token)
+
+    def currentCommand(self):
+        return _command.get() or self.activeCommand
+
+    def record(self, method, latency, bytesOut, bytesIn, error):
+        key = (self.currentCommand(), method)
+        with self._lock:
+            if key not in self.methods:
+                self.methods[key] = MethodStats()
+            self.methods[key].record(latency, bytesOut, bytesIn, error)
+
+    def reset(self):
+        with self._lock:
+            self.methods = {}
+
+    def calls(self, command=None):
+        """Number of calls, for one command or all of them"""
+        with self._lock:
+            return sum(
+                s.calls
+                for (c, _), s in self.methods.items()
+                if command is None or c == command
+            )
+
+    def middleware(self, make_request, w3):
+        """web3 middleware, inject it as the innermost layer to see raw responses"""
+
+        def middleware(method, params):
+            bytesOut = len(json.dumps(params, default=str))
+            start = time.perf_counter()
+            try:
+                response = make_request(method, params)
+            except Exception:
+                self.record(method, time.perf_counter() - start, bytesOut, 0, True)
+                raise
+            latency = time.perf_counter() - start
+            bytesIn = len(json.dumps(response, default=str))
+            self.record(method, latency, bytesOut, bytesIn, "error" in response)
+            return response
+
+        return middleware
+
+    def table(self):
+        """Rows (command, method, calls, errors, kB, mean ms, p50 ms, p95 ms)"""
+        with self._lock:
+            items = sorted(self.methods.items())
+        return [
+            (
+                command,
+                method,
+                s.calls,
+                s.errors,
+                (s.bytesIn + s.bytesOut) / 1000,
+                s.latency / s.calls * 1000,
+                s.quantile(0.5) * 1000,
+                s.quantile(0.95) * 1000,
+            )
+            for (command, method), s in items
+        ]
+
+    def prometheus(self) -> str:
+        """Stats in the Prometheus text exposition format"""
+        with self._lock:
+            items = sorted(self.methods.items())
+        lines = [
+            "# HELP morpho_rpc_calls_total JSON-RPC calls",
+            "# TYPE morpho_rpc_calls_total counter",
+        ]
+        lines += [
+            f'morpho_rpc_calls_total{{command="{c}",method="{m}"}} {s.calls}'
+            for (c, m), s in items
+        ]
+        lines += [
+            "# HELP morpho_rpc_errors_total JSON-RPC calls failing",
+            "# TYPE morpho_rpc_errors_total counter",
+        ]
+        lines += [
+            f'morpho_rpc_errors_total{{command="{c}",method="{m}"}} {s.errors}'
+            for (c, m), s in items
+        ]
+        lines += [
+            "# HELP morpho_rpc_bytes_total JSON-RPC payload bytes",
+            "# TYPE morpho_rpc_bytes_total counter",
+        ]
+        for (c, m), s in items:
+            lines.append(
+                f'morpho_rpc_bytes_total{{command="{c}",method="{m}",direction="out"}} {s.bytesOut}'
+            )
+            lines.append(
+                f'morpho_rpc_bytes_total{{command="{c}",method="{m}",direction="in"}} {s.bytesIn}'
+            )
+        lines += [
+            "# HELP morpho_rpc_latency_seconds JSON-RPC call latency",
+            "# TYPE morpho_rpc_latency_seconds histogram",
+        ]
+        for (c, m), s in items:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), s.buckets):
+                cumulative += count
+                lines.append(
+                    f'morpho_rpc_latency_seconds_bucket{{command="{c}",method="{m}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'morpho_rpc_latency_seconds_sum{{command="{c}",method="{m}"}} {s.latency}'
+            )
+            lines.append(
+                f'morpho_rpc_latency_seconds_count{{command="{c}",method="{m}"}} {s.calls}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None):
+        """Write the Prometheus text file (RPC_STATS_FILE) if a path is set"""
+        path = path or os.environ.get("RPC_STATS_FILE")
+        if not path:
+            return
+        tmp = path + ".tmp"
+        with open(tmp, "w") as file:
+            file.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+# Stats of the process, shared by every web3 instance
+stats = RpcStats()
@@ -0,0 +1,539 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import os
+import threading
+import time
+
+from eth_abi import decode, encode
+from eth_utils import (
+    event_abi_to_log_topic,
+    function_abi_to_4byte_selector,
+    keccak,
+    to_checksum_address,
+)
+from eth_utils.abi import collapse_if_tuple
+from web3.providers.base import BaseProvider
+
+WAD = pow(10, 18)
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+MULTICALL3 = "0xcA11bde05977b3631167028862bE2a173976CA11"
+SECONDS_PER_YEAR = 365 * 24 * 3600
+
+# Contract kind -> abi file, a kind is attached to every synthetic address
+ABIS = {
+    "vault": "metamorpho.json",
+    "blue": "morphoblue.json",
+    "reader": "MorphoReader.json",
+    "erc20": "erc20.json",
+    "oracle": "oracle.json",
+    "irm": "irm.json",
+    "multicall": "multicall3.json",
+}
+
+
+class SyntheticError(Exception):
+    pass
+
+
+def _hex(value: int) -> str:
+    return hex(value)
+
+
+def _functions(abi):
+    """selector -> (name, input types, output types)"""
+    return {
+        function_abi_to_4byte_selector(f): (
+            f["name"],
+            [collapse_if_tuple(i) for i in f["inputs"]],
+            [collapse_if_tuple(o) for o in f.get("outputs", [])],
+        )
+        for f in abi
+        if f.get("type") == "function"
+    }
+
+
+class SyntheticChain:
+    """In memory Morpho Blue deployment with one MetaMorpho vault of `markets` borrow
+    markets (plus an idle market) and `borrowers` borrowers per market. It answers
+    the JSON-RPC calls made by the CLI (vault, Morpho Blue, reader, tokens, oracles,
+    IRM, Multicall3, CreateMarket and Borrow logs) and counts them, `latency`
+    seconds are slept per request to emulate a remote node. State doesn't change between blocks.
+
+    roundTrips() counts the requests on the critical path of a command run from the
+    thread that called resetCounts(): its own requests plus the longest sequence of
+    requests made by one of the worker threads.
+    """
+
+    def __init__(
+        self,
+        markets=5,
+        borrowers=20,
+        block=19_000_000,
+        seed=0,
+        latency=0.0,
+        abiDir="abis",
+    ):
+        self.seed = seed
+        self.latency = latency
+        self.blockNumber = block
+        self.timestamp = 1_700_000_000
+        self.chainId = 31337
+        self._lock = threading.Lock()
+        self._filters = {}
+        self._filterIds = itertools.count(1)
+        self.requests = 0
+        self.methods = {}
+        self.contractCalls = {}
+        self.threads = {}
+        self.caller = threading.get_ident()
+
+        self.abis = {}
+        self.functions = {}
+        for kind, file in ABIS.items():
+            self.abis[kind] = json.load(open(os.path.join(abiDir, file)))
+            self.functions[kind] = _functions(self.abis[kind])
+        self.borrowTopic = self._topic("Borrow")
+        self.createMarketTopic = self._topic("CreateMarket")
+
+        self.kinds = {}
+        self.vault = self._address("vault", "vault")
+        self.blue = self._address("blue", "blue")
+        self.reader = self._address("reader", "reader")
+        self.irm = self._address("irm", "irm")
+        self.multicall = to_checksum_address(MULTICALL3)
+        self.kinds[self.multicall.lower()] = "multicall"
+        self.loanToken = self._address("erc20", "loan")
+        self.tokens = {self.loanToken.lower(): (6, "sUSD")}
+        self.oracles = {}
+
+        self.params = {}
+        self.state = {}
+        self.positions = {}
+        self.caps = {}
+        self.logs = []
+        self.queue = []
+        self._addMarket(ZERO_ADDRESS, ZERO_ADDRESS, ZERO_ADDRESS, 0, 0, 0)
+        for i in range(markets):
+            collateral = self._address("erc20", f"collateral{i}")
+            self.tokens[collateral.lower()] = (18, f"COL{i}")
+            oracle = self._address("oracle", f"oracle{i}")
+            # 1 collateral = (i + 1) loan tokens, scaled by 1e36 * 10^(6 - 18)
+            self.oracles[oracle.lower()] = (i + 1) * pow(10, 24)
+            self._addMarket(
+                collateral, oracle, self.irm, 86 * pow(10, 16), i, borrowers
+            )
+
+    def _topic(self, event):
+        abi = next(e for e in self.abis["blue"] if e.get("name") == event)
+        return "0x" + event_abi_to_log_topic(abi).hex()
+
+    def _address(self, kind, label):
+        address = to_checksum_address(keccak(text=f"{self.seed}:{label}")[-20:])
+        self.kinds[address.lower()] = kind
+        return address
+
+    def _addMarket(self, collateral, oracle, irm, lltv, index, borrowers):
+        params = (self.loanToken, collateral, oracle, irm, lltv)
+        id = keccak(
+            encode(["address", "address", "address", "address", "uint256"], params)
+        )
+        self.params[id] = params
+        self.queue.append(id)
+        self.logs.append(
+            {
+                "address": self.blue,
+                "topics": [self.createMarketTopic, "0x" + id.hex()],
+                "data": "0x"
+                + encode(["(address,address,address,address,uint256)"], [params]).hex(),
+                "blockNumber": self.blockNumber - 2000 + index,
+            }
+        )
+        self.caps[id] = pow(10, 30)
+
+        supplyAssets = (index + 1) * 10_000_000 * pow(10, 6)
+        borrowAssets = 0 if irm == ZERO_ADDRESS else supplyAssets * 8 // 10
+        self.state[id] = [
+            supplyAssets,
+            supplyAssets * pow(10, 6),
+            borrowAssets,
+            borrowAssets * pow(10, 6),
+            self.timestamp,
+            0,
+        ]
+        # The vault supplies 30% of each market
+        self.positions[(id, self.vault.lower())] = [
+            supplyAssets * 3 * pow(10, 5),
+            0,
+            0,
+        ]
+        price = self.oracles.get(oracle.lower(), 0)
+        for j in range(borrowers):
+            borrower = to_checksum_address(
+                keccak(text=f"{self.seed}:borrower:{index}:{j}")[-20:]
+            )
+            borrowShares = borrowAssets * pow(10, 6) // borrowers
+            # LTV spread from 50% to 95% so some positions are liquidatable
+            ltv = 50 + 45 * j // max(borrowers - 1, 1)
+            debt = borrowAssets // borrowers
+            collateralAssets = debt * 100 * pow(10, 36) // (ltv * price) if price else 0
+            self.positions[(id, borrower.lower())] = [0, borrowShares, collateralAssets]
+            self.logs.append(
+                {
+                    "address": self.blue,
+                    "topics": [
+                        self.borrowTopic,
+                        "0x" + id.hex(),
+                        "0x" + bytes(12).hex() + borrower[2:].lower(),
+                        "0x" + bytes(12).hex() + borrower[2:].lower(),
+                    ],
+                    "data": "0x"
+                    + encode(
+                        ["address", "uint256", "uint256"],
+                        [borrower, debt, borrowShares],
+                    ).hex(),
+                    "blockNumber": self.blockNumber - 1000 + j % 1000,
+                }
+            )
+
+    def marketIds(self):
+        return ["0x" + id.hex() for id in self.queue]
+
+    def mine(self, blocks=1):
+        self.blockNumber += blocks
+        self.timestamp += 12 * blocks
+
+    # Accounting
+
+    def resetCounts(self):
+        with self._lock:
+            self.requests = 0
+            self.methods = {}
+            self.contractCalls = {}
+            self.threads = {}
+            self.caller = threading.get_ident()
+
+    def roundTrips(self) -> int:
+        with self._lock:
+            threads = dict(self.threads)
+        caller = threads.pop(self.caller, 0)
+        return caller + max(threads.values(), default=0)
+
+    def _count(self, counts, key):
+        counts[key] = counts.get(key, 0) + 1
+
+    # JSON-RPC
+
+    def rpc(self, request):
+        """Answer one JSON-RPC request (a dict) or a batch (a list) in one round trip"""
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(request, list):
+            response = [self._answer(r) for r in request]
+        else:
+            response = self._answer(request)
+        with self._lock:
+            self.requests += 1
+            self._count(self.threads, threading.get_ident())
+        return response
+
+    def _answer(self, request):
+        method = request.get("method")
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        with self._lock:
+            self._count(self.methods, method)
+        try:
+            response["result"] = self.request(method, request.get("params") or [])
+        except SyntheticError as exc:
+            response["error"] = {"code": -32000, "message": str(exc)}
+        return response
+
+    def request(self, method, params):
+        if method == "eth_chainId":
+            return _hex(self.chainId)
+        if method in ("net_version",):
+            return str(self.chainId)
+        if method == "web3_clientVersion":
+            return "synthetic/0.1"
+        if method == "eth_blockNumber":
+            return _hex(self.blockNumber)
+        if method == "eth_getBlockByNumber":
+            return self._block(params[0])
+        if method in ("eth_gasPrice", "eth_maxPriorityFeePerGas"):
+            return _hex(pow(10, 9))
+        if method == "eth_getTransactionCount":
+            return "0x0"
+        if method == "eth_call":
+            call = params[0]
+            success, data = self._call(call["to"], bytes.fromhex(call["data"][2:]))
+            if not success:
+                raise SyntheticError("execution reverted")
+            return "0x" + data.hex()
+        if method == "eth_getLogs":
+            return self._logs(params[0])
+        if method == "eth_newFilter":
+            with self._lock:
+                filterId = _hex(next(self._filterIds))
+                self._filters[filterId] = params[0]
+            return filterId
+        if method in ("eth_getFilterLogs", "eth_getFilterChanges"):
+            if params[0] not in self._filters:
+                raise SyntheticError("filter not found")
+            return self._logs(self._filters[params[0]])
+        if method == "eth_uninstallFilter":
+            return self._filters.pop(params[0], None) is not None
+        raise SyntheticError(f"method {method} not supported")
+
+    def _blockNumber(self, tag):
+        if tag in (None, "latest", "pending", "safe", "finalized"):
+            return self.blockNumber
+        if tag == "earliest":
+            return 0
+        return int(tag, 16) if isinstance(tag, str) else int(tag)
+
+    def _block(self, tag):
+        number = self._blockNumber(tag)
+        return {
+            "number": _hex(number),
+            "hash": "0x" + keccak(text=f"block:{number}").hex(),
+            "parentHash": "0x" + keccak(text=f"block:{number - 1}").hex(),
+            "timestamp": _hex(self.timestamp - 12 * (self.blockNumber - number)),
+            "baseFeePerGas": _hex(pow(10, 9)),
+            "gasLimit": _hex(30_000_000),
+            "gasUsed": "0x0",
+            "miner": ZERO_ADDRESS,
+            "difficulty": "0x0",
+            "extraData": "0x",
+            "transactions": [],
+        }
+
+    def _logs(self, filter):
+        fromBlock = self._blockNumber(filter.get("fromBlock", "earliest"))
+        toBlock = self._blockNumber(filter.get("toBlock", "latest"))
+        address = filter.get("address")
+        addresses = (
+            None
+            if address is None
+            else {
+                a.lower() for a in ([address] if isinstance(address, str) else address)
+            }
+        )
+        topics = filter.get("topics") or []
+        logs = []
+        for index, log in enumerate(self.logs):
+            if not fromBlock <= log["blockNumber"] <= toBlock:
+                continue
+            if addresses is not None and log["address"].lower() not in addresses:
+                continue
+            if any(
+                wanted is not None
+                and (
+                    i >= len(log["topics"])
+                    or log["topics"][i]
+                    not in ([wanted] if isinstance(wanted, str) else wanted)
+                )
+                for i, wanted in enumerate(topics)
+            ):
+                continue
+            logs.append(
+                {
+                    **log,
+                    "blockNumber": _hex(log["blockNumber"]),
+                    "blockHash": "0x"
+                    + keccak(text=f"block:{log['blockNumber']}").hex(),
+                    "transactionHash": "0x" + keccak(text=f"tx:{index}").hex(),
+                    "transactionIndex": "0x0",
+                    "logIndex": _hex(index),
+                    "removed": False,
+                }
+            )
+        return logs
+
+    # Contracts
+
+    def _call(self, to, data):
+        """(success, return data) of a call to one of the synthetic contracts"""
+        kind = self.kinds.get(to.lower())
+        function = self.functions.get(kind, {}).get(data[:4])
+        if function is None:
+            return False, b""
+        name, inputs, outputs = function
+        with self._lock:
+            self._count(self.contractCalls, f"{kind}.{name}")
+        args = decode(inputs, data[4:]) if inputs else ()
+        try:
+            result = getattr(self, f"_{kind}_{name}")(to.lower(), *args)
+        except (AttributeError, KeyError, IndexError):
+            return False, b""
+        if len(outputs) == 1:
+            result = (result,)
+        return True, encode(outputs, result)
+
+    def _multicall_aggregate3(self, to, calls):
+        return [self._call(target, data) for target, _, data in calls]
+
+    def _multicall_getBlockNumber(self, to):
+        return self.blockNumber
+
+    def _multicall_getCurrentBlockTimestamp(self, to):
+        return self.timestamp
+
+    def _erc20_decimals(self, to):
+        return self.tokens[to][0]
+
+    def _erc20_symbol(self, to):
+        return self.tokens[to][1]
+
+    def _erc20_name(self, to):
+        return self.tokens[to][1]
+
+    def _oracle_price(self, to):
+        return self.oracles[to]
+
+    def _irm_borrowRateView(self, to, params, market):
+        utilization = market[2] * WAD // market[0] if market[0] else 0
+        # 4% APR at 90% utilization, linear
+        return 4 * WAD // 100 * utilization // (9 * WAD // 10) // SECONDS_PER_YEAR
+
+    def _vault_MORPHO(self, to):
+        return self.blue
+
+    def _vault_asset(self, to):
+        return self.loanToken
+
+    def _vault_symbol(self, to):
+        return "synUSD"
+
+    def _vault_name(self, to):
+        return "Synthetic USD vault"
+
+    def _vault_decimals(self, to):
+        return 18
+
+    def _vault_withdrawQueueLength(self, to):
+        return len(self.queue)
+
+    def _vault_withdrawQueue(self, to, index):
+        return self.queue[index]
+
+    def _vault_supplyQueueLength(self, to):
+        return len(self.queue)
+
+    def _vault_supplyQueue(self, to, index):
+        return self.queue[index]
+
+    def _vault_config(self, to, id):
+        return (self.caps[id], True, 0)
+
+    def _vault_totalAssets(self, to):
+        return sum(self._supplyAssets(id, self.vault.lower()) for id in self.queue)
+
+    def _blue_idToMarketParams(self, to, id):
+        return self.params.get(
+            id, (ZERO_ADDRESS, ZERO_ADDRESS, ZERO_ADDRESS, ZERO_ADDRESS, 0)
+        )
+
+    def _blue_market(self, to, id):
+        return tuple(self.state[id])
+
+    def _blue_position(self, to, id, address):
+        return tuple(self.positions.get((id, address.lower()), (0, 0, 0)))
+
+    def _supplyAssets(self, id, address):
+        shares = self.positions.get((id, address), (0, 0, 0))[0]
+        state = self.state[id]
+        return shares * (state[0] + 1) // (state[1] + pow(10, 6))
+
+    def _reader_getMarketData(self, to, id):
+        totalSupply, supplyShares, totalBorrow, borrowShares, _, fee = self.state[id]
+        utilization = totalBorrow * WAD // totalSupply if totalSupply else 0
+        borrowRate = 0
+        if self.params[id][3] != ZERO_ADDRESS:
+            borrowRate = (
+                self._irm_borrowRateView(self.irm, None, self.state[id])
+                * SECONDS_PER_YEAR
+            )
+        supplyRate = borrowRate * utilization // WAD
+        return (
+            totalSupply,
+            supplyShares,
+            totalBorrow,
+            borrowShares,
+            fee,
+            utilization,
+            supplyRate,
+            borrowRate,
+        )
+
+    def _reader_getPosition(self, to, id, address):
+        address = address.lower()
+        supplyShares, borrowShares, collateral = self.positions.get(
+            (id, address), (0, 0, 0)
+        )
+        state = self.state[id]
+        borrowAssets = -(-borrowShares * (state[2] + 1) // (state[3] + pow(10, 6)))
+        price = self.oracles.get(self.params[id][2].lower(), 0)
+        collateralValue = collateral * price // pow(10, 36)
+        ltv = borrowAssets * WAD // collateralValue if collateralValue else 0
+        lltv = self.params[id][4]
+        health = collateralValue * lltv // borrowAssets if borrowAssets else 2**256 - 1
+        return (
+            supplyShares,
+            self._supplyAssets(id, address),
+            borrowShares,
+            borrowAssets,
+            collateral,
+            collateralValue,
+            ltv,
+            health,
+        )
+
+
+class SyntheticProvider(BaseProvider):
+    """web3 provider answering from a SyntheticChain, in process"""
+
+    def __init__(self, chain: SyntheticChain):
+        super().__init__()
+        self.chain = chain
+        self._ids = itertools.count()
+
+    def make_request(self, method, params):
+        return self.chain.rpc(
+            {
+                "jsonrpc": "2.0",
+                "method": method,
+                "params": list(params or []),
+                "id": next(self._ids),
+            }
+        )
+
+    def is_connected(self, show_traceback=False):
+        return True
+
+
+class SyntheticHandler(BaseHTTPRequestHandler):
+    """JSON-RPC over HTTP on top of a SyntheticChain, with keep-alive as a node"""
+
+    chain = None
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps(self.chain.rpc(request)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(chain, port=0):
+    """Serve the chain in a background thread, returns (server, url)"""
+    handler = type("Handler", (SyntheticHandler,), {"chain": chain})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"